@@ -0,0 +1,86 @@
+import asyncio
+import heapq
+import itertools
+import logging
+from typing import List, Tuple
+
+from starlette.exceptions import HTTPException
+
+logger = logging.getLogger(__name__)
+
+
+class ServiceUnavailableException(HTTPException):
+    """503 error telling the client when to retry with a Retry-After header"""
+
+    def __init__(self, detail: str, retry_after: int):
+        super().__init__(status_code=503, detail=detail)
+        self.headers = {"Retry-After": str(retry_after)}
+
+
+class AdmissionController:
+    """
+    Limits the requests handled at once to max_in_flight. Up to max_queue_length more
+    requests wait for a free slot, lowest priority number first and then in arrival
+    order. When the queue is full, a new request either replaces a queued request with
+    a higher priority number or is shed with a 503.
+    """
+
+    def __init__(self, max_in_flight: int, max_queue_length: int, retry_after: int):
+        self.max_in_flight = max_in_flight
+        self.max_queue_length = max_queue_length
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self.shed = 0
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._order = itertools.count()
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self, priority: int = 0):
+        if self.in_flight < self.max_in_flight and not self._waiters:
+            self.in_flight += 1
+            return
+        if self.queue_depth >= self.max_queue_length:
+            # Cancelled waiters that have not run their cleanup yet take no room
+            self._waiters = [waiter for waiter in self._waiters if not waiter[2].done()]
+            heapq.heapify(self._waiters)
+        if self.queue_depth >= self.max_queue_length:
+            lowest_waiter = max(self._waiters, default=None)
+            if lowest_waiter is None or lowest_waiter[0] <= priority:
+                raise self._shed_exception()
+            # Make room by shedding the queued request with the lowest priority
+            self._waiters.remove(lowest_waiter)
+            heapq.heapify(self._waiters)
+            lowest_waiter[2].set_exception(self._shed_exception())
+        future = asyncio.get_event_loop().create_future()
+        waiter = (priority, next(self._order), future)
+        heapq.heappush(self._waiters, waiter)
+        try:
+            await future
+        except asyncio.CancelledError:
+            # release or shedding may have popped the waiter already
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+                heapq.heapify(self._waiters)
+            if future.done() and not future.cancelled() and future.exception() is None:
+                # The slot was handed over just before the cancellation
+                self.release()
+            raise
+
+    def _shed_exception(self) -> ServiceUnavailableException:
+        self.shed += 1
+        err_msg = "Too many requests in progress, please retry later"
+        logger.warning(err_msg)
+        return ServiceUnavailableException(err_msg, self.retry_after)
+
+    def release(self):
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            # Skip waiters cancelled before their task could remove them
+            if not future.done():
+                # Hand the slot straight to the next waiter
+                future.set_result(None)
+                return
+        self.in_flight -= 1
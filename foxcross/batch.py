@@ -0,0 +1,304 @@
+import logging
+import re
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Deque, Dict, Iterator, List, Optional, Tuple, Union
+
+from slugify import slugify
+from starlette.exceptions import HTTPException
+
+from .constants import SLUGIFY_REGEX, SLUGIFY_REPLACE
+from .enums import BatchFormats
+from .exceptions import BatchPredictionError, NoModelServingFoundError
+from .executors import _call_in_worker, _WorkerHTTPException
+
+logger = logging.getLogger(__name__)
+
+_format_suffixes = {
+    ".json": BatchFormats.JSON,
+    ".ndjson": BatchFormats.NDJSON,
+    ".jsonl": BatchFormats.NDJSON,
+    ".csv": BatchFormats.CSV,
+    ".parquet": BatchFormats.PARQUET,
+    ".pq": BatchFormats.PARQUET,
+}
+
+
+def _import_pandas():
+    try:
+        import pandas
+    except ImportError:
+        raise ImportError(
+            "Cannot import pandas. Please install foxcross using foxcross[pandas] or"
+            " foxcross[modin]"
+        )
+    return pandas
+
+
+def _import_parquet():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError(
+            "Cannot import pyarrow. Please install foxcross using foxcross[arrow]"
+        )
+    return pyarrow
+
+
+def _get_runner() -> Any:
+    # The pandas runner also skips DataFrameModelServing when a module imports it
+    try:
+        from .pandas_serving import _model_serving_runner
+    except ImportError:
+        from .serving import _model_serving_runner
+    return _model_serving_runner
+
+
+def _get_format(path: Path, batch_format: Union[BatchFormats, str, None]) -> BatchFormats:
+    if batch_format is not None:
+        return BatchFormats(batch_format)
+    try:
+        return _format_suffixes[path.suffix.lower()]
+    except KeyError:
+        raise ValueError(
+            f"Cannot tell the format of {path} from its extension. Please pass one of"
+            f" {', '.join(x.value for x in BatchFormats)}"
+        )
+
+
+def find_batch_model_serving(module_name: str = "models", model: Optional[str] = None):
+    """
+    Find the model serving class to run in the module, by class name or by the slug it
+    is mounted under when the module has several
+    """
+    serving_models = _get_runner().find_model_servings(module_name)
+    if model is None:
+        if len(serving_models) > 1:
+            names = ", ".join(class_.__name__ for class_ in serving_models)
+            raise NoModelServingFoundError(
+                f"Found several model servings in {module_name}: {names}. Please choose"
+                f" one with model"
+            )
+        return serving_models[0]
+    for class_ in serving_models:
+        slug = slugify(re.sub(SLUGIFY_REGEX, SLUGIFY_REPLACE, class_.__name__))
+        if model in (class_.__name__, slug):
+            return class_
+    raise NoModelServingFoundError(
+        f"Could not find model serving {model} in {module_name}"
+    )
+
+
+def _read_ndjson(path: Path, chunk_size: int, json_codec: Any) -> Iterator[List[Any]]:
+    records = []
+    with path.open("rb") as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                records.append(json_codec.loads(line))
+            except (TypeError, ValueError) as exc:
+                raise BatchPredictionError(
+                    f"Failed to load line {line_number} of {path} into JSON: {exc}"
+                )
+            if len(records) >= chunk_size:
+                yield records
+                records = []
+    if records:
+        yield records
+
+
+def _read_chunks(
+    model_serving: Any, path: Path, input_format: BatchFormats, chunk_size: int
+) -> Iterator[Any]:
+    """Read the input in chunks of up to chunk_size rows, formatted for prediction"""
+    if input_format is BatchFormats.JSON:
+        # A JSON document cannot be read in parts, so it is predicted as one chunk
+        try:
+            data = model_serving._json_codec.loads(path.read_bytes())
+        except ValueError as exc:
+            raise BatchPredictionError(f"Failed to load {path} into JSON: {exc}")
+        yield model_serving._format_input(data)
+    elif input_format is BatchFormats.NDJSON:
+        for records in _read_ndjson(path, chunk_size, model_serving._json_codec):
+            yield model_serving._format_stream_chunk(records)
+    elif input_format is BatchFormats.CSV:
+        for frame in _import_pandas().read_csv(path, chunksize=chunk_size):
+            yield model_serving._format_frame_chunk(frame)
+    else:
+        parquet_file = _import_parquet().parquet.ParquetFile(str(path))
+        for record_batch in parquet_file.iter_batches(batch_size=chunk_size):
+            yield model_serving._format_frame_chunk(record_batch.to_pandas())
+
+
+def _count_rows(data: Any) -> int:
+    try:
+        return len(data)
+    except TypeError:
+        return 1
+
+
+def _results_frame(results: Any) -> Any:
+    pandas = _import_pandas()
+    # modin DataFrames are converted before they are written with pandas or pyarrow
+    to_pandas = getattr(results, "_to_pandas", None)
+    if to_pandas is not None:
+        return to_pandas()
+    return results if isinstance(results, pandas.DataFrame) else pandas.DataFrame(results)
+
+
+class _NDJSONWriter:
+    def __init__(self, model_serving: Any, path: Path):
+        self._model_serving = model_serving
+        self._file = path.open("wb")
+
+    def write(self, results: Any):
+        self._file.write(self._model_serving._serialize_stream_chunk(results))
+
+    def close(self):
+        self._file.close()
+
+
+class _CSVWriter:
+    def __init__(self, model_serving: Any, path: Path):
+        self._file = path.open("w", newline="")
+        self._header = True
+
+    def write(self, results: Any):
+        _results_frame(results).to_csv(self._file, header=self._header, index=False)
+        self._header = False
+
+    def close(self):
+        self._file.close()
+
+
+class _ParquetWriter:
+    def __init__(self, model_serving: Any, path: Path):
+        self._pyarrow = _import_parquet()
+        self._path = path
+        self._writer = None
+
+    def write(self, results: Any):
+        table = self._pyarrow.Table.from_pandas(
+            _results_frame(results), preserve_index=False
+        )
+        if self._writer is None:
+            # The first chunk sets the schema of the file
+            self._writer = self._pyarrow.parquet.ParquetWriter(
+                str(self._path), table.schema
+            )
+        self._writer.write_table(table)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+
+_writer_classes = {
+    BatchFormats.NDJSON: _NDJSONWriter,
+    BatchFormats.CSV: _CSVWriter,
+    BatchFormats.PARQUET: _ParquetWriter,
+}
+
+
+def _worker_result(future: Future) -> Any:
+    try:
+        return future.result()
+    except _WorkerHTTPException as exc:
+        raise exc.to_http_exception()
+
+
+def _predict_chunks(
+    model_serving: Any, chunks: Iterator[Any], workers: int
+) -> Iterator[Tuple[int, Any]]:
+    """Yield the number of rows and the prediction results of each chunk, in order"""
+    if workers <= 1:
+        for chunk in chunks:
+            yield _count_rows(chunk), model_serving._process_batch_prediction(chunk)
+        return
+    pending: Deque[Tuple[int, Future]] = deque()
+    executor = ProcessPoolExecutor(max_workers=workers)
+    try:
+        for chunk in chunks:
+            future = executor.submit(
+                _call_in_worker,
+                model_serving.__class__,
+                "_process_batch_prediction",
+                chunk,
+            )
+            pending.append((_count_rows(chunk), future))
+            # Reading ahead is bounded so that only a few chunks are held in memory
+            # while every worker has one to predict
+            if len(pending) >= workers * 2:
+                rows, future = pending.popleft()
+                yield rows, _worker_result(future)
+        while pending:
+            rows, future = pending.popleft()
+            yield rows, _worker_result(future)
+    finally:
+        for _, future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+def run_batch(
+    input_path: Union[str, Path],
+    output_path: Union[str, Path],
+    module_name: str = "models",
+    model: Optional[str] = None,
+    input_format: Union[BatchFormats, str, None] = None,
+    output_format: Union[BatchFormats, str, None] = None,
+    chunk_size: int = 10000,
+    workers: int = 1,
+) -> Dict[str, Any]:
+    """
+    Run the predictions of a model serving over the input file without HTTP, writing
+    the results of each chunk to the output file as soon as they are ready. Chunks are
+    predicted in a pool of worker processes when workers is more than one.
+    """
+    input_path, output_path = Path(input_path), Path(output_path)
+    input_format = _get_format(input_path, input_format)
+    output_format = _get_format(output_path, output_format)
+    if output_format is BatchFormats.JSON:
+        raise ValueError("JSON output cannot be written in chunks, please use ndjson")
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be at least 1")
+    model_serving_class = find_batch_model_serving(module_name, model)
+    # With workers, the model is only loaded in the worker processes
+    model_serving = model_serving_class(lazy_load=workers > 1)
+    logger.info(
+        f"Predicting {input_path} with {model_serving_class.__name__} into {output_path}"
+    )
+    rows = chunks = 0
+    start = time.perf_counter()
+    writer = _writer_classes[output_format](model_serving, output_path)
+    try:
+        for chunk_rows, results in _predict_chunks(
+            model_serving,
+            _read_chunks(model_serving, input_path, input_format, chunk_size),
+            workers,
+        ):
+            writer.write(results)
+            rows += chunk_rows
+            chunks += 1
+            logger.debug(f"Wrote chunk {chunks} of {chunk_rows} rows")
+    except HTTPException as exc:
+        raise BatchPredictionError(f"Chunk {chunks + 1} failed: {exc.detail}")
+    finally:
+        writer.close()
+    seconds = time.perf_counter() - start
+    rows_per_second = rows / seconds if seconds > 0 else 0.0
+    logger.info(
+        f"Predicted {rows} rows in {chunks} chunks in {seconds:.3f}s"
+        f" ({rows_per_second:.1f} rows/sec)"
+    )
+    return {
+        "model": model_serving_class.__name__,
+        "rows": rows,
+        "chunks": chunks,
+        "seconds": seconds,
+        "rows_per_second": rows_per_second,
+    }
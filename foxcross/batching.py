@@ -0,0 +1,85 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Hashable, List, Optional, Tuple
+
+from starlette.exceptions import HTTPException
+
+logger = logging.getLogger(__name__)
+
+
+class PredictionBatcher:
+    """
+    Collects concurrent predictions for up to max_wait seconds or max_size items and
+    runs them through predict_batch as a single batch. Only one batch runs at a time and
+    only items submitted with the same key are batched together.
+    """
+
+    def __init__(
+        self,
+        predict_batch: Callable[[List[Any]], Awaitable[List[Any]]],
+        max_size: int,
+        max_wait: float,
+        max_queue_size: Optional[int] = None,
+    ):
+        self._predict_batch = predict_batch
+        self._max_size = max_size
+        self._max_wait = max_wait
+        self._max_queue_size = max_queue_size
+        self._pending: List[Tuple[Hashable, Any, asyncio.Future]] = []
+        self._in_flight = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of items waiting for or running in a batch"""
+        return len(self._pending) + self._in_flight
+
+    async def submit(self, data: Any, key: Hashable = None) -> Any:
+        if self._max_queue_size is not None and self.queue_depth >= self._max_queue_size:
+            err_msg = "Prediction batch queue is full"
+            logger.warning(err_msg)
+            raise HTTPException(status_code=503, detail=err_msg)
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self._pending.append((key, data, future))
+        if self._in_flight:
+            # The running batch schedules the next one when it finishes
+            return await future
+        if len(self._next_batch_items()) >= self._max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self._max_wait, self._flush)
+        return await future
+
+    def _next_batch_items(self) -> List[Tuple[Hashable, Any, asyncio.Future]]:
+        key = self._pending[0][0]
+        return [item for item in self._pending if item[0] == key][: self._max_size]
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._in_flight or not self._pending:
+            return
+        batch = self._next_batch_items()
+        batch_ids = {id(item) for item in batch}
+        self._pending = [item for item in self._pending if id(item) not in batch_ids]
+        self._in_flight = len(batch)
+        asyncio.get_event_loop().create_task(self._run_batch(batch))
+
+    async def _run_batch(self, batch: List[Tuple[Hashable, Any, asyncio.Future]]):
+        logger.debug(f"Running prediction batch of size {len(batch)}")
+        try:
+            results = await self._predict_batch([data for _, data, _ in batch])
+        except Exception as exc:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(exc)
+        else:
+            for (_, _, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+        finally:
+            self._in_flight = 0
+            # Items that queued up while this batch ran have already waited for it
+            self._flush()
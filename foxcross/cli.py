@@ -0,0 +1,76 @@
+import argparse
+import logging
+import os
+import sys
+from typing import List, Optional
+
+from .enums import BatchFormats
+from .exceptions import FoxcrossException
+
+logger = logging.getLogger(__name__)
+
+
+def _create_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="foxcross")
+    subparsers = parser.add_subparsers(dest="command")
+    batch_parser = subparsers.add_parser(
+        "batch", help="Run a model serving over a file without HTTP"
+    )
+    formats = [x.value for x in BatchFormats]
+    batch_parser.add_argument("input", help="JSON, NDJSON, CSV or Parquet input file")
+    batch_parser.add_argument("output", help="NDJSON, CSV or Parquet output file")
+    batch_parser.add_argument(
+        "--module", default="models", help="Python module of the model serving"
+    )
+    batch_parser.add_argument(
+        "--model", help="Model serving class name or slug, if the module has several"
+    )
+    batch_parser.add_argument(
+        "--input-format", choices=formats, help="Defaults to the input file extension"
+    )
+    batch_parser.add_argument(
+        "--output-format", choices=formats, help="Defaults to the output file extension"
+    )
+    batch_parser.add_argument(
+        "--chunk-size", type=int, default=10000, help="Rows predicted at a time"
+    )
+    batch_parser.add_argument(
+        "--workers", type=int, default=1, help="Processes predicting chunks in parallel"
+    )
+    batch_parser.add_argument("--log-level", default="info")
+    return parser
+
+
+def _batch(args: argparse.Namespace) -> int:
+    from .batch import run_batch
+
+    logging.basicConfig(
+        level=args.log_level.upper(), format="%(asctime)s %(levelname)s %(message)s"
+    )
+    # Like uvicorn, find the model serving module in the working directory
+    if os.getcwd() not in sys.path:
+        sys.path.insert(0, os.getcwd())
+    try:
+        run_batch(
+            args.input,
+            args.output,
+            module_name=args.module,
+            model=args.model,
+            input_format=args.input_format,
+            output_format=args.output_format,
+            chunk_size=args.chunk_size,
+            workers=args.workers,
+        )
+    except (FoxcrossException, ImportError, OSError, ValueError) as exc:
+        logger.error(f"Batch prediction failed: {exc}")
+        return 1
+    return 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = _create_parser()
+    args = parser.parse_args(argv)
+    if args.command == "batch":
+        return _batch(args)
+    parser.print_help()
+    return 2
@@ -0,0 +1,42 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict
+
+logger = logging.getLogger(__name__)
+
+
+class RequestCoalescer:
+    """
+    Runs one prediction for concurrent requests with the same key and hands all of them
+    its result. A key is forgotten as soon as its prediction finishes, so unlike the
+    result cache nothing is kept for later requests. The prediction runs in its own
+    task, so it still finishes for the other requests when the first one disconnects.
+    """
+
+    def __init__(self):
+        self.coalesced = 0
+        self._in_flight: Dict[str, asyncio.Future] = {}
+
+    @property
+    def in_flight(self) -> int:
+        """Number of distinct predictions running"""
+        return len(self._in_flight)
+
+    async def run(self, key: str, function: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._in_flight.get(key)
+        if task is not None:
+            self.coalesced += 1
+            logger.debug("Coalesced prediction with an identical one in flight")
+        else:
+            task = asyncio.ensure_future(function())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+        # Shielded, so a waiter that is cancelled does not cancel the others' prediction
+        return await asyncio.shield(task)
+
+    def _finish(self, key: str, task: asyncio.Future):
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+        # Retrieve the exception, so asyncio does not log it when every waiter has gone
+        if not task.cancelled():
+            task.exception()
@@ -0,0 +1,263 @@
+import logging
+import zlib
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.exceptions import HTTPException
+from starlette.responses import PlainTextResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from .caching import ResultCache
+from .negotiation import parse_q_values
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_COMPRESSION_LEVELS = {"zstd": 3, "br": 4, "gzip": 6}
+
+
+class _Compressor:
+    """Incremental compressor with a common interface over zlib, brotli and zstandard"""
+
+    def __init__(self, encoding: str, level: int):
+        if encoding == "gzip":
+            # wbits of 31 writes a gzip header and trailer
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+            self._flush = lambda: self._compressor.flush(zlib.Z_SYNC_FLUSH)
+            self._finish = self._compressor.flush
+            self.compress = self._compressor.compress
+        elif encoding == "br":
+            self._compressor = brotli.Compressor(quality=level)
+            self._flush = self._compressor.flush
+            self._finish = self._compressor.finish
+            self.compress = self._compressor.process
+        else:
+            self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+            self._flush = lambda: self._compressor.flush(
+                zstandard.COMPRESSOBJ_FLUSH_BLOCK
+            )
+            self._finish = self._compressor.flush
+            self.compress = self._compressor.compress
+
+    def compress_chunk(self, data: bytes) -> bytes:
+        """Compress data and flush it, so a streaming client can decode it right away"""
+        return self.compress(data) + self._flush()
+
+    def compress_last(self, data: bytes) -> bytes:
+        return self.compress(data) + self._finish()
+
+
+class _Decompressor:
+    def __init__(self, encoding: str):
+        if encoding == "gzip":
+            self._decompressor = zlib.decompressobj(31)
+            self.decompress = self._decompressor.decompress
+            self.finished = lambda: self._decompressor.eof
+        elif encoding == "br":
+            self._decompressor = brotli.Decompressor()
+            self.decompress = self._decompressor.process
+            self.finished = self._decompressor.is_finished
+        else:
+            self._decompressor = zstandard.ZstdDecompressor().decompressobj()
+            self.decompress = self._decompressor.decompress
+            self.finished = lambda: self._decompressor.eof
+
+
+def available_encodings() -> Tuple[str, ...]:
+    encodings = []
+    if zstandard is not None:
+        encodings.append("zstd")
+    if brotli is not None:
+        encodings.append("br")
+    encodings.append("gzip")
+    return tuple(encodings)
+
+
+def negotiate_encoding(accept_encoding: str, encodings: Iterable[str]) -> Optional[str]:
+    """
+    Pick the encoding with the highest q-value in the Accept-Encoding header, preferring
+    earlier encodings on ties. Returns None when the response should not be compressed.
+    """
+    q_values = dict(parse_q_values(accept_encoding))
+    best_encoding = None
+    best_q_value = 0.0
+    for encoding in encodings:
+        q_value = q_values.get(encoding, q_values.get("*", 0.0))
+        if q_value > best_q_value:
+            best_encoding, best_q_value = encoding, q_value
+    return best_encoding
+
+
+class CompressionMiddleware:
+    """
+    Compresses responses of at least minimum_size bytes with zstd, brotli or gzip as
+    negotiated by Accept-Encoding, and decompresses request bodies sent with a
+    Content-Encoding. Compressed bodies of responses to cached_paths are kept in cache,
+    keyed by the encoding and the uncompressed body, so identical responses such as the
+    test data are only compressed once.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        minimum_size: int = 500,
+        levels: Optional[Dict[str, int]] = None,
+        encodings: Optional[Iterable[str]] = None,
+        cached_paths: Iterable[str] = (),
+        cache: Optional[ResultCache] = None,
+        max_decompressed_size: Optional[int] = None,
+    ):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.levels = {**DEFAULT_COMPRESSION_LEVELS, **(levels or {})}
+        supported = available_encodings()
+        self.encodings = tuple(
+            encoding
+            for encoding in (supported if encodings is None else encodings)
+            if encoding in supported
+        )
+        self.cached_paths = frozenset(cached_paths)
+        self.cache = cache
+        self.max_decompressed_size = max_decompressed_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = Headers(scope=scope)
+        content_encoding = headers.get("content-encoding", "identity").strip().lower()
+        if content_encoding != "identity":
+            if content_encoding not in available_encodings():
+                err_msg = f"Content-Encoding {content_encoding} is not supported"
+                logger.warning(err_msg)
+                response = PlainTextResponse(err_msg, status_code=415)
+                await response(scope, receive, send)
+                return
+            scope = _decoded_scope(scope)
+            receive = _DecompressingReceive(
+                receive, content_encoding, self.max_decompressed_size
+            )
+        encoding = negotiate_encoding(headers.get("accept-encoding", ""), self.encodings)
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        responder = _CompressionResponder(
+            self, encoding, scope["path"] in self.cached_paths, send
+        )
+        await self.app(scope, receive, responder.send)
+
+
+def _decoded_scope(scope: Scope) -> Scope:
+    # The app sees the request as if it had been sent uncompressed
+    raw_headers: List[Tuple[bytes, bytes]] = [
+        (name, value)
+        for name, value in scope["headers"]
+        if name not in (b"content-encoding", b"content-length")
+    ]
+    return {**scope, "headers": raw_headers}
+
+
+class _DecompressingReceive:
+    def __init__(self, receive: Receive, encoding: str, max_size: Optional[int]):
+        self._receive = receive
+        self._encoding = encoding
+        self._max_size = max_size
+        self._size = 0
+        self._decompressor = _Decompressor(encoding)
+
+    async def __call__(self) -> Message:
+        message = await self._receive()
+        if message["type"] != "http.request":
+            return message
+        err_msg = f"Failed to decompress the {self._encoding} request body"
+        try:
+            body = self._decompressor.decompress(message.get("body", b""))
+        except Exception as exc:
+            logger.warning(f"{err_msg}: {exc}")
+            raise HTTPException(status_code=400, detail=err_msg)
+        if not message.get("more_body", False) and not self._decompressor.finished():
+            logger.warning(f"{err_msg}: truncated body")
+            raise HTTPException(status_code=400, detail=err_msg)
+        self._size += len(body)
+        if self._max_size is not None and self._size > self._max_size:
+            err_msg = f"Decompressed request body is larger than {self._max_size} bytes"
+            logger.warning(err_msg)
+            raise HTTPException(status_code=413, detail=err_msg)
+        return {**message, "body": body}
+
+
+class _CompressionResponder:
+    def __init__(
+        self, middleware: CompressionMiddleware, encoding: str, cached: bool, send: Send
+    ):
+        self._middleware = middleware
+        self._encoding = encoding
+        self._cached = cached and middleware.cache is not None
+        self._send = send
+        self._start_message: Optional[Message] = None
+        self._compressor: Optional[_Compressor] = None
+        self.started = False
+
+    async def send(self, message: Message):
+        if message["type"] == "http.response.start":
+            # Hold the headers until the first body shows whether to compress
+            self._start_message = message
+            return
+        if message["type"] != "http.response.body":
+            await self._send(message)
+            return
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if self._compressor is not None:
+            message["body"] = (
+                self._compressor.compress_chunk(body)
+                if more_body
+                else self._compressor.compress_last(body)
+            )
+            await self._send(message)
+            return
+        if self.started:
+            await self._send(message)
+            return
+        self.started = True
+        headers = MutableHeaders(raw=self._start_message["headers"])
+        if "content-encoding" in headers or (
+            not more_body and len(body) < self._middleware.minimum_size
+        ):
+            await self._send(self._start_message)
+            await self._send(message)
+            return
+        headers["Content-Encoding"] = self._encoding
+        headers.add_vary_header("Accept-Encoding")
+        if more_body:
+            del headers["Content-Length"]
+            self._compressor = self._new_compressor()
+            message["body"] = self._compressor.compress_chunk(body)
+        else:
+            message["body"] = self._compress_body(body)
+            headers["Content-Length"] = str(len(message["body"]))
+        await self._send(self._start_message)
+        await self._send(message)
+
+    def _new_compressor(self) -> _Compressor:
+        return _Compressor(self._encoding, self._middleware.levels[self._encoding])
+
+    def _compress_body(self, body: bytes) -> bytes:
+        if not self._cached:
+            return self._new_compressor().compress_last(body)
+        cache = self._middleware.cache
+        key = cache.make_key(self._encoding.encode(), body)
+        compressed = cache.get(key)
+        if compressed is None:
+            compressed = self._new_compressor().compress_last(body)
+            cache.set(key, compressed)
+        return compressed
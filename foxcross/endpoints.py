@@ -1,8 +1,8 @@
 from starlette.requests import Request
-from starlette.templating import Jinja2Templates
+from starlette.responses import Response
 
-from .templates import templates
+from .templates import get_templates
 
 
-async def _index_endpoint(request: Request) -> Jinja2Templates.TemplateResponse:
-    return templates.TemplateResponse("index.html", {"request": request})
+async def _index_endpoint(request: Request) -> Response:
+    return get_templates().TemplateResponse("index.html", {"request": request})
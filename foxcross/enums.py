@@ -4,6 +4,10 @@ from enum import Enum
 class MediaTypes(Enum):
     JSON = "application/json"
     HTML = "text/html"
+    ARROW_STREAM = "application/vnd.apache.arrow.stream"
+    PARQUET = "application/vnd.apache.parquet"
+    NUMPY = "application/x-npy"
+    NDJSON = "application/x-ndjson"
     ANY_TEXT = "text/*"
     ANY_APP = "application/*"
     ANY = "*/*"
@@ -15,3 +19,29 @@ class MediaTypes(Enum):
     @classmethod
     def json_media_types(cls):
         return cls.ANY.value, cls.ANY_APP.value, cls.JSON.value
+
+
+class ExecutionModes(Enum):
+    INLINE = "inline"
+    THREAD = "thread"
+    PROCESS = "process"
+
+
+class JSONCodecs(Enum):
+    AUTO = "auto"
+    ORJSON = "orjson"
+    UJSON = "ujson"
+    JSON = "json"
+
+
+class LoadModes(Enum):
+    EAGER = "eager"
+    PARALLEL = "parallel"
+    LAZY = "lazy"
+
+
+class BatchFormats(Enum):
+    JSON = "json"
+    NDJSON = "ndjson"
+    CSV = "csv"
+    PARQUET = "parquet"
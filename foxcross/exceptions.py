@@ -1,3 +1,8 @@
+from typing import Optional
+
+from starlette.exceptions import HTTPException
+
+
 class FoxcrossException(Exception):
     pass
 
@@ -20,3 +25,27 @@ class PreProcessingError(FoxcrossException):
 
 class PostProcessingError(FoxcrossException):
     http_status_code = 500
+
+
+class BatchPredictionError(FoxcrossException):
+    pass
+
+
+class SchemaValidationError(FoxcrossException):
+    http_status_code = 400
+
+
+def to_http_exception(exc: Exception, detail: Optional[str] = None) -> HTTPException:
+    """
+    HTTPException for a foxcross exception that remembers the exception's class, so
+    errors are counted by the class the model raised rather than as HTTPException
+    """
+    http_exception = HTTPException(
+        status_code=exc.http_status_code, detail=str(exc) if detail is None else detail
+    )
+    http_exception.exception_name = type(exc).__name__
+    return http_exception
+
+
+def exception_name(exc: Exception) -> str:
+    return getattr(exc, "exception_name", type(exc).__name__)
@@ -0,0 +1,89 @@
+import asyncio
+import logging
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Any, Optional
+
+from starlette.exceptions import HTTPException
+
+from .enums import ExecutionModes
+from .exceptions import exception_name
+
+logger = logging.getLogger(__name__)
+
+# Model serving used by the prediction function inside process pool workers
+_worker_model_serving = None
+
+
+class _WorkerHTTPException(Exception):
+    """
+    Starlette's HTTPException does not survive pickling, so process pool workers
+    send the status code and detail back in this exception instead
+    """
+
+    def __init__(self, status_code: int, detail: str, exception_name: str):
+        super().__init__(status_code, detail, exception_name)
+        self.status_code = status_code
+        self.detail = detail
+        self.exception_name = exception_name
+
+    def to_http_exception(self) -> HTTPException:
+        http_exception = HTTPException(status_code=self.status_code, detail=self.detail)
+        http_exception.exception_name = self.exception_name
+        return http_exception
+
+
+def _get_worker_model_serving(model_serving_class: Any) -> Any:
+    # Loaded on the first call in each worker rather than with a ProcessPoolExecutor
+    # initializer, which needs Python 3.7
+    global _worker_model_serving
+    if _worker_model_serving is None:
+        # Skip the Starlette setup in ModelServing.__init__ since workers only predict
+        model_serving = model_serving_class.__new__(model_serving_class)
+        model_serving.load_model()
+        _worker_model_serving = model_serving
+        logger.debug(f"Initialized process worker for {model_serving_class}")
+    return _worker_model_serving
+
+
+def _call_in_worker(model_serving_class: Any, method_name: str, data: Any) -> Any:
+    try:
+        model_serving = _get_worker_model_serving(model_serving_class)
+        return getattr(model_serving, method_name)(data)
+    except HTTPException as exc:
+        raise _WorkerHTTPException(exc.status_code, exc.detail, exception_name(exc))
+
+
+def create_executor(
+    execution_mode: ExecutionModes, max_workers: Optional[int]
+) -> Optional[Executor]:
+    if execution_mode is ExecutionModes.THREAD:
+        logger.debug(f"Creating thread pool with max_workers={max_workers}")
+        return ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="foxcross-predict"
+        )
+    elif execution_mode is ExecutionModes.PROCESS:
+        # Imported here, since it pulls in multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        logger.debug(f"Creating process pool with max_workers={max_workers}")
+        return ProcessPoolExecutor(max_workers=max_workers)
+    return None
+
+
+async def run_in_executor(
+    executor: Executor,
+    execution_mode: ExecutionModes,
+    model_serving: Any,
+    method_name: str,
+    data: Any,
+) -> Any:
+    """Run a model serving method by name in the executor for the execution mode"""
+    loop = asyncio.get_event_loop()
+    if execution_mode is ExecutionModes.PROCESS:
+        try:
+            return await loop.run_in_executor(
+                executor, _call_in_worker, model_serving.__class__, method_name, data
+            )
+        except _WorkerHTTPException as exc:
+            raise exc.to_http_exception()
+    return await loop.run_in_executor(executor, getattr(model_serving, method_name), data)
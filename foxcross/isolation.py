@@ -0,0 +1,312 @@
+import asyncio
+import logging
+import os
+import re
+import shutil
+import signal
+import socket
+import tempfile
+import time
+from typing import Any, List, Optional, Tuple
+from urllib.parse import quote
+
+import h11
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+from starlette.types import Receive, Scope, Send
+
+from .constants import SLUGIFY_REGEX, SLUGIFY_REPLACE
+
+logger = logging.getLogger(__name__)
+
+# Headers that only apply to one connection, or that the front server adds itself
+_skipped_headers = frozenset(
+    (
+        b"connection",
+        b"keep-alive",
+        b"proxy-authenticate",
+        b"proxy-authorization",
+        b"te",
+        b"trailer",
+        b"transfer-encoding",
+        b"upgrade",
+        b"date",
+        b"server",
+    )
+)
+# Shorter than the 5 second keep alive timeout of uvicorn, so an idle connection is
+# dropped before the model's server closes it
+_max_idle_seconds = 4.0
+_read_size = 65536
+# Endpoints of an isolated model listed in the navigation of the composed app's pages
+_listed_paths = ("/predict/", "/predict-stream/", "/predict-test/", "/input-format/")
+
+_IdleConnection = Tuple[asyncio.StreamReader, asyncio.StreamWriter, h11.Connection, float]
+
+
+class IsolatedModelProcess:
+    """
+    Serves a model serving class from processes of its own on a Unix socket. A forked
+    supervisor process loads the model and forks workers that accept requests from the
+    socket, so the model's memory, event loop and CPU time are kept apart from the
+    other models. The socket is bound before forking, so requests wait in its backlog
+    while the model loads instead of failing.
+    """
+
+    def __init__(
+        self,
+        model_serving_class: Any,
+        workers: int = 1,
+        root_path: str = "",
+        stop_timeout: float = 10.0,
+        **kwargs,
+    ):
+        self.model_serving_class = model_serving_class
+        self.workers = workers
+        self.root_path = root_path
+        self.stop_timeout = stop_timeout
+        self.socket_path: Optional[str] = None
+        self.pid: Optional[int] = None
+        self._kwargs = kwargs
+        self._directory: Optional[str] = None
+        self._owner_pid: Optional[int] = None
+
+    @property
+    def name(self) -> str:
+        return self.model_serving_class.__name__
+
+    def start(self):
+        self._directory = tempfile.mkdtemp(prefix="foxcross-")
+        self.socket_path = os.path.join(self._directory, "model.sock")
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.socket_path)
+        sock.listen(2048)
+        self._owner_pid = os.getpid()
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 1
+            try:
+                exit_code = self._serve(sock)
+            except BaseException:
+                logger.exception(f"Isolated {self.name} process {os.getpid()} failed")
+            finally:
+                os._exit(exit_code)
+        sock.close()
+        self.pid = pid
+        logger.info(
+            f"Started {self.name} in isolated process {pid} with {self.workers} workers"
+            f" on {self.socket_path}"
+        )
+
+    def _serve(self, sock: socket.socket) -> int:
+        # Imported here, since only the isolated processes run a server of their own
+        import uvicorn
+
+        from .workers import WorkerSupervisor
+
+        model_serving = self.model_serving_class(**self._kwargs)
+        config = uvicorn.Config(
+            model_serving,
+            root_path=self.root_path,
+            debug=self._kwargs.get("debug", False),
+        )
+        return WorkerSupervisor(config, self.workers, sock=sock).run()
+
+    def stop(self):
+        # Forked workers of the composing process inherit this object, but only the
+        # process that forked the model's process can wait for it
+        if self.pid is None or os.getpid() != self._owner_pid:
+            return
+        pid, self.pid = self.pid, None
+        try:
+            os.kill(pid, signal.SIGTERM)
+            deadline = time.monotonic() + self.stop_timeout
+            while os.waitpid(pid, os.WNOHANG) == (0, 0):
+                if time.monotonic() >= deadline:
+                    logger.warning(
+                        f"Killing isolated {self.name} process {pid} that did not stop"
+                        f" within {self.stop_timeout}s"
+                    )
+                    os.kill(pid, signal.SIGKILL)
+                    os.waitpid(pid, 0)
+                    break
+                time.sleep(0.05)
+        except (ProcessLookupError, ChildProcessError):
+            pass
+        shutil.rmtree(self._directory, ignore_errors=True)
+        logger.info(f"Stopped isolated {self.name} process {pid}")
+
+
+class IsolatedModelProxy:
+    """
+    ASGI app that forwards HTTP requests to an isolated model over its Unix socket.
+    Request and response bodies are streamed both ways at once, and idle connections
+    are kept for the next request.
+    """
+
+    def __init__(self, process: IsolatedModelProcess, max_idle_connections: int = 64):
+        self.process = process
+        self.max_idle_connections = max_idle_connections
+        self.model_name = process.model_serving_class.model_name or re.sub(
+            SLUGIFY_REGEX, SLUGIFY_REPLACE, process.name
+        )
+        self.routes = [Route(path, self) for path in _listed_paths]
+        self._idle: List[_IdleConnection] = []
+        self._idle_loop: Optional[asyncio.AbstractEventLoop] = None
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            return
+        try:
+            reader, writer, connection = await self._acquire()
+        except OSError as exc:
+            err_msg = f"Model {self.process.name} is unavailable"
+            logger.warning(f"{err_msg}: {exc}")
+            await PlainTextResponse(err_msg, status_code=503)(scope, receive, send)
+            return
+        response_started = []
+        try:
+            await self._forward(
+                scope, receive, send, reader, writer, connection, response_started
+            )
+        except (OSError, h11.ProtocolError) as exc:
+            writer.close()
+            if response_started:
+                raise
+            err_msg = f"Model {self.process.name} failed to respond"
+            logger.warning(f"{err_msg}: {exc!r}")
+            await PlainTextResponse(err_msg, status_code=502)(scope, receive, send)
+            return
+        except BaseException:
+            writer.close()
+            raise
+        self._release(reader, writer, connection)
+
+    async def _acquire(
+        self,
+    ) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter, h11.Connection]:
+        loop = asyncio.get_event_loop()
+        if loop is not self._idle_loop:
+            # Connections cannot be shared between event loops
+            self._idle = []
+            self._idle_loop = loop
+        while self._idle:
+            reader, writer, connection, idle_since = self._idle.pop()
+            if not reader.at_eof() and time.monotonic() - idle_since < _max_idle_seconds:
+                return reader, writer, connection
+            writer.close()
+        reader, writer = await asyncio.open_unix_connection(self.process.socket_path)
+        return reader, writer, h11.Connection(h11.CLIENT)
+
+    def _release(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        connection: h11.Connection,
+    ):
+        if (
+            connection.our_state is h11.DONE
+            and connection.their_state is h11.DONE
+            and len(self._idle) < self.max_idle_connections
+        ):
+            connection.start_next_cycle()
+            self._idle.append((reader, writer, connection, time.monotonic()))
+        else:
+            writer.close()
+
+    async def _forward(
+        self,
+        scope: Scope,
+        receive: Receive,
+        send: Send,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        connection: h11.Connection,
+        response_started: List[bool],
+    ):
+        writer.write(connection.send(_make_request(scope)))
+        # The model may answer before it has read the whole body, as streaming
+        # predictions do, so the body is sent while the response is read
+        sending = asyncio.ensure_future(_send_body(receive, writer, connection))
+        try:
+            event = await _next_event(reader, connection)
+            while isinstance(event, h11.InformationalResponse):
+                event = await _next_event(reader, connection)
+            if not isinstance(event, h11.Response):
+                raise ConnectionResetError("Connection closed before the response")
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": event.status_code,
+                    "headers": _forwarded_headers(event.headers),
+                }
+            )
+            response_started.append(True)
+            while True:
+                event = await _next_event(reader, connection)
+                if isinstance(event, h11.Data):
+                    await send(
+                        {
+                            "type": "http.response.body",
+                            "body": bytes(event.data),
+                            "more_body": True,
+                        }
+                    )
+                elif isinstance(event, h11.EndOfMessage):
+                    break
+                else:
+                    raise ConnectionResetError("Connection closed during the response")
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            await sending
+        finally:
+            if not sending.done():
+                sending.cancel()
+            elif not sending.cancelled():
+                # Retrieved, so asyncio does not log an error the response already hit
+                sending.exception()
+
+
+def _forwarded_headers(headers: Any) -> List[Tuple[bytes, bytes]]:
+    return [
+        (name.lower(), value)
+        for name, value in headers
+        if name.lower() not in _skipped_headers
+    ]
+
+
+def _make_request(scope: Scope) -> h11.Request:
+    headers = _forwarded_headers(scope["headers"])
+    names = {name for name, _ in headers}
+    if b"host" not in names:
+        headers.append((b"host", b"localhost"))
+    if b"content-length" not in names:
+        headers.append((b"transfer-encoding", b"chunked"))
+    target = quote(scope["path"])
+    if scope.get("query_string"):
+        target = f"{target}?{scope['query_string'].decode('latin-1')}"
+    return h11.Request(method=scope["method"], target=target, headers=headers)
+
+
+async def _send_body(
+    receive: Receive, writer: asyncio.StreamWriter, connection: h11.Connection
+):
+    more_body = True
+    while more_body:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            raise ConnectionAbortedError("Client disconnected")
+        if message.get("body"):
+            writer.write(connection.send(h11.Data(data=message["body"])))
+            await writer.drain()
+        more_body = message.get("more_body", False)
+    writer.write(connection.send(h11.EndOfMessage()))
+    await writer.drain()
+
+
+async def _next_event(reader: asyncio.StreamReader, connection: h11.Connection) -> Any:
+    while True:
+        event = connection.next_event()
+        if event is not h11.NEED_DATA:
+            return event
+        # An empty read tells h11 the connection was closed
+        connection.receive_data(await reader.read(_read_size))
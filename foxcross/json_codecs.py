@@ -0,0 +1,89 @@
+import json
+from typing import Any, Tuple
+
+from .enums import JSONCodecs
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+def _default(obj: Any) -> Any:
+    # numpy arrays and scalars both convert themselves to Python objects with tolist,
+    # which avoids importing numpy just to check their types
+    if type(obj).__module__ == "numpy" and hasattr(obj, "tolist"):
+        return obj.tolist()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+class JSONCodec:
+    """Decodes JSON from bytes and encodes it to UTF-8 bytes with the standard library"""
+
+    def loads(self, data: bytes) -> Any:
+        return json.loads(data)
+
+    def dumps(self, data: Any) -> bytes:
+        return json.dumps(
+            data,
+            ensure_ascii=False,
+            allow_nan=False,
+            separators=(",", ":"),
+            default=_default,
+        ).encode("utf-8")
+
+
+class UJSONCodec(JSONCodec):
+    def loads(self, data: bytes) -> Any:
+        return ujson.loads(data)
+
+    def dumps(self, data: Any) -> bytes:
+        return ujson.dumps(data, ensure_ascii=False).encode("utf-8")
+
+
+class OrjsonCodec(JSONCodec):
+    def loads(self, data: bytes) -> Any:
+        return orjson.loads(data)
+
+    def dumps(self, data: Any) -> bytes:
+        # orjson writes contiguous numpy arrays natively and falls back to _default
+        # for the rest
+        return orjson.dumps(
+            data,
+            default=_default,
+            option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS,
+        )
+
+
+_codec_classes = {
+    JSONCodecs.ORJSON: OrjsonCodec,
+    JSONCodecs.UJSON: UJSONCodec,
+    JSONCodecs.JSON: JSONCodec,
+}
+
+
+def available_json_codecs() -> Tuple[JSONCodecs, ...]:
+    """Installed JSON codecs, fastest first"""
+    codecs = []
+    if orjson is not None:
+        codecs.append(JSONCodecs.ORJSON)
+    if ujson is not None:
+        codecs.append(JSONCodecs.UJSON)
+    codecs.append(JSONCodecs.JSON)
+    return tuple(codecs)
+
+
+def get_json_codec(codec: JSONCodecs = JSONCodecs.AUTO) -> JSONCodec:
+    if codec is JSONCodecs.AUTO:
+        codec = available_json_codecs()[0]
+    elif codec not in available_json_codecs():
+        raise ImportError(
+            f"Cannot import {codec.value}. Please install foxcross using"
+            f" foxcross[{codec.value}]"
+        )
+    return _codec_classes[codec]()
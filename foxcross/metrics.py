@@ -0,0 +1,183 @@
+import bisect
+import threading
+from collections import defaultdict
+from typing import Callable, DefaultDict, Dict, Iterable, List, Tuple
+
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse
+
+PROMETHEUS_MEDIA_TYPE = "text/plain; version=0.0.4"
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+_metric_help = {
+    "foxcross_requests_total": ("counter", "HTTP requests handled"),
+    "foxcross_request_errors_total": ("counter", "Errors raised while handling requests"),
+    "foxcross_requests_in_flight": ("gauge", "HTTP requests currently being handled"),
+    "foxcross_request_duration_seconds": ("histogram", "HTTP request latency"),
+    "foxcross_stage_duration_seconds": ("histogram", "Prediction stage latency"),
+}
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels
+    )
+    return ",".join(f'{name}="{value}"' for name, value in escaped)
+
+
+class Histogram:
+    """Cumulative latency histogram with fixed upper bounds"""
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name: str, labels: Tuple[Tuple[str, str], ...]) -> List[str]:
+        lines = []
+        cumulative = 0
+        for upper_bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += count
+            le = "+Inf" if upper_bound == float("inf") else repr(upper_bound)
+            lines.append(
+                f"{name}_bucket{{{_format_labels(labels + (('le', le),))}}} {cumulative}"
+            )
+        lines.append(f"{name}_sum{{{_format_labels(labels)}}} {self.sum!r}")
+        lines.append(f"{name}_count{{{_format_labels(labels)}}} {self.count}")
+        return lines
+
+
+class ModelMetrics:
+    """
+    Request, error and latency metrics of a single model serving, rendered in the
+    Prometheus text format. Updates only take a lock, a dict lookup and a bisect, so
+    recording them adds microseconds to a request.
+    """
+
+    def __init__(self, model_name: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.model_name = model_name
+        self.buckets = buckets
+        self.in_flight = 0
+        self.requests: DefaultDict[Tuple[str, int], int] = defaultdict(int)
+        self.errors: DefaultDict[Tuple[str, int], int] = defaultdict(int)
+        self.request_durations: Dict[str, Histogram] = {}
+        self.stage_durations: Dict[str, Histogram] = {}
+        self.collected: Dict[str, Tuple[str, str, Callable[[], float]]] = {}
+        # Stages may be recorded from prediction threads
+        self._lock = threading.Lock()
+
+    def record_request(self, path: str, status_code: int, duration: float):
+        with self._lock:
+            self.requests[(path, status_code)] += 1
+            self._histogram(self.request_durations, path).observe(duration)
+
+    def record_error(self, exception_name: str, status_code: int):
+        with self._lock:
+            self.errors[(exception_name, status_code)] += 1
+
+    def observe_stage(self, stage: str, duration: float):
+        with self._lock:
+            self._histogram(self.stage_durations, stage).observe(duration)
+
+    def collect(
+        self, name: str, metric_type: str, help_text: str, read: Callable[[], float]
+    ):
+        """Report the value returned by read, such as a queue depth, on every scrape"""
+        self.collected[name] = (metric_type, help_text, read)
+
+    def _histogram(self, histograms: Dict[str, Histogram], key: str) -> Histogram:
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram(self.buckets)
+        return histogram
+
+    def samples(self) -> Dict[str, List[str]]:
+        model_label = (("model_name", self.model_name),)
+        samples: DefaultDict[str, List[str]] = defaultdict(list)
+        with self._lock:
+            for (path, status_code), count in sorted(self.requests.items()):
+                labels = model_label + (("path", path), ("status_code", status_code))
+                samples["foxcross_requests_total"].append(
+                    f"foxcross_requests_total{{{_format_labels(labels)}}} {count}"
+                )
+            for (exception_name, status_code), count in sorted(self.errors.items()):
+                labels = model_label + (
+                    ("exception", exception_name),
+                    ("status_code", status_code),
+                )
+                samples["foxcross_request_errors_total"].append(
+                    f"foxcross_request_errors_total{{{_format_labels(labels)}}} {count}"
+                )
+            samples["foxcross_requests_in_flight"].append(
+                f"foxcross_requests_in_flight{{{_format_labels(model_label)}}}"
+                f" {self.in_flight}"
+            )
+            for path, histogram in sorted(self.request_durations.items()):
+                samples["foxcross_request_duration_seconds"].extend(
+                    histogram.samples(
+                        "foxcross_request_duration_seconds",
+                        model_label + (("path", path),),
+                    )
+                )
+            for stage, histogram in sorted(self.stage_durations.items()):
+                samples["foxcross_stage_duration_seconds"].extend(
+                    histogram.samples(
+                        "foxcross_stage_duration_seconds",
+                        model_label + (("stage", stage),),
+                    )
+                )
+            for name, (_, _, read) in self.collected.items():
+                samples[name].append(f"{name}{{{_format_labels(model_label)}}} {read()}")
+        return samples
+
+
+def render_metrics(registries: Iterable[ModelMetrics]) -> str:
+    """Render the metrics of one or more model servings, grouped by metric name"""
+    samples: DefaultDict[str, List[str]] = defaultdict(list)
+    metric_help = dict(_metric_help)
+    for registry in registries:
+        for name, lines in registry.samples().items():
+            samples[name].extend(lines)
+        for name, (metric_type, help_text, _) in registry.collected.items():
+            metric_help.setdefault(name, (metric_type, help_text))
+    output = []
+    for name, (metric_type, help_text) in metric_help.items():
+        if not samples[name]:
+            continue
+        output.append(f"# HELP {name} {help_text}")
+        output.append(f"# TYPE {name} {metric_type}")
+        output.extend(samples[name])
+    return "\n".join(output) + "\n"
+
+
+def metrics_endpoint(
+    registries: Callable[[], Iterable[ModelMetrics]],
+) -> Callable[[Request], PlainTextResponse]:
+    async def _metrics_endpoint(request: Request) -> PlainTextResponse:
+        return PlainTextResponse(
+            render_metrics(registries()), media_type=PROMETHEUS_MEDIA_TYPE
+        )
+
+    return _metrics_endpoint
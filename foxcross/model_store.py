@@ -0,0 +1,146 @@
+import logging
+import os
+import re
+import shutil
+import tempfile
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, Iterator, Optional, Union
+
+try:
+    import numpy
+except ImportError:
+    raise ImportError(
+        "Cannot import numpy. Please install foxcross using foxcross[pandas] or"
+        " foxcross[modin]"
+    )
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+ArrayArtifact = Union[numpy.ndarray, Dict[str, numpy.ndarray]]
+_name_regex = re.compile(r"^[\w.-]+$")
+
+
+def default_model_store_directory() -> Path:
+    return Path(tempfile.gettempdir()) / "foxcross-model-store"
+
+
+def _check_name(name: str):
+    if not _name_regex.match(name) or name.startswith("."):
+        raise ValueError(
+            f"{name!r} is not a valid artifact name. Use letters, digits, _, - and ."
+        )
+
+
+class ModelStore:
+    """
+    Keeps numpy arrays of model artifacts in .npy files under directory and hands them
+    out as read-only memory maps. Every process that attaches to an artifact shares the
+    same pages of the operating system's page cache, so the arrays only take memory
+    once however many workers load the model.
+    """
+
+    def __init__(self, directory: Union[str, Path]):
+        self.directory = Path(directory)
+
+    def get_or_create(
+        self,
+        name: str,
+        create: Callable[[], ArrayArtifact],
+        source: Optional[Union[str, Path]] = None,
+    ) -> ArrayArtifact:
+        """
+        Attach to the artifact stored under name, first storing the array or dict of
+        arrays returned by create if it is missing or older than the source file
+        """
+        _check_name(name)
+        path = self.directory / name
+        if self._is_current(path, source):
+            return self._attach(path)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        # Only one worker creates the artifact while the others wait to attach to it
+        with self._lock(name):
+            if not self._is_current(path, source):
+                self._write(path, create())
+                logger.info(f"Stored model artifact {name} in {self.directory}")
+        return self._attach(path)
+
+    def get(self, name: str) -> ArrayArtifact:
+        _check_name(name)
+        path = self.directory / name
+        if not self._exists(path):
+            raise KeyError(name)
+        return self._attach(path)
+
+    def remove(self, name: str):
+        _check_name(name)
+        for path in (self._array_path(self.directory / name), self.directory / name):
+            if path.is_dir():
+                shutil.rmtree(path)
+            elif path.exists():
+                path.unlink()
+
+    @staticmethod
+    def _array_path(path: Path) -> Path:
+        return path.with_name(f"{path.name}.npy")
+
+    def _exists(self, path: Path) -> bool:
+        return self._array_path(path).exists() or path.is_dir()
+
+    def _is_current(self, path: Path, source: Optional[Union[str, Path]]) -> bool:
+        if not self._exists(path):
+            return False
+        if source is None:
+            return True
+        stored = self._array_path(path) if self._array_path(path).exists() else path
+        return stored.stat().st_mtime >= Path(source).stat().st_mtime
+
+    def _attach(self, path: Path) -> ArrayArtifact:
+        array_path = self._array_path(path)
+        if array_path.exists():
+            return numpy.load(array_path, mmap_mode="r", allow_pickle=False)
+        return {
+            array_path.stem: numpy.load(array_path, mmap_mode="r", allow_pickle=False)
+            for array_path in sorted(path.glob("*.npy"))
+        }
+
+    def _write(self, path: Path, artifact: ArrayArtifact):
+        # Written under a temporary name and renamed, so a process never attaches to a
+        # partly written artifact
+        temporary_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}")
+        if isinstance(artifact, dict):
+            temporary_path.mkdir()
+            for key, array in artifact.items():
+                _check_name(key)
+                numpy.save(
+                    temporary_path / f"{key}.npy",
+                    numpy.asarray(array),
+                    allow_pickle=False,
+                )
+            # A directory can only be renamed over a missing or empty one
+            self.remove(path.name)
+            os.replace(temporary_path, path)
+        else:
+            with temporary_path.open("wb") as f:
+                numpy.save(f, numpy.asarray(artifact), allow_pickle=False)
+            if path.is_dir():
+                shutil.rmtree(path)
+            os.replace(temporary_path, self._array_path(path))
+
+    @contextmanager
+    def _lock(self, name: str) -> Iterator[None]:
+        if fcntl is None:
+            yield
+            return
+        with (self.directory / f".{name}.lock").open("w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
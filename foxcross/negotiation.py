@@ -0,0 +1,66 @@
+import functools
+from typing import Dict, Generic, List, Mapping, Optional, Tuple, TypeVar
+
+Codec = TypeVar("Codec")
+
+
+def parse_q_values(header: str) -> List[Tuple[str, float]]:
+    """
+    Values of an Accept or Accept-Encoding header, lower cased and without their
+    parameters, with their q-values in the order they were sent
+    """
+    values = []
+    for part in header.split(","):
+        value, *params = part.split(";")
+        value = value.strip().lower()
+        if not value:
+            continue
+        q_value = 1.0
+        for param in params:
+            name, _, param_value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q_value = float(param_value)
+                except ValueError:
+                    q_value = 0.0
+        values.append((value, q_value))
+    return values
+
+
+class ContentNegotiator(Generic[Codec]):
+    """
+    Picks the media type, and the codec registered for it, that best fits an Accept or
+    Content-Type header. The header's q-values decide first, then the more specific
+    media range, then the header's order. The order of codecs only decides between
+    media types the header accepts equally, such as for */*. Each distinct header is
+    only parsed once, since clients send the same few headers over and over.
+    """
+
+    def __init__(self, codecs: Mapping[str, Codec], cache_size: int = 128):
+        self.codecs: Dict[str, Codec] = dict(codecs)
+        self.media_types = tuple(self.codecs)
+        self.negotiate = functools.lru_cache(maxsize=cache_size)(self._negotiate)
+
+    def _negotiate(self, header: str) -> Optional[Tuple[str, Codec]]:
+        media_ranges: Dict[str, Tuple[float, int]] = {}
+        for position, (media_range, q_value) in enumerate(parse_q_values(header)):
+            media_ranges.setdefault(media_range, (q_value, position))
+        best_media_type = None
+        best_rank = None
+        for preference, media_type in enumerate(self.media_types):
+            main_type = media_type.partition("/")[0]
+            # The most specific media range that matches sets the q-value
+            for specificity, media_range in enumerate(
+                (media_type, f"{main_type}/*", "*/*")
+            ):
+                if media_range in media_ranges:
+                    q_value, position = media_ranges[media_range]
+                    break
+            else:
+                continue
+            rank = (q_value, -specificity, -position, -preference)
+            if q_value > 0 and (best_rank is None or rank > best_rank):
+                best_media_type, best_rank = media_type, rank
+        if best_media_type is None:
+            return None
+        return best_media_type, self.codecs[best_media_type]
@@ -1,30 +1,230 @@
+import functools
+import importlib.util
+import io
 import logging
-from typing import Any, Dict, Union
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Union
 
 from starlette.exceptions import HTTPException
+from starlette.requests import Request
+from starlette.responses import Response
 
+from .enums import MediaTypes
+from .exceptions import SchemaValidationError, to_http_exception
 from .runner import ModelServingRunner
+from .schema import DataFrameSchema
 from .serving import ModelServing
 
 try:
-    import modin.pandas as pandas
     import numpy
+    import pandas
 except ImportError:
+    raise ImportError(
+        "Cannot import pandas. Please install foxcross using foxcross[pandas] or"
+        " foxcross[modin]"
+    )
+
+# modin is imported with the first DataFrame large enough for it, since importing it
+# takes far longer than importing pandas
+modin_pandas = None
+_modin_installed = importlib.util.find_spec("modin") is not None
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+logger = logging.getLogger(__name__)
+
+_frame_executor_lock = threading.Lock()
+
+
+def _get_modin_pandas() -> Any:
+    global modin_pandas
+    if modin_pandas is None and _modin_installed:
+        import modin.pandas
+
+        modin_pandas = modin.pandas
+    return modin_pandas
+
+
+def _is_dataframe(data: Any) -> bool:
+    if isinstance(data, pandas.DataFrame):
+        return True
+    # A model may return modin DataFrames before foxcross has imported modin
+    modin_module = sys.modules.get("modin.pandas")
+    return modin_module is not None and isinstance(data, modin_module.DataFrame)
+
+
+def _to_pandas(frame: Any) -> Any:
+    # modin DataFrames are converted before they are serialized, since modin runs
+    # to_json, to_dict and pyarrow conversions through pandas anyway
+    to_pandas = getattr(frame, "_to_pandas", None)
+    return to_pandas() if to_pandas is not None else frame
+
+
+def _is_frame_dict(data: Any) -> bool:
+    return isinstance(data, dict) and all(
+        isinstance(key, str) and _is_dataframe(value) for key, value in data.items()
+    )
+
+
+def _read_arrow_stream(body: bytes) -> pandas.DataFrame:
+    # py_buffer wraps the request body without copying it
+    reader = pyarrow.ipc.open_stream(pyarrow.py_buffer(body))
+    return pandas.DataFrame(reader.read_pandas())
+
+
+def _write_arrow_stream(frame: pandas.DataFrame) -> bytes:
+    table = pyarrow.Table.from_pandas(frame)
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def _read_parquet(body: bytes) -> pandas.DataFrame:
+    return pandas.read_parquet(io.BytesIO(body))
+
+
+def _write_parquet(frame: pandas.DataFrame) -> bytes:
+    buffer = io.BytesIO()
+    frame.to_parquet(buffer)
+    return buffer.getvalue()
+
+
+def _read_numpy(body: bytes) -> pandas.DataFrame:
+    array = numpy.load(io.BytesIO(body), allow_pickle=False)
+    return pandas.DataFrame(array, copy=False)
+
+
+def _write_numpy(frame: pandas.DataFrame) -> bytes:
+    buffer = io.BytesIO()
+    # Records keep the column names as the field names of a structured array
+    numpy.save(buffer, frame.to_records(index=False), allow_pickle=False)
+    return buffer.getvalue()
+
+
+# to_dict orients that DataFrame.to_json can produce directly
+_to_json_orients = {
+    "dict": "columns",
+    "index": "index",
+    "records": "records",
+    "split": "split",
+}
+# Most decimal places DataFrame.to_json can write for floats
+_to_json_precision = 15
+
+
+def _floats_survive_to_json(frame: pandas.DataFrame) -> bool:
+    """
+    Check that to_json writes every float in the frame, including float index and
+    column labels, with enough digits to read back exactly the same float. Object
+    values other than strings and None, which could hide floats or nested containers,
+    are not checked and fail.
+    """
+    for values in [frame[column] for column in frame.columns[frame.dtypes == object]] + [
+        frame.index,
+        frame.columns,
+    ]:
+        if values.dtype == object and pandas.api.types.infer_dtype(
+            values, skipna=True
+        ) not in ("string", "empty"):
+            return False
+    float_values = [frame.select_dtypes(include="floating").to_numpy(dtype=float).ravel()]
+    float_values.extend(
+        labels.to_numpy(dtype=float)
+        for labels in (frame.index, frame.columns)
+        if labels.dtype.kind == "f"
+    )
+    values = numpy.concatenate(float_values)
+    values = numpy.abs(values[numpy.isfinite(values) & (values != 0)])
+    # Very small and large floats are written in scientific notation with 15
+    # significant digits, which cannot represent every float
+    if values.size == 0:
+        return True
+    if values.min() < 1e-15 or values.max() >= 1e16:
+        return False
+    # Floats of at least 8 are precise to less than 15 decimal places, so they survive.
+    # Smaller floats survive only if they are the closest float to their value rounded
+    # to 15 decimal places.
+    scale = 10.0**_to_json_precision
+    small_values = values[values < 8]
+    return bool((numpy.round(small_values * scale) / scale == small_values).all())
+
+
+def _dataframe_to_json(
+    frame: pandas.DataFrame, orient: str, lines: bool = False
+) -> Optional[bytes]:
+    """
+    Write the frame straight to JSON bytes, skipping the copy made by replace and the
+    Python objects made by to_dict. Returns None when the output would differ from
+    the to_dict path, so the caller can fall back to it. With lines, the records
+    orient is written as newline delimited JSON.
+    """
+    json_orient = _to_json_orients.get(orient)
+    if json_orient is None:
+        return None
+    for dtype in list(frame.dtypes) + [frame.index.dtype, frame.columns.dtype]:
+        # Extension dtypes such as categoricals are not checked by
+        # _floats_survive_to_json, even when their kind is O, so only strings pass
+        if pandas.api.types.is_string_dtype(dtype):
+            continue
+        if not isinstance(dtype, numpy.dtype) or dtype.kind not in "biufO":
+            return None
+    if not _floats_survive_to_json(frame):
+        return None
     try:
-        import pandas
-        import numpy
-    except ImportError:
-        raise ImportError(
-            "Cannot import pandas. Please install foxcross using foxcross[pandas] or"
-            " foxcross[modin]"
+        output = frame.to_json(
+            orient=json_orient, double_precision=_to_json_precision, lines=lines
         )
+    except (TypeError, ValueError, OverflowError):
+        return None
+    # Older pandas versions leave off the final newline
+    if lines and output and not output.endswith("\n"):
+        output += "\n"
+    return output.encode("utf-8")
 
-logger = logging.getLogger(__name__)
+
+_binary_readers: Dict[MediaTypes, Callable[[bytes], pandas.DataFrame]] = {
+    MediaTypes.NUMPY: _read_numpy
+}
+_binary_writers: Dict[MediaTypes, Callable[[pandas.DataFrame], bytes]] = {
+    MediaTypes.NUMPY: _write_numpy
+}
+if pyarrow is not None:
+    _binary_readers[MediaTypes.ARROW_STREAM] = _read_arrow_stream
+    _binary_readers[MediaTypes.PARQUET] = _read_parquet
+    _binary_writers[MediaTypes.ARROW_STREAM] = _write_arrow_stream
+    _binary_writers[MediaTypes.PARQUET] = _write_parquet
 
 
 class DataFrameModelServing(ModelServing):
     # TODO: probably should limit to orient choices
     pandas_orient = "index"
+    # With modin installed, only DataFrames of at least this many rows are partitioned
+    # with modin. None always uses pandas.
+    modin_min_rows = 100000
+    # A DataFrameSchema, or a dict of them by key for multi_dataframe inputs, that
+    # input DataFrames are checked against and cast to before pre_process_input
+    input_schema = None
+    infer_input_schema = False
+    # Threads that read and write the DataFrames of multi_dataframe inputs and outputs
+    # in parallel. None reads and writes them one after another.
+    multi_dataframe_threads = None
+    # A column holding the key of each row's DataFrame, so multi_dataframe inputs and
+    # outputs can be sent as one concatenated binary DataFrame
+    multi_dataframe_key_column = None
+    _input_schema = None
+    _frame_executor = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._input_schema = self._load_input_schema()
+        self.add_event_handler("shutdown", self._shutdown_frame_executor)
 
     def predict(
         self, data: Union[pandas.DataFrame, Dict[str, pandas.DataFrame]]
@@ -49,16 +249,43 @@ class DataFrameModelServing(ModelServing):
         """Hook to enable post-processing of output data"""
         return super().post_process_results(data)
 
+    def _load_input_schema(
+        self,
+    ) -> Union[DataFrameSchema, Dict[str, DataFrameSchema], None]:
+        if self.input_schema is not None or not self.infer_input_schema:
+            return self.input_schema
+        with open(self.test_data_path, "rb") as f:
+            test_data = self._format_input(self._json_codec.loads(f.read()))
+        if isinstance(test_data, dict):
+            schema = {
+                key: DataFrameSchema.infer(_to_pandas(frame))
+                for key, frame in test_data.items()
+            }
+        else:
+            schema = DataFrameSchema.infer(_to_pandas(test_data))
+        logger.info(f"Inferred input schema {schema} from {self.test_data_path}")
+        return schema
+
     def _format_input(
         self, data: Dict
     ) -> Union[pandas.DataFrame, Dict[str, pandas.DataFrame]]:
         try:
-            if data.pop("multi_dataframe", None) is True:
+            # Avoid mutating data since the test data is cached between requests
+            if data.get("multi_dataframe") is True:
                 logger.debug("Formatting pandas multi_dataframe input")
-                return {key: pandas.DataFrame(value) for key, value in data.items()}
+                frames = self._map_frames(
+                    lambda key, value: self._format_frame(pandas.DataFrame(value), key),
+                    {
+                        key: value
+                        for key, value in data.items()
+                        if key != "multi_dataframe"
+                    },
+                )
+                self._check_frame_keys(frames)
+                return frames
             else:
-                return pandas.DataFrame(data)
-        except (TypeError, KeyError) as exc:
+                return self._format_frame(pandas.DataFrame(data))
+        except (TypeError, KeyError, AttributeError) as exc:
             err_msg = f"Error reading in json: {exc}"
             logger.warning(err_msg)
             raise HTTPException(status_code=400, detail=err_msg)
@@ -68,15 +295,19 @@ class DataFrameModelServing(ModelServing):
     ) -> Any:
         # Convert NaNs to Nones to handle ujson OverflowError
         try:
-            output = results.replace({numpy.nan: None}).to_dict(orient=self.pandas_orient)
+            output = (
+                _to_pandas(results)
+                .replace({numpy.nan: None})
+                .to_dict(orient=self.pandas_orient)
+            )
         except AttributeError:
             try:
-                output = {
-                    key: value.replace({numpy.nan: None}).to_dict(
-                        orient=self.pandas_orient
-                    )
-                    for key, value in results.items()
-                }
+                output = self._map_frames(
+                    lambda key, value: _to_pandas(value)
+                    .replace({numpy.nan: None})
+                    .to_dict(orient=self.pandas_orient),
+                    results,
+                )
                 output["multi_dataframe"] = True
                 logger.debug("Formatted multi_dataframe output")
             except (TypeError, AttributeError):
@@ -85,6 +316,254 @@ class DataFrameModelServing(ModelServing):
                 raise HTTPException(status_code=500, detail=err_msg)
         return output
 
+    def _input_decoders(self) -> Dict[str, Callable[[Request], Awaitable[Any]]]:
+        decoders = super()._input_decoders()
+        for media_type in _binary_readers:
+            decoders[media_type.value] = functools.partial(
+                self._read_binary_input, media_type
+            )
+        return decoders
+
+    def _output_encoders(self) -> Dict[str, Callable[[Any], Response]]:
+        encoders = super()._output_encoders()
+        for media_type in _binary_writers:
+            encoders[media_type.value] = functools.partial(
+                self._encode_binary_output, media_type
+            )
+        return encoders
+
+    async def _read_binary_input(
+        self, media_type: MediaTypes, request: Request
+    ) -> pandas.DataFrame:
+        body = await request.body()
+        logger.debug(f"Received {media_type.value} POST data for prediction")
+        try:
+            frame = _binary_readers[media_type](body)
+        except Exception as exc:
+            err_msg = f"Error reading in {media_type.value}: {exc}"
+            logger.warning(err_msg)
+            raise HTTPException(status_code=400, detail=err_msg)
+        key_column = self.multi_dataframe_key_column
+        if key_column is not None and key_column in frame.columns:
+            return self._split_frames(frame)
+        return self._format_frame(frame)
+
+    def _encode_json_output(
+        self, results: Union[pandas.DataFrame, Dict[str, pandas.DataFrame]]
+    ) -> Response:
+        body = self._serialize_json_output(results)
+        if body is None:
+            return super()._encode_json_output(results)
+        return Response(body, media_type=MediaTypes.JSON.value)
+
+    def _encode_binary_output(
+        self,
+        media_type: MediaTypes,
+        results: Union[pandas.DataFrame, Dict[str, pandas.DataFrame]],
+    ) -> Response:
+        if not _is_dataframe(results):
+            if self.multi_dataframe_key_column is None or not _is_frame_dict(results):
+                err_msg = (
+                    f"Only a single DataFrame can be returned as {media_type.value}"
+                    " without a multi_dataframe_key_column"
+                )
+                logger.warning(err_msg)
+                raise HTTPException(status_code=406, detail=err_msg)
+            results = self._concat_frames(results)
+        try:
+            body = _binary_writers[media_type](_to_pandas(results))
+        except Exception:
+            err_msg = f"Error trying to serialize response data to {media_type.value}"
+            logger.exception(err_msg)
+            raise HTTPException(status_code=500, detail=err_msg)
+        return Response(body, media_type=media_type.value)
+
+    def _serialize_json_output(
+        self, results: Union[pandas.DataFrame, Dict[str, pandas.DataFrame]]
+    ) -> Optional[bytes]:
+        if _is_dataframe(results):
+            return _dataframe_to_json(_to_pandas(results), self.pandas_orient)
+        if not _is_frame_dict(results):
+            return None
+        bodies = self._map_frames(
+            lambda key, value: _dataframe_to_json(_to_pandas(value), self.pandas_orient),
+            results,
+        )
+        parts = []
+        for key, body in bodies.items():
+            if body is None:
+                return None
+            parts.append(self._json_codec.dumps(key) + b":" + body)
+        parts.append(b'"multi_dataframe":true')
+        logger.debug("Serialized multi_dataframe output")
+        return b"{" + b",".join(parts) + b"}"
+
+    def _format_stream_chunk(self, records: List[Any]) -> pandas.DataFrame:
+        try:
+            frame = pandas.DataFrame(records)
+        except (TypeError, ValueError) as exc:
+            err_msg = f"Error reading in NDJSON: {exc}"
+            logger.warning(err_msg)
+            raise HTTPException(status_code=400, detail=err_msg)
+        return self._format_frame(frame)
+
+    def _format_frame_chunk(self, frame: pandas.DataFrame) -> pandas.DataFrame:
+        return self._format_frame(frame)
+
+    def _serialize_stream_chunk(self, results: pandas.DataFrame) -> bytes:
+        if not _is_dataframe(results):
+            err_msg = "Stream predictions must return a single DataFrame"
+            logger.error(err_msg)
+            raise HTTPException(status_code=500, detail=err_msg)
+        results = _to_pandas(results)
+        body = _dataframe_to_json(results, "records", lines=True)
+        if body is None:
+            return super()._serialize_stream_chunk(
+                results.replace({numpy.nan: None}).to_dict(orient="records")
+            )
+        return body
+
+    def _format_frame(
+        self, frame: pandas.DataFrame, key: Optional[str] = None
+    ) -> pandas.DataFrame:
+        """Check an input frame against the input schema and pick its library"""
+        schema = self._input_schema
+        if isinstance(schema, dict):
+            schema = schema.get(key)
+            if schema is None:
+                err_msg = (
+                    "Expected a multi_dataframe input"
+                    if key is None
+                    else f"Unexpected DataFrame {key}"
+                )
+                logger.warning(err_msg)
+                raise HTTPException(status_code=400, detail=err_msg)
+        if schema is not None:
+            try:
+                frame = schema.coerce(frame)
+            except SchemaValidationError as exc:
+                err_msg = str(exc) if key is None else f"DataFrame {key}: {exc}"
+                logger.warning(err_msg)
+                raise to_http_exception(exc, err_msg)
+        return self._select_dataframe_library(frame)
+
+    def _map_frames(
+        self, function: Callable[[str, Any], Any], items: Dict[str, Any]
+    ) -> Dict[str, Any]:
+        """
+        Call function with the key and value of each item, in parallel on
+        multi_dataframe_threads threads. Building DataFrames and writing them out
+        spends much of its time in numpy and pandas code that releases the GIL.
+        """
+        if not self.multi_dataframe_threads or len(items) < 2:
+            return {key: function(key, value) for key, value in items.items()}
+        executor = self._get_frame_executor()
+        futures = {
+            key: executor.submit(function, key, value) for key, value in items.items()
+        }
+        return {key: future.result() for key, future in futures.items()}
+
+    def _get_frame_executor(self) -> ThreadPoolExecutor:
+        with _frame_executor_lock:
+            if self._frame_executor is None:
+                logger.debug(
+                    "Creating multi_dataframe thread pool with"
+                    f" max_workers={self.multi_dataframe_threads}"
+                )
+                self._frame_executor = ThreadPoolExecutor(
+                    max_workers=self.multi_dataframe_threads,
+                    thread_name_prefix="foxcross-frames",
+                )
+            return self._frame_executor
+
+    def _shutdown_frame_executor(self):
+        if self._frame_executor is not None:
+            self._frame_executor.shutdown(wait=True)
+            self._frame_executor = None
+            logger.debug("multi_dataframe thread pool shut down")
+
+    def _split_frames(self, frame: pandas.DataFrame) -> Dict[str, pandas.DataFrame]:
+        """Split a frame into a DataFrame per value of multi_dataframe_key_column"""
+        key_column = self.multi_dataframe_key_column
+        logger.debug(f"Splitting binary input into DataFrames by {key_column}")
+        groups = {
+            str(key): group.drop(columns=key_column)
+            for key, group in frame.groupby(key_column, sort=False)
+        }
+        frames = self._map_frames(
+            lambda key, group: self._format_frame(group, key), groups
+        )
+        self._check_frame_keys(frames)
+        return frames
+
+    def _concat_frames(self, frames: Dict[str, pandas.DataFrame]) -> pandas.DataFrame:
+        """
+        Concatenate DataFrames into one, keeping their indexes and adding their keys in
+        multi_dataframe_key_column as the first column
+        """
+        try:
+            return pandas.concat(
+                {key: _to_pandas(frame) for key, frame in frames.items()},
+                names=[self.multi_dataframe_key_column],
+            ).reset_index(level=0)
+        except ValueError:
+            err_msg = "Failed to concatenate the multi_dataframe results"
+            logger.exception(err_msg)
+            raise HTTPException(status_code=500, detail=err_msg)
+
+    def _check_frame_keys(self, frames: Dict[str, pandas.DataFrame]):
+        if not isinstance(self._input_schema, dict):
+            return
+        missing = [key for key in self._input_schema if key not in frames]
+        if missing:
+            err_msg = f"Missing DataFrames: {', '.join(missing)}"
+            logger.warning(err_msg)
+            raise HTTPException(status_code=400, detail=err_msg)
+
+    def _select_dataframe_library(self, frame: pandas.DataFrame) -> pandas.DataFrame:
+        """
+        Hand large frames to predict as modin DataFrames and small ones as pandas
+        DataFrames, since partitioning a frame across modin's engine costs more than
+        predicting a few rows with pandas
+        """
+        if self.modin_min_rows is None or len(frame) < self.modin_min_rows:
+            return _to_pandas(frame)
+        modin_module = _get_modin_pandas()
+        if modin_module is None:
+            return _to_pandas(frame)
+        if isinstance(frame, modin_module.DataFrame):
+            return frame
+        return modin_module.DataFrame(frame)
+
+    def _is_batchable(self, data: Any) -> bool:
+        return _is_dataframe(data)
+
+    def _batch_key(self, data: pandas.DataFrame) -> Hashable:
+        # Concatenating frames with different columns or dtypes would change the
+        # schema every request in the batch sees
+        return tuple(data.columns), tuple(str(dtype) for dtype in data.dtypes)
+
+    def _concat_batch(self, batch: List[pandas.DataFrame]) -> pandas.DataFrame:
+        # The batched requests are each small enough for pandas, but their concatenation
+        # may be large enough for modin
+        return self._select_dataframe_library(
+            pandas.concat([_to_pandas(data) for data in batch], ignore_index=True)
+        )
+
+    def _split_batch(
+        self, results: pandas.DataFrame, batch: List[pandas.DataFrame]
+    ) -> List[pandas.DataFrame]:
+        self._check_batch_results(len(results), batch)
+        split_results = []
+        start = 0
+        for data in batch:
+            # Restore each request's original index after the ignore_index concat
+            split_results.append(
+                results.iloc[start : start + len(data)].set_axis(data.index, axis=0)
+            )
+            start += len(data)
+        return split_results
+
 
 _model_serving_runner = ModelServingRunner(
     ModelServing, (ModelServing, DataFrameModelServing)
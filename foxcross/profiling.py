@@ -0,0 +1,117 @@
+import cProfile
+import io
+import itertools
+import logging
+import pstats
+import random
+import threading
+import time
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Mapping, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+
+class PredictionProfiler:
+    """
+    Runs cProfile around the predictions of selected requests: a sample_rate fraction of
+    them, and those sent with the header, if one is given. The profiles are added up for
+    the profile endpoint and, with a directory, each one is also dumped to a pstats file.
+    Only one prediction is profiled at a time, since a thread can only run one profiler
+    and Python 3.12 allows only one at a time per process.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        sample_rate: Optional[float] = None,
+        header: Optional[str] = None,
+        directory: Optional[Union[str, Path]] = None,
+    ):
+        self.name = name
+        self.sample_rate = sample_rate or 0.0
+        self.header = header.lower() if header else None
+        self.directory = Path(directory) if directory is not None else None
+        self.profiled = 0
+        self.skipped = 0
+        self._stats: Optional[pstats.Stats] = None
+        self._counter = itertools.count(1)
+        self._running = threading.Lock()
+        self._stats_lock = threading.Lock()
+
+    def should_profile(self, headers: Mapping[str, str]) -> bool:
+        if self.header is not None and self.header in headers:
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def profile(self, function: Callable[[Any], Any], data: Any) -> Any:
+        profile = self._start()
+        if profile is None:
+            return function(data)
+        try:
+            return function(data)
+        finally:
+            self._stop(profile)
+
+    async def profile_async(self, awaitable: Awaitable) -> Any:
+        """
+        Profile an async prediction. Other tasks that run on the event loop while it
+        awaits are included in the profile.
+        """
+        profile = self._start()
+        if profile is None:
+            return await awaitable
+        try:
+            return await awaitable
+        finally:
+            self._stop(profile)
+
+    def _start(self) -> Optional[cProfile.Profile]:
+        if not self._running.acquire(blocking=False):
+            self.skipped += 1
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler, such as a coverage tool, is already running
+            self._running.release()
+            self.skipped += 1
+            return None
+        return profile
+
+    def _stop(self, profile: cProfile.Profile):
+        profile.disable()
+        self._running.release()
+        self._add(profile)
+
+    def _add(self, profile: cProfile.Profile):
+        with self._stats_lock:
+            if self._stats is None:
+                self._stats = pstats.Stats(profile)
+            else:
+                self._stats.add(profile)
+            self.profiled += 1
+        if self.directory is not None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            path = self.directory / (
+                f"{self.name}-{int(time.time() * 1000)}-{next(self._counter)}.prof"
+            )
+            profile.dump_stats(str(path))
+            logger.debug(f"Dumped prediction profile to {path}")
+
+    def report(self, sort: str = "cumulative", limit: int = 50) -> str:
+        """Text report of the profiles added up since the last reset"""
+        with self._stats_lock:
+            if self._stats is None:
+                return "No predictions have been profiled yet\n"
+            stream = io.StringIO()
+            self._stats.stream = stream
+            self._stats.sort_stats(sort).print_stats(limit)
+        return f"{self.profiled} profiled predictions\n{stream.getvalue()}"
+
+    def reset(self):
+        with self._stats_lock:
+            self._stats = None
+            self.profiled = 0
+            self.skipped = 0
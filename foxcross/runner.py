@@ -1,18 +1,23 @@
+import atexit
 import importlib
 import inspect
 import logging
+import os
 import re
 import sys
-from typing import Any, Tuple
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List, Tuple, Union
 
-import uvicorn
 from slugify import slugify
 from starlette.applications import Starlette
 from starlette.types import ASGIApp
 
 from .constants import SLUGIFY_REGEX, SLUGIFY_REPLACE
 from .endpoints import _index_endpoint
+from .enums import LoadModes
 from .exceptions import NoModelServingFoundError
+from .metrics import metrics_endpoint
 
 logger = logging.getLogger(__name__)
 
@@ -22,7 +27,100 @@ class ModelServingRunner:
         self._excluded_classes = excluded_classes
         self._base_class = base_class
 
-    def compose(self, module_name: str = "models", **kwargs) -> ASGIApp:
+    def compose(
+        self,
+        module_name: str = "models",
+        load_mode: Union[LoadModes, str] = LoadModes.EAGER,
+        warmup: bool = False,
+        isolate_models: bool = False,
+        **kwargs,
+    ) -> ASGIApp:
+        load_mode = LoadModes(load_mode)
+        lazy_load = load_mode != LoadModes.EAGER
+        started_at = time.perf_counter()
+        serving_models = self.find_model_servings(module_name)
+        import_time = time.perf_counter() - started_at
+        if len(serving_models) == 1:
+            model_serving = serving_models[0](
+                lazy_load=lazy_load, warmup=warmup, **kwargs
+            )
+            mounted_apps = [model_serving]
+            logger.debug(f"Initialized single model serving for {serving_models[0]}")
+        else:
+            model_serving = Starlette(**kwargs)
+            mounted_apps = []
+            for asgi_app in serving_models:
+                slugified_app_name = slugify(
+                    re.sub(SLUGIFY_REGEX, SLUGIFY_REPLACE, asgi_app.__name__)
+                )
+                workers = asgi_app.isolated_workers or (1 if isolate_models else None)
+                if workers:
+                    self._mount_isolated(
+                        model_serving,
+                        asgi_app,
+                        f"/{slugified_app_name}",
+                        workers,
+                        # Isolated processes only serve their own model, so they load
+                        # it eagerly unless loading is deferred to the first request
+                        lazy_load=load_mode == LoadModes.LAZY,
+                        warmup=warmup,
+                        **kwargs,
+                    )
+                    continue
+                mounted_app = asgi_app(lazy_load=lazy_load, warmup=warmup, **kwargs)
+                model_serving.mount(f"/{slugified_app_name}", mounted_app)
+                # Starlette does not send lifespan events to mounted apps
+                model_serving.add_event_handler("startup", mounted_app.router.startup)
+                model_serving.add_event_handler("shutdown", mounted_app.router.shutdown)
+                mounted_apps.append(mounted_app)
+            if not all(class_.api_only for class_ in serving_models):
+                model_serving.add_route("/", _index_endpoint, methods=["GET"])
+            model_serving.add_route(
+                "/metrics/",
+                metrics_endpoint(lambda: [app.metrics for app in mounted_apps]),
+                methods=["GET"],
+            )
+            logger.debug(f"Initialized multiple model serving for {serving_models}")
+        if load_mode == LoadModes.PARALLEL:
+            self._load_in_parallel(mounted_apps)
+        self._log_startup_timings(module_name, import_time, mounted_apps)
+        return model_serving
+
+    @staticmethod
+    def _mount_isolated(
+        app: Starlette, model_serving_class: Any, path: str, workers: int, **kwargs
+    ):
+        # Imported here, since only isolated models need the proxy
+        from .isolation import IsolatedModelProcess, IsolatedModelProxy
+
+        process = IsolatedModelProcess(
+            model_serving_class, workers, root_path=path, **kwargs
+        )
+        process.start()
+        app.mount(path, IsolatedModelProxy(process))
+        app.add_event_handler("shutdown", process.stop)
+        # A supervisor of forked workers exits without the app's shutdown event
+        atexit.register(process.stop)
+
+    @staticmethod
+    def _log_startup_timings(
+        module_name: str, import_time: float, model_servings: List[Any]
+    ):
+        # Imports include the model module's own, such as the DataFrame and ML libraries
+        logger.info(f"Imported {module_name} in {import_time:.3f}s")
+        for model_serving in model_servings:
+            load_time = (
+                "deferred"
+                if model_serving.load_time is None
+                else f"{model_serving.load_time:.3f}s"
+            )
+            logger.info(
+                f"Started {model_serving.__class__.__name__}: load_model {load_time},"
+                f" route setup {model_serving.setup_time:.3f}s"
+            )
+
+    def find_model_servings(self, module_name: str = "models") -> List[Any]:
+        """Import the module and return the model serving classes found in it"""
         try:
             python_module = importlib.import_module(module_name)
             logger.debug(f"Found python module {python_module} for model serving")
@@ -41,21 +139,43 @@ class ModelServingRunner:
             err_msg = f"Could not find any model serving in {python_module}"
             logger.error(err_msg)
             raise NoModelServingFoundError(err_msg)
-        elif len(serving_models) == 1:
-            model_serving = serving_models[0](**kwargs)
-            logger.debug(f"Initialized single model serving for {serving_models[0]}")
-        else:
-            model_serving = Starlette(**kwargs)
-            for asgi_app in serving_models:
-                slugified_app_name = slugify(
-                    re.sub(SLUGIFY_REGEX, SLUGIFY_REPLACE, asgi_app.__name__)
-                )
-                model_serving.mount(f"/{slugified_app_name}", asgi_app(**kwargs))
-            model_serving.add_route("/", _index_endpoint, methods=["GET"])
-            logger.debug(f"Initialized multiple model serving for {serving_models}")
-        return model_serving
+        return serving_models
+
+    @staticmethod
+    def _load_in_parallel(model_servings: List[Any]):
+        # Threads rather than processes, since the models must end up in this process.
+        # Loading usually releases the GIL while reading files and in native code.
+        start = time.perf_counter()
+        with ThreadPoolExecutor(
+            max_workers=len(model_servings), thread_name_prefix="foxcross-load"
+        ) as executor:
+            for future in [
+                executor.submit(model_serving._load_model)
+                for model_serving in model_servings
+            ]:
+                future.result()
+        logger.info(
+            f"Loaded {len(model_servings)} models in parallel in"
+            f" {time.perf_counter() - start:.3f}s"
+        )
+
+    def run_model_serving(self, module_name: str = "models", workers: int = 1, **kwargs):
+        # Imported here, since compose_models alone does not need a server
+        import uvicorn
 
-    def run_model_serving(self, module_name: str = "models", **kwargs):
         debug = kwargs.get("debug", False)
+        start = time.perf_counter()
         asgi_app = self.compose(module_name, **kwargs)
-        uvicorn.run(asgi_app, debug=debug)
+        logger.info(f"Composed model serving in {time.perf_counter() - start:.3f}s")
+        if workers > 1 and not hasattr(os, "fork"):
+            logger.warning("Multiple workers require os.fork, running a single worker")
+            workers = 1
+        if workers > 1:
+            from .workers import WorkerSupervisor
+
+            supervisor = WorkerSupervisor(uvicorn.Config(asgi_app, debug=debug), workers)
+            exit_code = supervisor.run()
+            if exit_code:
+                sys.exit(exit_code)
+        else:
+            uvicorn.run(asgi_app, debug=debug)
@@ -0,0 +1,135 @@
+from typing import Any, Dict, List, Mapping, NamedTuple, Union
+
+from .exceptions import SchemaValidationError
+
+try:
+    import pandas
+except ImportError:
+    raise ImportError(
+        "Cannot import pandas. Please install foxcross using foxcross[pandas] or"
+        " foxcross[modin]"
+    )
+
+
+class ColumnSchema(NamedTuple):
+    dtype: Any
+    nullable: bool = True
+
+
+def _first_value(series: pandas.Series, mask: pandas.Series) -> Any:
+    return series[mask].iloc[0]
+
+
+def _coerce_numeric(
+    name: str, series: pandas.Series, dtype: Any, nullable: bool
+) -> pandas.Series:
+    converted = pandas.to_numeric(series, errors="coerce")
+    invalid = converted.isna() & series.notna()
+    if invalid.any():
+        raise SchemaValidationError(
+            f"Column {name} must be numeric but has {_first_value(series, invalid)!r}"
+        )
+    if dtype.kind in "iu":
+        if nullable and converted.isna().any():
+            # Integer dtypes cannot hold NaN, so nullable integers are read as floats
+            # like pandas itself does
+            return converted.astype("float64")
+        fractional = converted % 1 != 0
+        if fractional.any():
+            raise SchemaValidationError(
+                f"Column {name} must be integers but has"
+                f" {_first_value(series, fractional)!r}"
+            )
+    return converted.astype(dtype)
+
+
+def _coerce_column(name: str, series: pandas.Series, column: ColumnSchema) -> Any:
+    dtype = column.dtype
+    if series.dtype == dtype:
+        return series
+    if dtype.kind in "iuf":
+        return _coerce_numeric(name, series, dtype, column.nullable)
+    if dtype.kind == "M":
+        converted = pandas.to_datetime(series, errors="coerce")
+        invalid = converted.isna() & series.notna()
+        if invalid.any():
+            raise SchemaValidationError(
+                f"Column {name} must be datetimes but has"
+                f" {_first_value(series, invalid)!r}"
+            )
+        return converted.astype(dtype)
+    if dtype.kind == "b":
+        # astype(bool) would turn any non-empty string into True
+        inferred_type = pandas.api.types.infer_dtype(series, skipna=True)
+        if inferred_type not in ("boolean", "empty"):
+            raise SchemaValidationError(f"Column {name} must be booleans")
+    try:
+        return series.astype(dtype)
+    except (TypeError, ValueError) as exc:
+        raise SchemaValidationError(f"Column {name} cannot be read as {dtype}: {exc}")
+
+
+class DataFrameSchema:
+    """
+    Column names, dtypes and nullability that input DataFrames are checked against and
+    cast to, one whole column at a time. Extra columns are kept unless strict is set.
+    """
+
+    def __init__(
+        self, columns: Mapping[str, Union[ColumnSchema, str, Any]], strict: bool = False
+    ):
+        self.columns: Dict[str, ColumnSchema] = {}
+        for name, column in columns.items():
+            if not isinstance(column, ColumnSchema):
+                column = ColumnSchema(column)
+            # Resolved once, so a bad dtype fails at startup rather than per request
+            self.columns[name] = column._replace(
+                dtype=pandas.api.types.pandas_dtype(column.dtype)
+            )
+        self.strict = strict
+
+    @classmethod
+    def infer(cls, frame: pandas.DataFrame, strict: bool = False) -> "DataFrameSchema":
+        """Infer the schema of frame, with nulls only allowed where frame has some"""
+        return cls(
+            {
+                name: ColumnSchema(frame[name].dtype, bool(frame[name].isna().any()))
+                for name in frame.columns
+            },
+            strict=strict,
+        )
+
+    def __repr__(self) -> str:
+        return f"DataFrameSchema({self.columns!r}, strict={self.strict})"
+
+    def coerce(self, frame: pandas.DataFrame) -> pandas.DataFrame:
+        """
+        Check frame against the schema and cast its columns to the schema's dtypes.
+        Raises SchemaValidationError when frame does not fit.
+        """
+        missing = [name for name in self.columns if name not in frame.columns]
+        if missing:
+            raise SchemaValidationError(f"Missing columns: {_join(missing)}")
+        if self.strict:
+            extra = [name for name in frame.columns if name not in self.columns]
+            if extra:
+                raise SchemaValidationError(f"Unexpected columns: {_join(extra)}")
+        coerced_columns = {}
+        for name, column in self.columns.items():
+            series = frame[name]
+            if not column.nullable and series.isna().any():
+                raise SchemaValidationError(f"Column {name} must not have null values")
+            coerced = _coerce_column(name, series, column)
+            if coerced is not series:
+                coerced_columns[name] = coerced
+        if not coerced_columns:
+            return frame
+        # A shallow copy, so the caller's frame keeps its columns
+        frame = frame.copy(deep=False)
+        for name, coerced in coerced_columns.items():
+            frame[name] = coerced
+        return frame
+
+
+def _join(names: List[Any]) -> str:
+    return ", ".join(str(name) for name in names)
@@ -1,46 +1,134 @@
+import asyncio
+import copy
+import inspect
+import itertools
 import logging
+import os
 import re
+import time
 from pathlib import Path
-from typing import Any, Dict, Iterable, Union
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Hashable,
+    Iterable,
+    List,
+    Tuple,
+    Union,
+)
 
 import aiofiles
 from starlette.applications import Starlette
 from starlette.exceptions import HTTPException
-from starlette.middleware.gzip import GZipMiddleware
 from starlette.middleware.httpsredirect import HTTPSRedirectMiddleware
 from starlette.requests import Request
-from starlette.templating import Jinja2Templates
+from starlette.responses import PlainTextResponse, Response, StreamingResponse
+from starlette.types import Receive, Scope, Send
 
+from .admission import AdmissionController, ServiceUnavailableException
+from .batching import PredictionBatcher
+from .caching import ResultCache
+from .coalescing import RequestCoalescer
+from .compression import CompressionMiddleware
 from .constants import SLUGIFY_REGEX, SLUGIFY_REPLACE
 from .endpoints import _index_endpoint
-from .enums import MediaTypes
+from .enums import ExecutionModes, JSONCodecs, MediaTypes
 from .exceptions import (
     PostProcessingError,
     PredictionError,
     PreProcessingError,
     TestDataPathUndefinedError,
+    exception_name,
+    to_http_exception,
 )
+from .executors import create_executor, run_in_executor
+from .json_codecs import get_json_codec
+from .metrics import ModelMetrics, metrics_endpoint
+from .negotiation import ContentNegotiator
+from .profiling import PredictionProfiler
 from .runner import ModelServingRunner
-from .templates import templates
+from .templates import get_templates
 
-try:
-    import ujson as json
-    from starlette.responses import UJSONResponse as JSONResponse
-except ImportError:
-    import json
-    from starlette.responses import JSONResponse
+if TYPE_CHECKING:
+    from .model_store import ModelStore
 
 logger = logging.getLogger(__name__)
 
+# Endpoints that only respond with one media type share these negotiators
+_html_negotiator = ContentNegotiator({MediaTypes.HTML.value: None})
+_json_negotiator = ContentNegotiator({MediaTypes.JSON.value: None})
+_ndjson_negotiator = ContentNegotiator({MediaTypes.NDJSON.value: None})
+
+
+def _stat_files(paths: Iterable[str]) -> List[Union[tuple, None]]:
+    stats = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            stats.append((stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            stats.append(None)
+    return stats
+
 
 class ModelServing(Starlette):
     test_data_path = None
     model_name = None
+    execution_mode = ExecutionModes.INLINE
+    json_codec = JSONCodecs.AUTO
+    max_workers = None
+    batch_max_size = None
+    batch_max_wait_ms = 5
+    batch_max_queue_size = 1024
+    predict_test_cache_ttl = None
+    stream_chunk_size = 1000
+    deterministic = True
+    result_cache_size = None
+    result_cache_max_bytes = None
+    result_cache_ttl = None
+    coalesce_requests = False
+    max_in_flight = None
+    max_queue_length = 100
+    retry_after_seconds = 1
+    endpoint_priorities = {
+        "/predict/": 0,
+        "/predict-stream/": 0,
+        "/predict-test/": 1,
+        "/input-format/": 1,
+    }
+    compression_minimum_size = 500
+    compression_levels = None
+    compression_encodings = None
+    compression_cache_size = 32
+    max_decompressed_request_bytes = None
+    model_store_path = None
+    reload_endpoint = False
+    reload_watch_paths = ()
+    reload_poll_seconds = 5
+    reload_validate = True
+    profile_sample_rate = None
+    profile_header = None
+    profile_directory = None
+    metrics = None
+    api_only = False
+    # Worker processes to serve the model from when composed with other models. None
+    # serves it from the composing process unless compose isolates every model.
+    isolated_workers = None
     _download_format_options = (MediaTypes.JSON,)
 
     def __init__(
-        self, redirect_https: bool = False, gzip_response: bool = True, **kwargs
+        self,
+        redirect_https: bool = False,
+        gzip_response: bool = True,
+        lazy_load: bool = False,
+        warmup: bool = False,
+        **kwargs,
     ):
+        started_at = time.perf_counter()
         try:
             test_data = Path(self.test_data_path)
         except TypeError:
@@ -50,35 +138,462 @@ class ModelServing(Starlette):
             )
         assert test_data.exists(), f"{self.test_data_path} does not exist"
         super().__init__(**kwargs)
-        self.load_model()
-        logger.debug("load_model completed")
-        self.add_route("/", _index_endpoint, methods=["GET"])
-        self.add_route("/predict/", self._predict_endpoint, methods=["GET", "POST"])
+        self._execution_mode = ExecutionModes(self.execution_mode)
+        self._json_codec = get_json_codec(JSONCodecs(self.json_codec))
+        self._executor = None
+        self._async_predict = inspect.iscoroutinefunction(self.predict)
+        self._input_negotiator = ContentNegotiator(self._input_decoders())
+        self._output_negotiator = ContentNegotiator(self._output_encoders())
+        self._test_data_cache = None
+        self._predict_test_cache = None
+        self._init_request_handling()
+        self.load_time = None
+        self._warmup = warmup
+        self._load_future = None
+        self._init_reloading()
+        if not lazy_load:
+            self._load_model()
+        # GET requests only render the HTML pages
+        methods = ["POST"] if self.api_only else ["GET", "POST"]
+        if not self.api_only:
+            self.add_route("/", _index_endpoint, methods=["GET"])
+        self.add_route("/predict/", self._predict_endpoint, methods=methods)
+        self.add_route("/predict-stream/", self._predict_stream_endpoint, methods=methods)
+        self.add_route("/predict-test/", self._predict_test_endpoint, methods=methods)
+        self.add_route("/input-format/", self._input_format_endpoint, methods=methods)
         self.add_route(
-            "/predict-test/", self._predict_test_endpoint, methods=["GET", "POST"]
+            "/metrics/", metrics_endpoint(lambda: (self.metrics,)), methods=["GET"]
         )
-        self.add_route(
-            "/input-format/", self._input_format_endpoint, methods=["GET", "POST"]
+        if HTTPException not in self.exception_handlers:
+            self.add_exception_handler(HTTPException, self._http_exception_handler)
+        self.compression_cache = ResultCache(self.compression_cache_size)
+        self.add_middleware(
+            CompressionMiddleware,
+            minimum_size=self.compression_minimum_size,
+            levels=self.compression_levels,
+            # Compressed request bodies are still accepted without response compression
+            encodings=self.compression_encodings if gzip_response is True else (),
+            cached_paths=("/input-format/", "/predict-test/"),
+            cache=self.compression_cache,
+            max_decompressed_size=self.max_decompressed_request_bytes,
         )
-        if gzip_response is True:
-            self.add_middleware(GZipMiddleware)
-            logger.debug("GZIPMiddleware added")
+        logger.debug("CompressionMiddleware added")
         if redirect_https is True:
             self.add_middleware(HTTPSRedirectMiddleware)
             logger.debug("HTTPSRedirectMiddleware added")
+        self.add_event_handler("shutdown", self._shutdown_executor)
         if self.model_name is None:
             self.model_name = re.sub(
                 SLUGIFY_REGEX, SLUGIFY_REPLACE, self.__class__.__name__
             )
+        self._init_profiling()
+        self.metrics = ModelMetrics(self.model_name)
+        self._collect_metrics()
+        self._route_paths = frozenset(route.path for route in self.routes)
+        self.setup_time = time.perf_counter() - started_at - (self.load_time or 0)
+
+    def _init_request_handling(self):
+        self.result_cache = None
+        if self.result_cache_size and self.deterministic:
+            self.result_cache = ResultCache(
+                self.result_cache_size,
+                self.result_cache_max_bytes,
+                self.result_cache_ttl,
+            )
+            logger.debug(f"Result cache enabled for {self.result_cache_size} entries")
+        self.coalescer = None
+        if self.coalesce_requests and self.deterministic:
+            self.coalescer = RequestCoalescer()
+            logger.debug("Coalescing of identical in-flight predictions enabled")
+        self._batcher = None
+        if self.batch_max_size:
+            self._batcher = PredictionBatcher(
+                self._predict_batch,
+                self.batch_max_size,
+                self.batch_max_wait_ms / 1000,
+                self.batch_max_queue_size,
+            )
+            logger.debug(f"Prediction batching enabled up to {self.batch_max_size}")
+        self.admission = None
+        if self.max_in_flight:
+            self.admission = AdmissionController(
+                self.max_in_flight, self.max_queue_length, self.retry_after_seconds
+            )
+            logger.debug(f"Admission control enabled for {self.max_in_flight} requests")
+
+    def _init_profiling(self):
+        self.profiler = None
+        if not self.profile_sample_rate and not self.profile_header:
+            return
+        if self._execution_mode is ExecutionModes.PROCESS or self._batcher is not None:
+            logger.warning(
+                "Profiling is not supported for process pools or batched predictions"
+            )
+            return
+        self.profiler = PredictionProfiler(
+            self.model_name,
+            self.profile_sample_rate,
+            self.profile_header,
+            self.profile_directory,
+        )
+        self.add_route("/profile/", self._profile_endpoint, methods=["GET", "DELETE"])
+        logger.debug("Prediction profiling enabled")
+
+    def _init_reloading(self):
+        # Hooks are called on the model slot, which a reload replaces with a copy of
+        # this model serving holding the newly loaded model
+        self._model_slot = self
+        self.model_version = 0
+        self.reload_time = None
+        self.reload_error = None
+        self._reloads = 0
+        self._reload_failures = 0
+        self._reload_future = None
+        self._watch_task = None
+        if self.reload_endpoint:
+            self.add_route("/reload/", self._reload_endpoint, methods=["GET", "POST"])
+        if self.reload_watch_paths:
+            self.add_event_handler("startup", self._start_model_watcher)
+            self.add_event_handler("shutdown", self._stop_model_watcher)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await super().__call__(scope, receive, send)
+            return
+        # Unknown paths share one label so 404 scans cannot grow the metrics
+        path = scope["path"] if scope["path"] in self._route_paths else "other"
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        self.metrics.in_flight += 1
+        started_at = time.perf_counter()
+        try:
+            priority = self.endpoint_priorities.get(path)
+            if priority is not None and self.load_time is None:
+                await self._call_loading(scope, receive, send_with_status)
+            elif self.admission is None or priority is None:
+                await super().__call__(scope, receive, send_with_status)
+            else:
+                await self._call_admitted(scope, receive, send_with_status, priority)
+        except Exception as exc:
+            self.metrics.record_error(type(exc).__name__, 500)
+            raise
+        finally:
+            self.metrics.in_flight -= 1
+            self.metrics.record_request(
+                path, status_code, time.perf_counter() - started_at
+            )
+
+    async def _call_loading(self, scope: Scope, receive: Receive, send: Send):
+        if self._load_future is None:
+            logger.info(f"Loading {self.__class__.__name__} on its first request")
+            self._load_future = asyncio.get_event_loop().run_in_executor(
+                None, self._load_model
+            )
+        if self._load_future.done() and self._load_future.exception() is not None:
+            status_code = 500
+            detail = "Failed to load the model"
+            headers = None
+        else:
+            status_code = 503
+            detail = "The model is loading, please retry later"
+            headers = {"Retry-After": str(self.retry_after_seconds)}
+        self.metrics.record_error("ModelLoading", status_code)
+        response = PlainTextResponse(detail, status_code=status_code, headers=headers)
+        await response(scope, receive, send)
+
+    async def _call_admitted(
+        self, scope: Scope, receive: Receive, send: Send, priority: int
+    ):
+        try:
+            await self.admission.acquire(priority)
+        except ServiceUnavailableException as exc:
+            self.metrics.record_error(exception_name(exc), exc.status_code)
+            response = PlainTextResponse(
+                exc.detail, status_code=exc.status_code, headers=exc.headers
+            )
+            await response(scope, receive, send)
+            return
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.admission.release()
+
+    def _collect_metrics(self):
+        self.metrics.collect(
+            "foxcross_model_ready",
+            "gauge",
+            "Whether the model is loaded and serving predictions",
+            lambda: int(self.load_time is not None),
+        )
+        self.metrics.collect(
+            "foxcross_model_load_seconds",
+            "gauge",
+            "Time taken to load and warm up the model",
+            lambda: self.load_time or 0,
+        )
+        self.metrics.collect(
+            "foxcross_model_version",
+            "gauge",
+            "Number of times the model has been loaded, counting reloads",
+            lambda: self.model_version,
+        )
+        self.metrics.collect(
+            "foxcross_model_reload_seconds",
+            "gauge",
+            "Time taken by the last successful reload",
+            lambda: self.reload_time or 0,
+        )
+        self.metrics.collect(
+            "foxcross_model_reloads_total",
+            "counter",
+            "Successful model reloads",
+            lambda: self._reloads,
+        )
+        self.metrics.collect(
+            "foxcross_model_reload_failures_total",
+            "counter",
+            "Model reloads that failed and kept the current model",
+            lambda: self._reload_failures,
+        )
+        if self.profiler is not None:
+            self.metrics.collect(
+                "foxcross_profiled_predictions_total",
+                "counter",
+                "Predictions profiled since the profile was last reset",
+                lambda: self.profiler.profiled,
+            )
+        if self.admission is not None:
+            self.metrics.collect(
+                "foxcross_admission_in_flight",
+                "gauge",
+                "Requests holding an admission slot",
+                lambda: self.admission.in_flight,
+            )
+            self.metrics.collect(
+                "foxcross_admission_queue_depth",
+                "gauge",
+                "Requests waiting for an admission slot",
+                lambda: self.admission.queue_depth,
+            )
+            self.metrics.collect(
+                "foxcross_admission_shed_total",
+                "counter",
+                "Requests shed with a 503 by admission control",
+                lambda: self.admission.shed,
+            )
+        if self.result_cache is not None:
+            self._collect_cache_metrics(
+                "result_cache", "serialized prediction responses", self.result_cache
+            )
+        if self.compression_cache_size:
+            self._collect_cache_metrics(
+                "compression_cache", "compressed responses", self.compression_cache
+            )
+        if self.coalescer is not None:
+            self.metrics.collect(
+                "foxcross_coalesced_requests_total",
+                "counter",
+                "Predictions answered by an identical prediction already in flight",
+                lambda: self.coalescer.coalesced,
+            )
+        if self._batcher is not None:
+            self.metrics.collect(
+                "foxcross_batch_queue_depth",
+                "gauge",
+                "Predictions waiting for or running in a batch",
+                lambda: self._batcher.queue_depth,
+            )
+
+    def _collect_cache_metrics(self, name: str, description: str, cache: ResultCache):
+        for counter in ("hits", "misses", "evictions"):
+            self.metrics.collect(
+                f"foxcross_{name}_{counter}_total",
+                "counter",
+                f"Cache {counter} of {description}",
+                lambda counter=counter: getattr(cache, counter),
+            )
+        self.metrics.collect(
+            f"foxcross_{name}_entries",
+            "gauge",
+            f"Number of cached {description}",
+            lambda: len(cache),
+        )
+        self.metrics.collect(
+            f"foxcross_{name}_bytes",
+            "gauge",
+            f"Total size of the cached {description}",
+            lambda: cache.size_bytes,
+        )
 
     def load_model(self):
         """Hook to load a model or models"""
         pass
 
+    @property
+    def model_store(self) -> "ModelStore":
+        """
+        Store of read-only, memory-mapped numpy arrays for load_model, which every
+        worker process loading this model shares. Requires numpy.
+        """
+        # Imported here since numpy is only installed with the pandas extras
+        from .model_store import ModelStore, default_model_store_directory
+
+        directory = Path(self.model_store_path or default_model_store_directory())
+        # Set on the class or named after it, since load_model runs before __init__
+        # sets model_name and process pool workers never run __init__
+        model_name = self.model_name or re.sub(
+            SLUGIFY_REGEX, SLUGIFY_REPLACE, self.__class__.__name__
+        )
+        return ModelStore(directory / model_name)
+
+    def _load_model(self):
+        started_at = time.perf_counter()
+        try:
+            self.load_model()
+            logger.debug("load_model completed")
+            if self._warmup:
+                self._warm_up()
+        except Exception:
+            logger.exception(f"Failed to load {self.__class__.__name__}")
+            raise
+        self.load_time = time.perf_counter() - started_at
+        self.model_version = 1
+        logger.info(f"Loaded {self.__class__.__name__} in {self.load_time:.3f}s")
+
+    async def reload_model(self) -> bool:
+        """
+        Run load_model on a copy of this model serving and swap it in, after checking it
+        against the test data when reload_validate is set. Requests in flight finish on
+        the model they started with. Returns whether the new model was swapped in
+        """
+        started_at = time.perf_counter()
+        try:
+            model = await asyncio.get_event_loop().run_in_executor(
+                None, self._load_reload_candidate
+            )
+        except Exception as exc:
+            self._reload_failures += 1
+            self.reload_error = f"{type(exc).__name__}: {exc}"
+            logger.exception(
+                f"Failed to reload {self.__class__.__name__}, keeping the current model"
+            )
+            return False
+        self._model_slot = model
+        self.model_version += 1
+        self._reloads += 1
+        self.reload_time = time.perf_counter() - started_at
+        self.reload_error = None
+        self._predict_test_cache = None
+        if self.result_cache is not None:
+            self.result_cache.clear()
+        if self._execution_mode is ExecutionModes.PROCESS and self._executor is not None:
+            # Process pool workers loaded the old model, so new workers are started
+            # while the old ones finish their predictions
+            executor, self._executor = self._executor, None
+            executor.shutdown(wait=False)
+        logger.info(
+            f"Reloaded {self.__class__.__name__} as version {self.model_version} in"
+            f" {self.reload_time:.3f}s"
+        )
+        return True
+
+    def _load_reload_candidate(self) -> "ModelServing":
+        model = copy.copy(self)
+        # Otherwise each copy would keep the previous model alive
+        model._model_slot = model
+        model.load_model()
+        if self.reload_validate:
+            model._warm_up()
+        return model
+
+    def _start_reload(self) -> Union[asyncio.Future, None]:
+        if self._reload_future is not None and not self._reload_future.done():
+            return None
+        self._reload_future = asyncio.ensure_future(self.reload_model())
+        return self._reload_future
+
+    def _reload_status(self) -> Dict[str, Any]:
+        return {
+            "model_version": self.model_version,
+            "reloading": self._reload_future is not None
+            and not self._reload_future.done(),
+            "reload_seconds": self.reload_time,
+            "reload_error": self.reload_error,
+        }
+
+    async def _reload_endpoint(self, request: Request) -> Response:
+        self._negotiate(request, "accept", _json_negotiator, 406)
+        status_code = 200
+        if request.method == "POST":
+            if self.load_time is None:
+                err_msg = "The model has not been loaded yet"
+                logger.warning(err_msg)
+                raise HTTPException(status_code=409, detail=err_msg)
+            if self._start_reload() is None:
+                err_msg = "The model is already reloading"
+                logger.warning(err_msg)
+                raise HTTPException(status_code=409, detail=err_msg)
+            status_code = 202
+        return Response(
+            self._json_codec.dumps(self._reload_status()),
+            status_code=status_code,
+            media_type=MediaTypes.JSON.value,
+        )
+
+    def _start_model_watcher(self):
+        self._watch_task = asyncio.ensure_future(self._watch_model_files())
+
+    async def _stop_model_watcher(self):
+        if self._watch_task is not None:
+            self._watch_task.cancel()
+            self._watch_task = None
+
+    async def _watch_model_files(self):
+        loaded_stats = _stat_files(self.reload_watch_paths)
+        previous_stats = loaded_stats
+        while True:
+            await asyncio.sleep(self.reload_poll_seconds)
+            stats = _stat_files(self.reload_watch_paths)
+            # Files still being written change between polls, so they are only
+            # reloaded once they stay the same for a whole poll
+            if stats != loaded_stats and stats == previous_stats:
+                future = self._start_reload() if self.load_time is not None else None
+                if future is not None:
+                    logger.info(f"Model files of {self.__class__.__name__} changed")
+                    loaded_stats = stats
+                    await future
+            previous_stats = stats
+
+    def _warm_up(self):
+        # Runs the test data through the prediction hooks once, so the first request
+        # does not pay for lazy initialization inside the model
+        with open(self.test_data_path, "rb") as f:
+            test_data = self._json_codec.loads(f.read())
+        formatted_data = self._format_input(test_data)
+        if self._async_predict:
+            loop = asyncio.new_event_loop()
+            try:
+                results = loop.run_until_complete(
+                    self._process_prediction_async(formatted_data)
+                )
+            finally:
+                loop.close()
+        else:
+            results = self._process_prediction(formatted_data)
+        self._format_output(results)
+        logger.debug("Warmed up the model with the test data")
+
     def predict(self, data: Any) -> Any:
         """
         Method to define how the model performs a prediction.
-        Must return JSON serializable data
+        Must return JSON serializable data. May be defined with async def, in which
+        case it is awaited on the event loop instead of using the execution_mode
         """
         raise NotImplementedError(
             "You must implement your model serving's predict method and it must return"
@@ -86,6 +601,17 @@ class ModelServing(Starlette):
         )
 
     async def _read_test_data(self) -> Any:
+        try:
+            stat = os.stat(self.test_data_path)
+        except FileNotFoundError:
+            err_msg = f"Error reading {self.test_data_path}"
+            logger.exception(err_msg)
+            raise HTTPException(status_code=500, detail=err_msg)
+        # Only re-read the test data when the file on disk changes
+        cache_key = (stat.st_mtime_ns, stat.st_size)
+        if self._test_data_cache is not None and self._test_data_cache[0] == cache_key:
+            logger.debug(f"Test data for {self.test_data_path} served from cache")
+            return self._test_data_cache[1]
         try:
             async with aiofiles.open(self.test_data_path, mode="rb") as f:
                 contents = await f.read()
@@ -95,57 +621,192 @@ class ModelServing(Starlette):
             logger.exception(err_msg)
             raise HTTPException(status_code=500, detail=err_msg)
         try:
-            return json.loads(contents.decode("utf-8"))
+            test_data = self._json_codec.loads(contents)
         except (TypeError, ValueError):
             err_msg = "Failed to load test data into JSON"
             logger.exception(err_msg)
             raise HTTPException(status_code=500, detail=err_msg)
+        self._test_data_cache = (cache_key, test_data)
+        return test_data
 
-    async def _predict_endpoint(
-        self, request: Request
-    ) -> Union[JSONResponse, Jinja2Templates.TemplateResponse]:
-        if request.method == "GET":
-            self._validate_http_headers(
-                request, "accept", MediaTypes.html_media_types(), 406
+    async def _predict_test_output(self) -> Any:
+        test_data = await self._read_test_data()
+        cache_key = self._test_data_cache[0]
+        if self._predict_test_cache is not None:
+            cached_key, expires_at, cached_output = self._predict_test_cache
+            if cached_key == cache_key and time.monotonic() < expires_at:
+                logger.debug("Predict test output served from cache")
+                return cached_output
+        # Hooks may mutate their input, so they never see the cached test data
+        formatted_data = self._format_input(copy.deepcopy(test_data))
+        logger.debug("Formatted test data")
+        processed_results = await self._run_prediction(formatted_data)
+        logger.debug("Completed prediction test process")
+        formatted_output = self._format_output(processed_results)
+        logger.debug("Formatted prediction test results")
+        if self.predict_test_cache_ttl:
+            self._predict_test_cache = (
+                cache_key,
+                time.monotonic() + self.predict_test_cache_ttl,
+                formatted_output,
             )
-            return templates.TemplateResponse("predict.html", {"request": request})
+        return formatted_output
+
+    async def _predict_endpoint(self, request: Request) -> Response:
+        if request.method == "GET":
+            self._negotiate(request, "accept", _html_negotiator, 406)
+            return get_templates().TemplateResponse("predict.html", {"request": request})
         elif request.method == "POST":
-            self._validate_http_headers(
-                request, "accept", MediaTypes.json_media_types(), 406
-            )
-            self._validate_http_headers(
-                request, "content-type", MediaTypes.json_media_types(), 415
-            )
-            json_data = await request.json()
-            logger.debug("Received POST data for prediction")
-            formatted_data = self._format_input(json_data)
-            logger.debug("Formatted POST input data for prediction")
-            processed_results = self._process_prediction(formatted_data)
-            logger.debug("Completed prediction process")
-            formatted_output = self._format_output(processed_results)
-            logger.debug("Formatted prediction results")
-            return self._get_json_response(formatted_output)
-
-    async def _predict_test_endpoint(
-        self, request: Request
-    ) -> Union[JSONResponse, Jinja2Templates.TemplateResponse]:
+            media_type, encode_output = self._negotiate(
+                request, "accept", self._output_negotiator, 406
+            )
+            content_type, read_input = self._negotiate(
+                request, "content-type", self._input_negotiator, 415
+            )
+            cache_key = None
+            if self.result_cache is not None or self.coalescer is not None:
+                # The model version keeps requests from before and after a reload
+                # apart
+                cache_key = ResultCache.make_key(
+                    str(self.model_version).encode(),
+                    content_type.encode(),
+                    media_type.encode(),
+                    await request.body(),
+                )
+            if self.result_cache is not None:
+                cached_body = self.result_cache.get(cache_key)
+                if cached_body is not None:
+                    logger.debug("Prediction served from result cache")
+                    return Response(cached_body, media_type=media_type)
+            if self.coalescer is None:
+                return await self._predict_response(
+                    request, read_input, encode_output, cache_key
+                )
+            response = await self.coalescer.run(
+                cache_key,
+                lambda: self._predict_response(
+                    request, read_input, encode_output, cache_key
+                ),
+            )
+            # Each request gets its own response around the shared body, since
+            # middleware changes the headers of the response it sends
+            return Response(response.body, media_type=media_type)
+
+    async def _predict_response(
+        self,
+        request: Request,
+        read_input: Callable[[Request], Awaitable[Any]],
+        encode_output: Callable[[Any], Response],
+        cache_key: Union[str, None],
+    ) -> Response:
+        model_version = self.model_version
+        started_at = time.perf_counter()
+        formatted_data = await read_input(request)
+        self._observe_stage("format_input", started_at)
+        logger.debug("Formatted POST input data for prediction")
+        # Only an attribute check when profiling is disabled
+        profile = self.profiler is not None and self.profiler.should_profile(
+            request.headers
+        )
+        processed_results = await self._run_prediction(formatted_data, profile)
+        logger.debug("Completed prediction process")
+        started_at = time.perf_counter()
+        response = encode_output(processed_results)
+        self._observe_stage("serialize_output", started_at)
+        logger.debug("Formatted prediction results")
+        # A result of the old model is not cached once a reload has cleared the cache
+        if self.result_cache is not None and model_version == self.model_version:
+            self.result_cache.set(cache_key, response.body)
+        return response
+
+    async def _predict_stream_endpoint(self, request: Request) -> Response:
         if request.method == "GET":
-            self._validate_http_headers(
-                request, "accept", MediaTypes.html_media_types(), 406
+            self._negotiate(request, "accept", _html_negotiator, 406)
+            return get_templates().TemplateResponse(
+                "predict_stream.html", {"request": request}
             )
         elif request.method == "POST":
-            self._validate_http_headers(
-                request, "accept", MediaTypes.json_media_types(), 406
+            self._negotiate(request, "accept", _ndjson_negotiator, 406)
+            self._negotiate(request, "content-type", _ndjson_negotiator, 415)
+            chunks = self._read_ndjson_chunks(request)
+            # Predict the first chunk before the response starts so that errors in it
+            # can still change the status code
+            try:
+                first_chunk = await chunks.__anext__()
+            except StopAsyncIteration:
+                return Response(b"", media_type=MediaTypes.NDJSON.value)
+            first_results = await self._predict_stream_chunk(first_chunk)
+            return StreamingResponse(
+                self._stream_predictions(first_results, chunks),
+                media_type=MediaTypes.NDJSON.value,
             )
-        test_data = await self._read_test_data()
-        formatted_data = self._format_input(test_data)
-        logger.debug("Formatted test data")
-        processed_results = self._process_prediction(formatted_data)
-        logger.debug("Completed prediction test process")
-        formatted_output = self._format_output(processed_results)
-        logger.debug("Formatted prediction test results")
+
+    async def _read_ndjson_chunks(self, request: Request) -> AsyncIterator[List[Any]]:
+        buffer = b""
+        records = []
+        async for body in request.stream():
+            buffer += body
+            *lines, buffer = buffer.split(b"\n")
+            for line in lines:
+                if line.strip():
+                    records.append(self._load_ndjson_line(line))
+                if len(records) >= self.stream_chunk_size:
+                    yield records
+                    records = []
+        if buffer.strip():
+            records.append(self._load_ndjson_line(buffer))
+        if records:
+            yield records
+
+    def _load_ndjson_line(self, line: bytes) -> Any:
+        try:
+            return self._json_codec.loads(line)
+        except (TypeError, ValueError):
+            err_msg = "Failed to load NDJSON line into JSON"
+            logger.warning(err_msg)
+            raise HTTPException(status_code=400, detail=err_msg)
+
+    async def _predict_stream_chunk(self, records: List[Any]) -> bytes:
+        started_at = time.perf_counter()
+        formatted_data = self._format_stream_chunk(records)
+        self._observe_stage("format_input", started_at)
+        processed_results = await self._run_prediction(formatted_data)
+        logger.debug(f"Completed prediction for stream chunk of {len(records)}")
+        started_at = time.perf_counter()
+        output = self._serialize_stream_chunk(processed_results)
+        self._observe_stage("serialize_output", started_at)
+        return output
+
+    async def _stream_predictions(
+        self, first_results: bytes, chunks: AsyncIterator[List[Any]]
+    ) -> AsyncIterator[bytes]:
+        yield first_results
+        try:
+            async for records in chunks:
+                yield await self._predict_stream_chunk(records)
+        except HTTPException as exc:
+            # The 200 status has already been sent, so report the error as the last
+            # record of the stream instead
+            logger.warning(f"Stopped prediction stream: {exc.detail}")
+            self.metrics.record_error(exception_name(exc), exc.status_code)
+            yield self._stream_error_record(exc.status_code, exc.detail)
+
+    def _stream_error_record(self, status_code: int, detail: str) -> bytes:
+        return (
+            self._json_codec.dumps(
+                {"error": {"status_code": status_code, "detail": detail}}
+            )
+            + b"\n"
+        )
+
+    async def _predict_test_endpoint(self, request: Request) -> Response:
+        if request.method == "GET":
+            self._negotiate(request, "accept", _html_negotiator, 406)
+        elif request.method == "POST":
+            self._negotiate(request, "accept", _json_negotiator, 406)
+        formatted_output = await self._predict_test_output()
         if request.method == "GET":
-            return templates.TemplateResponse(
+            return get_templates().TemplateResponse(
                 "predict_test.html",
                 {
                     "request": request,
@@ -161,41 +822,180 @@ class ModelServing(Starlette):
                 },
             )
 
+    async def _run_prediction(self, formatted_data: Any, profile: bool = False) -> Any:
+        # The request keeps this model even if a reload swaps in a new one meanwhile
+        model = self._model_slot
+        if profile:
+            return await self._run_profiled_prediction(model, formatted_data)
+        if self._batcher is not None:
+            return await self._run_batched_prediction(model, formatted_data)
+        if self._async_predict:
+            return await model._process_prediction_async(formatted_data)
+        executor = self._get_executor()
+        if executor is None:
+            return model._process_prediction(formatted_data)
+        started_at = time.perf_counter()
+        results = await run_in_executor(
+            executor, self._execution_mode, model, "_process_prediction", formatted_data
+        )
+        self._observe_pool_stage(started_at)
+        return results
+
+    async def _run_profiled_prediction(
+        self, model: "ModelServing", formatted_data: Any
+    ) -> Any:
+        if self._async_predict:
+            return await self.profiler.profile_async(
+                model._process_prediction_async(formatted_data)
+            )
+        executor = self._get_executor()
+        if executor is None:
+            return self.profiler.profile(model._process_prediction, formatted_data)
+        return await asyncio.get_event_loop().run_in_executor(
+            executor, self.profiler.profile, model._process_prediction, formatted_data
+        )
+
+    async def _profile_endpoint(self, request: Request) -> Response:
+        if request.method == "DELETE":
+            self.profiler.reset()
+            logger.info("Prediction profile reset")
+            return Response(b"", status_code=204)
+        try:
+            limit = int(request.query_params.get("limit", 50))
+            report = self.profiler.report(
+                request.query_params.get("sort", "cumulative"), limit
+            )
+        except (KeyError, ValueError) as exc:
+            err_msg = f"Invalid profile report parameters: {exc}"
+            logger.warning(err_msg)
+            raise HTTPException(status_code=400, detail=err_msg)
+        return PlainTextResponse(report)
+
+    async def _run_batched_prediction(
+        self, model: "ModelServing", formatted_data: Any
+    ) -> Any:
+        pre_processed_input = model._pre_process(formatted_data)
+        if self._is_batchable(pre_processed_input):
+            results = await self._batcher.submit(
+                pre_processed_input, self._batch_key(pre_processed_input)
+            )
+        else:
+            results = await self._run_predict(pre_processed_input)
+        return model._post_process(results)
+
+    async def _run_predict(self, data: Any) -> Any:
+        model = self._model_slot
+        if self._async_predict:
+            return await model._predict_async(data)
+        executor = self._get_executor()
+        if executor is None:
+            return model._predict(data)
+        started_at = time.perf_counter()
+        results = await run_in_executor(
+            executor, self._execution_mode, model, "_predict", data
+        )
+        self._observe_pool_stage(started_at)
+        return results
+
+    async def _predict_batch(self, batch: List[Any]) -> List[Any]:
+        results = await self._run_predict(self._concat_batch(batch))
+        return self._split_batch(results, batch)
+
+    def _get_executor(self):
+        # Created lazily so pools are never inherited by forked processes
+        if self._executor is None:
+            self._executor = create_executor(self._execution_mode, self.max_workers)
+        return self._executor
+
+    def _shutdown_executor(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+            logger.debug("Prediction executor shut down")
+
     def _process_prediction(self, formatted_data):
+        pre_processed_input = self._pre_process(formatted_data)
+        results = self._predict(pre_processed_input)
+        return self._post_process(results)
+
+    async def _process_prediction_async(self, formatted_data):
+        pre_processed_input = self._pre_process(formatted_data)
+        results = await self._predict_async(pre_processed_input)
+        return self._post_process(results)
+
+    def _process_batch_prediction(self, formatted_data):
+        # Batch predictions run outside of an event loop, so an async predict gets a
+        # loop of its own
+        if not inspect.iscoroutinefunction(self.predict):
+            return self._process_prediction(formatted_data)
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self._process_prediction_async(formatted_data))
+        finally:
+            loop.close()
+
+    def _observe_stage(self, stage: str, started_at: float):
+        # Model servings in process pool workers are not initialized and have no metrics
+        if self.metrics is not None:
+            self.metrics.observe_stage(stage, time.perf_counter() - started_at)
+
+    def _observe_pool_stage(self, started_at: float):
+        # The stages run in the worker processes, so only their total is recorded
+        if self._execution_mode == ExecutionModes.PROCESS:
+            self._observe_stage("process_pool", started_at)
+
+    def _pre_process(self, formatted_data):
+        started_at = time.perf_counter()
         try:
             pre_processed_input = self.pre_process_input(formatted_data)
             logger.debug("Pre-processed data")
         except PreProcessingError as exc:
             logger.warning(str(exc))
-            raise HTTPException(status_code=exc.http_status_code, detail=str(exc))
+            raise to_http_exception(exc)
+        self._observe_stage("pre_process_input", started_at)
+        return pre_processed_input
+
+    def _predict(self, data):
+        started_at = time.perf_counter()
         try:
-            results = self.predict(pre_processed_input)
+            results = self.predict(data)
             logger.debug("Performed prediction")
         except PredictionError as exc:
             logger.warning(str(exc))
-            raise HTTPException(status_code=exc.http_status_code, detail=str(exc))
+            raise to_http_exception(exc)
+        self._observe_stage("predict", started_at)
+        return results
+
+    async def _predict_async(self, data):
+        started_at = time.perf_counter()
+        try:
+            results = await self.predict(data)
+            logger.debug("Performed async prediction")
+        except PredictionError as exc:
+            logger.warning(str(exc))
+            raise to_http_exception(exc)
+        self._observe_stage("predict", started_at)
+        return results
+
+    def _post_process(self, results):
+        started_at = time.perf_counter()
         try:
             processed_results = self.post_process_results(results)
             logger.debug("Post-processed prediction results")
         except PostProcessingError as exc:
             logger.warning(str(exc))
-            raise HTTPException(status_code=exc.http_status_code, detail=str(exc))
+            raise to_http_exception(exc)
+        self._observe_stage("post_process_results", started_at)
         return processed_results
 
-    async def _input_format_endpoint(
-        self, request: Request
-    ) -> Union[JSONResponse, Jinja2Templates.TemplateResponse]:
+    async def _input_format_endpoint(self, request: Request) -> Response:
         if request.method == "GET":
-            self._validate_http_headers(
-                request, "accept", MediaTypes.html_media_types(), 406
-            )
+            self._negotiate(request, "accept", _html_negotiator, 406)
         elif request.method == "POST":
-            self._validate_http_headers(
-                request, "accept", MediaTypes.json_media_types(), 406
-            )
+            self._negotiate(request, "accept", _json_negotiator, 406)
         test_data = await self._read_test_data()
         if request.method == "GET":
-            return templates.TemplateResponse(
+            return get_templates().TemplateResponse(
                 "input_format.html",
                 {
                     "request": request,
@@ -212,40 +1012,48 @@ class ModelServing(Starlette):
             )
 
     @staticmethod
-    def _validate_http_headers(
+    def _negotiate(
         request: Request,
         header: str,
-        media_types: Iterable[str],
+        negotiator: ContentNegotiator,
         invalid_status_code: int,
-    ):
-        if not request.headers.get(header):
+    ) -> Tuple[str, Any]:
+        """The media type and codec for the accept or content-type header"""
+        value = request.headers.get(header)
+        if not value:
             err_msg = (
                 f"Missing http header {header}. Please provide one with an appropriate"
-                f" media type. Possible types are {', '.join(media_types)}"
+                f" media type. Possible types are {', '.join(negotiator.media_types)}"
             )
             logger.warning(err_msg)
             raise HTTPException(status_code=400, detail=err_msg)
-        elif not any(x in request.headers[header] for x in media_types):
+        negotiated = negotiator.negotiate(value)
+        if negotiated is None:
             err_msg = (
-                f"Media types {request.headers[header]} in {header} header are not"
-                f" supported. Supported types are {', '.join(media_types)}"
+                f"Media types {value} in {header} header are not supported. Supported"
+                f" types are {', '.join(negotiator.media_types)}"
             )
             logger.warning(err_msg)
             raise HTTPException(status_code=invalid_status_code, detail=err_msg)
+        return negotiated
+
+    def _http_exception_handler(self, request: Request, exc: HTTPException) -> Response:
+        self.metrics.record_error(exception_name(exc), exc.status_code)
+        headers = getattr(exc, "headers", None)
+        if exc.status_code in {204, 304}:
+            return Response(b"", status_code=exc.status_code, headers=headers)
+        return PlainTextResponse(exc.detail, status_code=exc.status_code, headers=headers)
 
-    @staticmethod
     def _get_json_response(
-        data: Any, extra_headers: Dict[str, str] = None
-    ) -> JSONResponse:
+        self, data: Any, extra_headers: Dict[str, str] = None
+    ) -> Response:
         try:
-            if extra_headers:
-                return JSONResponse(data, headers=extra_headers)
-            else:
-                return JSONResponse(data)
-        except (TypeError, ValueError):
+            body = self._json_codec.dumps(data)
+        except (TypeError, ValueError, OverflowError):
             err_msg = "Error trying to serialize response data to JSON"
             logger.exception(err_msg)
             raise HTTPException(status_code=500, detail=err_msg)
+        return Response(body, media_type=MediaTypes.JSON.value, headers=extra_headers)
 
     def pre_process_input(self, data: Any) -> Any:
         """Hook to enable pre-processing of input data"""
@@ -255,12 +1063,78 @@ class ModelServing(Starlette):
         """Hook to enable post-processing of output data"""
         return data
 
+    def _input_decoders(self) -> Dict[str, Callable[[Request], Awaitable[Any]]]:
+        """Readers of /predict/ request bodies by content type, preferred first"""
+        return {MediaTypes.JSON.value: self._read_json_input}
+
+    def _output_encoders(self) -> Dict[str, Callable[[Any], Response]]:
+        """Writers of /predict/ responses by media type, preferred first"""
+        return {MediaTypes.JSON.value: self._encode_json_output}
+
+    async def _read_json_input(self, request: Request) -> Any:
+        try:
+            json_data = self._json_codec.loads(await request.body())
+        except ValueError as exc:
+            err_msg = f"Failed to load request body into JSON: {exc}"
+            logger.warning(err_msg)
+            raise HTTPException(status_code=400, detail=err_msg)
+        logger.debug("Received POST data for prediction")
+        return self._format_input(json_data)
+
+    def _encode_json_output(self, results: Any) -> Response:
+        return self._get_json_response(self._format_output(results))
+
     def _format_input(self, data: Any) -> Any:
         return data
 
     def _format_output(self, results: Any) -> Any:
         return results
 
+    def _format_stream_chunk(self, records: List[Any]) -> Any:
+        return self._format_input(records)
+
+    def _format_frame_chunk(self, frame: Any) -> Any:
+        """Format a pandas DataFrame chunk of a CSV or Parquet batch input"""
+        return self._format_stream_chunk(frame.to_dict(orient="records"))
+
+    def _serialize_stream_chunk(self, results: Any) -> bytes:
+        try:
+            return b"".join(self._json_codec.dumps(result) + b"\n" for result in results)
+        except (TypeError, ValueError, OverflowError):
+            err_msg = "Error trying to serialize stream results to NDJSON"
+            logger.exception(err_msg)
+            raise HTTPException(status_code=500, detail=err_msg)
+
+    def _is_batchable(self, data: Any) -> bool:
+        return isinstance(data, list)
+
+    def _batch_key(self, data: Any) -> Hashable:
+        """Inputs are only batched together with inputs that share their key"""
+        return None
+
+    def _concat_batch(self, batch: List[Any]) -> Any:
+        return list(itertools.chain.from_iterable(batch))
+
+    def _split_batch(self, results: Any, batch: List[Any]) -> List[Any]:
+        self._check_batch_results(len(results), batch)
+        split_results = []
+        start = 0
+        for data in batch:
+            split_results.append(results[start : start + len(data)])
+            start += len(data)
+        return split_results
+
+    @staticmethod
+    def _check_batch_results(results_length: int, batch: List[Any]):
+        expected_length = sum(len(data) for data in batch)
+        if results_length != expected_length:
+            err_msg = (
+                f"Batched prediction returned {results_length} results for"
+                f" {expected_length} inputs"
+            )
+            logger.error(err_msg)
+            raise HTTPException(status_code=500, detail=err_msg)
+
 
 _model_serving_runner = ModelServingRunner(ModelServing, (ModelServing,))
 compose_models = _model_serving_runner.compose
@@ -1,10 +1,23 @@
 import os
 from pathlib import Path
+from typing import TYPE_CHECKING, Optional
 
-from starlette.templating import Jinja2Templates
+if TYPE_CHECKING:
+    from starlette.templating import Jinja2Templates
 
 __location__ = Path(
     os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))
 )
-templates = Jinja2Templates(directory=str(__location__ / "templates"))
-templates.env.filters["hasattr"] = hasattr
+_templates: Optional["Jinja2Templates"] = None
+
+
+def get_templates() -> "Jinja2Templates":
+    # Created on the first HTML page, since importing jinja2 slows down startup and
+    # API-only model servings never render one
+    global _templates
+    if _templates is None:
+        from starlette.templating import Jinja2Templates
+
+        _templates = Jinja2Templates(directory=str(__location__ / "templates"))
+        _templates.env.filters["hasattr"] = hasattr
+    return _templates
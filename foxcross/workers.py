@@ -0,0 +1,162 @@
+import asyncio
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+from typing import Dict, Optional
+
+import uvicorn
+
+logger = logging.getLogger(__name__)
+
+HANDLED_SIGNALS = (signal.SIGINT, signal.SIGTERM)
+
+
+def resident_memory_mb() -> float:
+    """Current resident memory of this process in MB"""
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE") / 1024**2
+    except (OSError, ValueError, IndexError):
+        import resource
+
+        # Peak rather than current memory, in KB on Linux and bytes on macOS
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        divisor = 1024**2 if sys.platform == "darwin" else 1024
+        return max_rss / divisor
+
+
+class _WorkerServer(uvicorn.Server):
+    def __init__(self, config: uvicorn.Config, forked_at: float):
+        super().__init__(config)
+        self._forked_at = forked_at
+
+    async def startup(self, sockets=None):
+        await super().startup(sockets=sockets)
+        logger.info(
+            f"Worker {os.getpid()} started in"
+            f" {time.perf_counter() - self._forked_at:.3f}s with"
+            f" {resident_memory_mb():.1f} MB resident memory"
+        )
+
+
+class WorkerSupervisor:
+    """
+    Forks worker processes that serve an already composed ASGI app from a shared
+    socket. Since the models are loaded in the parent before forking, their memory is
+    shared copy-on-write between the workers. Workers that crash are restarted with an
+    exponential backoff, and the supervisor gives up after max_restarts consecutive
+    crashes of workers that did not stay up for stable_uptime seconds.
+    """
+
+    def __init__(
+        self,
+        config: uvicorn.Config,
+        workers: int,
+        sock: Optional[socket.socket] = None,
+        restart_delay: float = 1.0,
+        max_restart_delay: float = 30.0,
+        max_restarts: int = 5,
+        stable_uptime: float = 60.0,
+    ):
+        self.config = config
+        self.workers = workers
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.max_restarts = max_restarts
+        self.stable_uptime = stable_uptime
+        self._sock = sock
+        self._worker_pids: Dict[int, float] = {}
+        self._crashes = 0
+        self._should_exit = False
+        self._inherited_loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def run(self) -> int:
+        """Supervises the workers until a signal or a crash loop, returning an exit code"""
+        if self._sock is None:
+            self._sock = self.config.bind_socket()
+        logger.info(
+            f"Started supervisor {os.getpid()} for {self.workers} workers with"
+            f" {resident_memory_mb():.1f} MB resident memory"
+        )
+        for sig in HANDLED_SIGNALS:
+            signal.signal(sig, self._handle_exit)
+        for _ in range(self.workers):
+            self._spawn_worker()
+        exit_code = 0
+        while self._worker_pids:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            started_at = self._worker_pids.pop(pid, None)
+            if started_at is None or self._should_exit:
+                continue
+            uptime = time.monotonic() - started_at
+            self._crashes = 0 if uptime >= self.stable_uptime else self._crashes + 1
+            if self._crashes > self.max_restarts:
+                logger.error(
+                    f"Worker {pid} exited with status {status} after {uptime:.1f}s,"
+                    f" giving up after {self.max_restarts} restarts"
+                )
+                exit_code = 1
+                self._stop_workers()
+                continue
+            delay = min(
+                self.restart_delay * 2 ** max(self._crashes - 1, 0),
+                self.max_restart_delay,
+            )
+            logger.warning(
+                f"Worker {pid} exited with status {status} after {uptime:.1f}s,"
+                f" restarting in {delay:.1f}s"
+            )
+            self._wait(delay)
+            if not self._should_exit:
+                self._spawn_worker()
+        logger.info(f"Stopped supervisor {os.getpid()}")
+        return exit_code
+
+    def _spawn_worker(self):
+        forked_at = time.perf_counter()
+        # Signals are blocked until the child has dropped the supervisor's handlers
+        signal.pthread_sigmask(signal.SIG_BLOCK, HANDLED_SIGNALS)
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                for sig in HANDLED_SIGNALS:
+                    signal.signal(sig, signal.SIG_DFL)
+                signal.pthread_sigmask(signal.SIG_UNBLOCK, HANDLED_SIGNALS)
+                # Closing the event loop inherited from the supervisor when it is
+                # garbage collected would unregister the supervisor's file
+                # descriptors from the epoll instance they share
+                self._inherited_loop = asyncio.get_event_loop()
+                _WorkerServer(self.config, forked_at).run(sockets=[self._sock])
+            except BaseException:
+                logger.exception(f"Worker {os.getpid()} failed")
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+        self._worker_pids[pid] = time.monotonic()
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, HANDLED_SIGNALS)
+        logger.debug(f"Forked worker {pid}")
+
+    def _wait(self, delay: float):
+        # Sleeps in short steps so a signal does not have to wait out the backoff
+        deadline = time.monotonic() + delay
+        while not self._should_exit and time.monotonic() < deadline:
+            time.sleep(min(0.1, max(deadline - time.monotonic(), 0)))
+
+    def _stop_workers(self):
+        self._should_exit = True
+        for pid in self._worker_pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def _handle_exit(self, sig, frame):
+        self._stop_workers()
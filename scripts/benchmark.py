@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+"""
+Benchmark the /predict/ hot path of ModelServing and DataFrameModelServing.
+
+Each combination of JSON codec (orjson, ujson or the standard library) and DataFrame
+library (modin or pandas) that is installed runs in its own process, since Foxcross checks
+whether modin is installed at import time. Results are written as JSON so runs can be compared
+across versions:
+
+    python scripts/benchmark.py --output before.json
+    python scripts/benchmark.py --target uvicorn --baseline before.json
+"""
+
+import argparse
+import importlib.util
+import itertools
+import json
+import multiprocessing
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+PANDAS_ORIENTS = ("index", "records", "split")
+JSON_LIBS = ("stdlib", "ujson", "orjson")
+DATAFRAME_LIBS = ("pandas", "modin")
+_json_codecs = {"stdlib": "json", "ujson": "ujson", "orjson": "orjson"}
+_blocked_modules = {"pandas": ("modin",), "modin": ()}
+
+
+def _block_modules(dataframe_lib: str):
+    # Foxcross only uses pandas when importing modin fails
+    for name in _blocked_modules[dataframe_lib]:
+        sys.modules[name] = None
+
+
+def _percentile(sorted_values: List[float], percent: float) -> float:
+    index = int(round(percent / 100 * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def _scenarios(args: argparse.Namespace, has_pandas: bool) -> List[Dict[str, Any]]:
+    scenarios = [
+        {"model": model, "rows": rows, "orient": None, "gzip": gzip}
+        for model, rows, gzip in itertools.product(
+            # numpy returns the prediction as an array for the codec to serialize
+            ("list", "numpy") if has_pandas else ("list",),
+            args.sizes,
+            (False, True),
+        )
+    ]
+    if has_pandas:
+        scenarios.extend(
+            {
+                "model": "dataframe",
+                "rows": rows,
+                "orient": orient,
+                "gzip": gzip,
+                "modin_min_rows": args.modin_min_rows,
+            }
+            for rows, orient, gzip in itertools.product(
+                args.sizes, args.orients, (False, True)
+            )
+        )
+    return scenarios
+
+
+def _scenario_name(
+    scenario: Dict[str, Any], json_lib: str, dataframe_lib: str, target: str
+) -> str:
+    parts = [
+        scenario["model"],
+        f"target={target}",
+        f"rows={scenario['rows']}",
+        f"json={json_lib}",
+    ]
+    if scenario["model"] == "dataframe":
+        parts.extend([f"orient={scenario['orient']}", f"dataframe={dataframe_lib}"])
+        if dataframe_lib == "modin" and scenario["modin_min_rows"] is not None:
+            parts.append(f"modin_min_rows={scenario['modin_min_rows']}")
+    parts.append(f"gzip={'on' if scenario['gzip'] else 'off'}")
+    return " ".join(parts)
+
+
+def _payload(scenario: Dict[str, Any]) -> bytes:
+    rows = scenario["rows"]
+    if scenario["model"] != "dataframe":
+        return json.dumps([float(x) for x in range(rows)]).encode("utf-8")
+    columns = ("A", "B", "C", "D")
+    return json.dumps(
+        {column: [x * 0.5 + i for x in range(rows)] for i, column in enumerate(columns)}
+    ).encode("utf-8")
+
+
+def _create_app(scenario: Dict[str, Any], json_lib: str, data_dir: str):
+    test_data_path = Path(data_dir) / f"{scenario['model']}.json"
+    if not test_data_path.exists():
+        test_data_path.write_bytes(_payload({**scenario, "rows": 2}))
+    attributes = {
+        "test_data_path": str(test_data_path),
+        "json_codec": _json_codecs[json_lib],
+        "predict": lambda self, d: d,
+    }
+    if scenario["model"] == "numpy":
+        import numpy
+
+        attributes["predict"] = lambda self, d: numpy.asarray(d)
+    if scenario["model"] != "dataframe":
+        from foxcross.serving import ModelServing
+
+        model_class = type("BenchmarkModel", (ModelServing,), attributes)
+    else:
+        from foxcross.pandas_serving import DataFrameModelServing
+
+        attributes["pandas_orient"] = scenario["orient"]
+        if scenario["modin_min_rows"] is not None:
+            attributes["modin_min_rows"] = scenario["modin_min_rows"]
+        model_class = type(
+            "BenchmarkDataFrameModel", (DataFrameModelServing,), attributes
+        )
+    return model_class(gzip_response=scenario["gzip"])
+
+
+def _headers(scenario: Dict[str, Any]) -> Dict[str, str]:
+    return {
+        "Accept": "application/json",
+        "Content-Type": "application/json",
+        "Accept-Encoding": "gzip" if scenario["gzip"] else "identity",
+    }
+
+
+def _measure(post, payload: bytes, args: argparse.Namespace) -> Dict[str, Any]:
+    for _ in range(args.warmup):
+        post(payload)
+    latencies = []
+    started_at = time.perf_counter()
+    for _ in range(args.requests):
+        request_started_at = time.perf_counter()
+        post(payload)
+        latencies.append(time.perf_counter() - request_started_at)
+    elapsed = time.perf_counter() - started_at
+    latencies.sort()
+    return {
+        "requests": args.requests,
+        "throughput_rps": args.requests / elapsed,
+        "latency_ms": {
+            "mean": statistics.mean(latencies) * 1000,
+            "p50": _percentile(latencies, 50) * 1000,
+            "p99": _percentile(latencies, 99) * 1000,
+        },
+    }
+
+
+def _checked_post(session, url: str, headers: Dict[str, str]):
+    def post(payload: bytes):
+        response = session.post(url, data=payload, headers=headers)
+        if response.status_code != 200:
+            raise RuntimeError(f"Benchmark request failed: {response.status_code}")
+
+    return post
+
+
+def _serve(scenario, json_lib, dataframe_lib, data_dir, port):
+    _block_modules(dataframe_lib)
+    import uvicorn
+
+    uvicorn.run(
+        _create_app(scenario, json_lib, data_dir),
+        host="127.0.0.1",
+        port=port,
+        log_level="error",
+    )
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _run_testclient(scenario, json_lib, data_dir, args) -> Dict[str, Any]:
+    from starlette.testclient import TestClient
+
+    client = TestClient(_create_app(scenario, json_lib, data_dir))
+    return _measure(
+        _checked_post(client, "/predict/", _headers(scenario)), _payload(scenario), args
+    )
+
+
+def _run_uvicorn(scenario, json_lib, dataframe_lib, data_dir, args) -> Dict[str, Any]:
+    import requests
+
+    port = _free_port()
+    # Spawned rather than forked so the server imports its own JSON and DataFrame
+    # libraries
+    process = multiprocessing.get_context("spawn").Process(
+        target=_serve, args=(scenario, json_lib, dataframe_lib, data_dir, port)
+    )
+    process.start()
+    try:
+        url = f"http://127.0.0.1:{port}"
+        with requests.Session() as session:
+            deadline = time.monotonic() + 30
+            while True:
+                try:
+                    session.get(url)
+                    break
+                except requests.ConnectionError:
+                    if time.monotonic() > deadline or not process.is_alive():
+                        raise RuntimeError("Benchmark server did not start")
+                    time.sleep(0.1)
+            post = _checked_post(session, f"{url}/predict/", _headers(scenario))
+            return _measure(post, _payload(scenario), args)
+    finally:
+        process.terminate()
+        process.join()
+
+
+def run_variant(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    """Run every scenario with one JSON and DataFrame library in this process"""
+    json_lib, dataframe_lib = args.variant.split("/")
+    _block_modules(dataframe_lib)
+    has_pandas = importlib.util.find_spec("pandas") is not None
+    results = []
+    with tempfile.TemporaryDirectory() as data_dir:
+        for scenario in _scenarios(args, has_pandas):
+            if args.target == "uvicorn":
+                result = _run_uvicorn(scenario, json_lib, dataframe_lib, data_dir, args)
+            else:
+                result = _run_testclient(scenario, json_lib, data_dir, args)
+            result["name"] = _scenario_name(
+                scenario, json_lib, dataframe_lib, args.target
+            )
+            result["parameters"] = {
+                **scenario,
+                "json": json_lib,
+                "dataframe": dataframe_lib if scenario["model"] == "dataframe" else None,
+                "target": args.target,
+            }
+            print(
+                f"{result['name']}: {result['latency_ms']['p50']:.2f}ms p50",
+                file=sys.stderr,
+            )
+            results.append(result)
+    return results
+
+
+def _variants() -> List[str]:
+    json_libs = [
+        lib for lib in JSON_LIBS if lib == "stdlib" or importlib.util.find_spec(lib)
+    ]
+    dataframe_libs = [lib for lib in DATAFRAME_LIBS if importlib.util.find_spec(lib)]
+    # The list model still runs when neither DataFrame library is installed
+    return [f"{j}/{d}" for j in json_libs for d in dataframe_libs or ["pandas"]]
+
+
+def _compare(
+    results: List[Dict[str, Any]], baseline_path: str, max_regression: float
+) -> bool:
+    with open(baseline_path) as f:
+        baseline = {result["name"]: result for result in json.load(f)["results"]}
+    passed = True
+    for result in results:
+        previous = baseline.get(result["name"])
+        if previous is None:
+            continue
+        change = result["latency_ms"]["p50"] / previous["latency_ms"]["p50"] - 1
+        result["baseline_p50_change"] = change
+        if change > max_regression:
+            passed = False
+            print(f"REGRESSION {result['name']}: p50 {change:+.1%}", file=sys.stderr)
+    return passed
+
+
+def _parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--target", choices=("testclient", "uvicorn"), default="testclient"
+    )
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument(
+        "--sizes",
+        type=lambda x: [int(size) for size in x.split(",")],
+        default=[10, 1000, 10000],
+    )
+    parser.add_argument(
+        "--orients", type=lambda x: x.split(","), default=list(PANDAS_ORIENTS)
+    )
+    parser.add_argument(
+        "--modin-min-rows",
+        type=int,
+        help="Rows from which DataFrameModelServing uses modin, 0 to always use it",
+    )
+    parser.add_argument("--output", help="Write the JSON results to this file")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare to")
+    parser.add_argument(
+        "--max-regression",
+        type=float,
+        default=0.1,
+        help="Exit with status 1 if any p50 latency is this fraction slower than the baseline",
+    )
+    parser.add_argument("--variant", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = _parse_args(argv)
+    if args.variant:
+        json.dump(run_variant(args), sys.stdout)
+        return 0
+    forwarded_args = list(argv if argv is not None else sys.argv[1:])
+    results = []
+    for variant in _variants():
+        output = subprocess.run(
+            [sys.executable, __file__, "--variant", variant] + forwarded_args,
+            check=True,
+            stdout=subprocess.PIPE,
+        ).stdout
+        results.extend(json.loads(output))
+    from foxcross import __version__
+
+    report = {
+        "foxcross_version": __version__,
+        "python_version": platform.python_version(),
+        "platform": platform.platform(),
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "results": results,
+    }
+    passed = True
+    if args.baseline:
+        passed = _compare(results, args.baseline, args.max_regression)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+    return 0 if passed else 1
+
+
+if __name__ == "__main__":
+    exit(main())
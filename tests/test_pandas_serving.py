@@ -1,17 +1,31 @@
+import asyncio
 import os
 import re
 from pathlib import Path
 from typing import Dict, Union
 
+import numpy
 import pytest
 from slugify import slugify
 from starlette.testclient import TestClient
 
+from foxcross.batch import run_batch
 from foxcross.constants import SLUGIFY_REGEX, SLUGIFY_REPLACE
-from foxcross.enums import MediaTypes
-from foxcross.pandas_serving import DataFrameModelServing, compose_pandas
+from foxcross.enums import JSONCodecs, MediaTypes
+from foxcross import pandas_serving
+from foxcross.exceptions import SchemaValidationError
+from foxcross.json_codecs import available_json_codecs
+from foxcross.pandas_serving import (
+    DataFrameModelServing,
+    _binary_readers,
+    _binary_writers,
+    _dataframe_to_json,
+    compose_pandas,
+    pyarrow,
+)
+from foxcross.schema import ColumnSchema, DataFrameSchema
 
-from .test_serving import AddOneModel, add_one_data, add_one_result_data
+from .test_serving import AddOneModel, _import_time, add_one_data, add_one_result_data
 
 try:
     import modin.pandas as pandas
@@ -94,6 +108,21 @@ class InterpolateMultiFrameModelServing(DataFrameModelServing):
         return {key: self.model.interpolate(value) for key, value in data.items()}
 
 
+class BatchFillNaModelServing(DataFrameModelServing):
+    test_data_path = interpolate_data_path
+    batch_max_size = 2
+    batch_max_wait_ms = 50
+
+    def load_model(self):
+        self.batch_sizes = []
+
+    def predict(
+        self, data: Union[pandas.DataFrame, Dict[str, pandas.DataFrame]]
+    ) -> Union[pandas.DataFrame, Dict[str, pandas.DataFrame]]:
+        self.batch_sizes.append(len(data))
+        return data.fillna(0)
+
+
 @pytest.mark.parametrize(
     "model_serving,input_data,expected,endpoint",
     [
@@ -297,3 +326,452 @@ def test_format_output_attribute_error():
     client = TestClient(app)
     response = client.get("/predict-test/")
     assert response.status_code == 500
+
+
+def test_batched_dataframe_predictions():
+    app = BatchFillNaModelServing(debug=True)
+    first = pandas.DataFrame(interpolate_data)
+    second = pandas.DataFrame(
+        {column: [None, 2.0] for column in first.columns}, index=["x", "y"]
+    )
+
+    async def predict_concurrently():
+        return await asyncio.gather(
+            app._run_prediction(first), app._run_prediction(second)
+        )
+
+    results = asyncio.new_event_loop().run_until_complete(predict_concurrently())
+    assert app.batch_sizes == [len(first) + len(second)]
+    assert results[0].equals(first.fillna(0))
+    assert list(results[1].index) == ["x", "y"]
+    assert results[1]["A"].tolist() == [0, 2.0]
+
+
+def test_batched_dataframe_predictions_split_by_schema():
+    app = BatchFillNaModelServing(debug=True)
+    floats = pandas.DataFrame({"A": [None]})
+    other_columns = pandas.DataFrame({"B": [None]})
+    ints = pandas.DataFrame({"A": [1]})
+
+    async def predict_concurrently():
+        return await asyncio.gather(
+            *(app._run_prediction(frame) for frame in (floats, other_columns, ints))
+        )
+
+    results = asyncio.new_event_loop().run_until_complete(predict_concurrently())
+    assert app.batch_sizes == [1, 1, 1]
+    assert list(results[1].columns) == ["B"]
+    assert results[2]["A"].dtype == "int64"
+
+
+requires_pyarrow = pytest.mark.skipif(pyarrow is None, reason="requires pyarrow")
+
+
+@pytest.mark.parametrize(
+    "media_type",
+    [
+        MediaTypes.NUMPY,
+        pytest.param(MediaTypes.ARROW_STREAM, marks=requires_pyarrow),
+        pytest.param(MediaTypes.PARQUET, marks=requires_pyarrow),
+    ],
+)
+def test_binary_media_types(media_type):
+    app = InterpolateModelServing(debug=True)
+    client = TestClient(app)
+    response = client.post(
+        "/predict/",
+        headers={"Accept": media_type.value, "Content-Type": media_type.value},
+        data=_binary_writers[media_type](pandas.DataFrame(interpolate_data)),
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"] == media_type.value
+    result = _binary_readers[media_type](response.content)
+    expected = pandas.DataFrame.from_dict(interpolate_result_data, orient="index")
+    assert list(result.columns) == list(expected.columns)
+    assert result.values.tolist() == expected.values.tolist()
+
+
+@pytest.mark.parametrize(
+    "accept,media_type",
+    [
+        ("application/json, application/x-npy;q=0.1", MediaTypes.JSON),
+        ("application/x-npy, application/json", MediaTypes.NUMPY),
+        ("application/json;q=0.5, application/*", MediaTypes.NUMPY),
+    ],
+)
+def test_response_media_type_q_values(accept, media_type):
+    app = InterpolateModelServing(debug=True)
+    client = TestClient(app)
+    response = client.post(
+        "/predict/",
+        headers={"Accept": accept, "Content-Type": MediaTypes.JSON.value},
+        json=interpolate_data,
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"] == media_type.value
+
+
+def test_binary_input_json_output():
+    app = InterpolateModelServing(debug=True)
+    client = TestClient(app)
+    response = client.post(
+        "/predict/",
+        headers={
+            "Accept": MediaTypes.JSON.value,
+            "Content-Type": MediaTypes.NUMPY.value,
+        },
+        data=_binary_writers[MediaTypes.NUMPY](pandas.DataFrame(interpolate_data)),
+    )
+    assert response.status_code == 200
+    assert response.json() == interpolate_result_data
+
+
+def test_bad_binary_input():
+    app = InterpolateModelServing(debug=True)
+    client = TestClient(app)
+    response = client.post(
+        "/predict/",
+        headers={
+            "Accept": MediaTypes.JSON.value,
+            "Content-Type": MediaTypes.NUMPY.value,
+        },
+        data=b"not numpy",
+    )
+    assert response.status_code == 400
+
+
+def test_binary_output_multi_dataframe():
+    app = InterpolateMultiFrameModelServing(debug=True)
+    client = TestClient(app)
+    response = client.post(
+        "/predict/",
+        headers={"Accept": MediaTypes.NUMPY.value},
+        json=interpolate_multi_frame_data,
+    )
+    assert response.status_code == 406
+
+
+def test_multi_dataframe_threads():
+    app = type(
+        "ThreadedMultiFrameModelServing",
+        (InterpolateMultiFrameModelServing,),
+        {"multi_dataframe_threads": 4},
+    )(debug=True)
+    with TestClient(app) as client:
+        response = client.post(
+            "/predict/",
+            headers={"Accept": MediaTypes.JSON.value},
+            json=interpolate_multi_frame_data,
+        )
+        assert response.status_code == 200
+        assert response.json() == interpolate_multi_frame_result_data
+        assert app._frame_executor is not None
+        frames = app._format_input(interpolate_multi_frame_data)
+        assert list(frames) == ["one", "two"]
+        assert app._format_output(frames) == InterpolateMultiFrameModelServing(
+            debug=True
+        )._format_output(frames)
+    assert app._frame_executor is None
+
+
+@requires_pyarrow
+@pytest.mark.parametrize("threads", [None, 2])
+def test_multi_dataframe_key_column(threads):
+    app = type(
+        "KeyColumnModelServing",
+        (InterpolateMultiFrameModelServing,),
+        {"multi_dataframe_key_column": "frame", "multi_dataframe_threads": threads},
+    )(debug=True)
+    frames = {
+        key: pandas.DataFrame(value)
+        for key, value in interpolate_multi_frame_data.items()
+        if key != "multi_dataframe"
+    }
+    frames["two"] = frames["two"].iloc[1:]
+    write = _binary_writers[MediaTypes.ARROW_STREAM]
+    client = TestClient(app)
+    response = client.post(
+        "/predict/",
+        headers={
+            "Accept": MediaTypes.ARROW_STREAM.value,
+            "Content-Type": MediaTypes.ARROW_STREAM.value,
+        },
+        data=write(app._concat_frames(frames)),
+    )
+    assert response.status_code == 200
+    result = _binary_readers[MediaTypes.ARROW_STREAM](response.content)
+    assert list(result.columns) == ["frame", "A", "B", "C", "D"]
+    for key, frame in frames.items():
+        expected = frame.interpolate(limit_direction="forward")
+        actual = result[result["frame"] == key].drop(columns="frame")
+        assert actual.index.tolist() == frame.index.tolist()
+        pandas.testing.assert_frame_equal(actual, expected, check_dtype=False)
+
+
+output_frame = pandas.DataFrame(
+    {
+        "A": [12.0, None, 0.1, -3.5e-3, 123456789.125],
+        "B": [1, 2, 3, 4, 5],
+        "C": ["a/b", None, "c", "d", "e"],
+        "D": [True, False, True, False, True],
+    },
+    index=["v", "w", "x", "y", "z"],
+)
+
+
+@pytest.mark.parametrize("orient", ["index", "dict", "records", "split"])
+@pytest.mark.parametrize(
+    "frame",
+    [
+        output_frame,
+        output_frame.reset_index(drop=True),
+        pandas.DataFrame(interpolate_data),
+        pandas.DataFrame({"A": [0.1 + 0.2, 1e-9, 1e20]}),
+        pandas.DataFrame({"A": pandas.Series(["a", 0.1 + 0.2], dtype=object)}),
+        pandas.DataFrame({"A": [{"nested": 0.1 + 0.2}, None]}),
+        pandas.DataFrame({"A": [1, 2]}, index=[0.5, 0.1 + 0.2]),
+        pandas.DataFrame([[1, 2]], columns=[0.5, 0.1 + 0.2]),
+        pandas.DataFrame({"A": pandas.Categorical([0.1 + 0.2, 1.0])}),
+        pandas.DataFrame({"A": [1, 2]}, index=pandas.CategoricalIndex([0.1 + 0.2, 1.0])),
+    ],
+)
+def test_json_output_matches_to_dict(orient, frame):
+    app = InterpolateModelServing(debug=True)
+    app.pandas_orient = orient
+    expected = json.loads(json.dumps(app._format_output(frame)))
+    response = app._encode_json_output(frame)
+    assert json.loads(response.body) == expected
+
+
+def test_json_output_fast_path():
+    assert _dataframe_to_json(output_frame, "index") is not None
+    assert _dataframe_to_json(output_frame, "list") is None
+    assert _dataframe_to_json(pandas.DataFrame({"A": [0.1 + 0.2]}), "index") is None
+    assert (
+        _dataframe_to_json(pandas.DataFrame({"A": [1]}, index=[0.1 + 0.2]), "split")
+        is None
+    )
+    assert _dataframe_to_json(pandas.DataFrame({"A": [{"nested": 0.5}]}), "index") is None
+    assert (
+        _dataframe_to_json(
+            pandas.DataFrame({"A": pandas.date_range("2020", periods=2)}), "index"
+        )
+        is None
+    )
+
+
+def test_predict_stream_dataframe():
+    app = BatchFillNaModelServing(debug=True)
+    app.stream_chunk_size = 2
+    client = TestClient(app)
+    frame = pandas.DataFrame(interpolate_data)
+    response = client.post(
+        "/predict-stream/",
+        headers={
+            "Accept": MediaTypes.NDJSON.value,
+            "Content-Type": MediaTypes.NDJSON.value,
+        },
+        data=frame.to_json(orient="records", lines=True),
+    )
+    assert response.status_code == 200
+    assert app.batch_sizes == [2, 2, 1]
+    results = [json.loads(line) for line in response.text.splitlines()]
+    assert results == frame.fillna(0).to_dict(orient="records")
+
+
+@pytest.mark.parametrize("codec", [JSONCodecs.ORJSON, JSONCodecs.JSON])
+def test_predict_returns_numpy(codec):
+    if codec not in available_json_codecs():
+        pytest.skip(f"{codec.value} is not installed")
+    model_serving = type(
+        "NumpyModel",
+        (AddOneModel,),
+        {"json_codec": codec, "predict": lambda self, data: numpy.array(data) + 1},
+    )
+    client = TestClient(model_serving())
+    response = client.post(
+        "/predict/", headers={"Accept": MediaTypes.JSON.value}, json=add_one_data
+    )
+    assert response.status_code == 200
+    assert response.json() == add_one_result_data
+
+    # Non-contiguous arrays and numpy scalars fall back to tolist
+    model_serving.predict = lambda self, data: {
+        "columns": numpy.array([data, data]).T[:, 0],
+        "total": numpy.int64(sum(data)),
+    }
+    response = client.post(
+        "/predict/", headers={"Accept": MediaTypes.JSON.value}, json=add_one_data
+    )
+    assert response.json() == {"columns": add_one_data, "total": sum(add_one_data)}
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+@pytest.mark.parametrize("output_format", ["ndjson", "csv", "parquet"])
+@pytest.mark.parametrize("input_format", ["csv", "parquet"])
+def test_batch_dataframe(input_format, output_format, workers, tmp_path):
+    if pyarrow is None and "parquet" in (input_format, output_format):
+        pytest.skip("pyarrow is not installed")
+    frame = pandas.DataFrame({"a": [1.0, None, 3.0, None, 5.0], "b": range(5)})
+    input_path = tmp_path / f"input.{input_format}"
+    output_path = tmp_path / f"output.{output_format}"
+    if input_format == "csv":
+        frame.to_csv(input_path, index=False)
+    else:
+        frame.to_parquet(input_path, index=False)
+    summary = run_batch(
+        input_path,
+        output_path,
+        module_name=__name__,
+        model="BatchFillNaModelServing",
+        chunk_size=2,
+        workers=workers,
+    )
+    assert summary["rows"] == 5
+    assert summary["chunks"] == 3
+    if output_format == "ndjson":
+        results = pandas.read_json(output_path, lines=True)
+    elif output_format == "csv":
+        results = pandas.read_csv(output_path)
+    else:
+        results = pandas.read_parquet(output_path)
+    assert results.to_dict(orient="records") == frame.fillna(0).to_dict(orient="records")
+
+
+class _ModinDataFrame(pandas_serving.pandas.DataFrame):
+    """Stands in for modin's DataFrame, which is converted back with _to_pandas"""
+
+    def _to_pandas(self):
+        return pandas_serving.pandas.DataFrame(self)
+
+
+def test_modin_min_rows(monkeypatch):
+    monkeypatch.setattr(
+        pandas_serving, "modin_pandas", type("modin", (), {"DataFrame": _ModinDataFrame})
+    )
+    app = type(
+        "ModinThresholdModel",
+        (InterpolateModelServing,),
+        {
+            "modin_min_rows": 3,
+            "predict": lambda self, data: self.frame_types.append(type(data)) or data,
+        },
+    )()
+    app.frame_types = []
+    client = TestClient(app)
+    for rows in (2, 3):
+        data = {"A": {str(x): float(x) for x in range(rows)}}
+        response = client.post(
+            "/predict/", headers={"Accept": MediaTypes.JSON.value}, json=data
+        )
+        assert response.status_code == 200
+        assert response.json() == {key: {"A": value} for key, value in data["A"].items()}
+    assert app.frame_types == [pandas_serving.pandas.DataFrame, _ModinDataFrame]
+
+    app.modin_min_rows = None
+    frame = app._format_frame_chunk(_ModinDataFrame({"A": range(5)}))
+    assert type(frame) is pandas_serving.pandas.DataFrame
+
+
+def test_dataframe_schema():
+    frame = pandas.DataFrame(
+        {"a": [1, 2], "b": [0.5, None], "c": ["x", "y"], "d": [True, False]}
+    )
+    schema = DataFrameSchema.infer(frame)
+    assert schema.columns["a"] == ColumnSchema(numpy.dtype("int64"), False)
+    assert schema.columns["b"].nullable is True
+    assert schema.coerce(frame) is frame
+
+    coerced = schema.coerce(
+        pandas.DataFrame(
+            {
+                "a": ["3", 4.0],
+                "b": ["1.5", None],
+                "c": ["z", "w"],
+                "d": pandas.Series([True, False], dtype=object),
+            }
+        )
+    )
+    assert coerced["a"].tolist() == [3, 4]
+    assert coerced["a"].dtype == "int64"
+    assert coerced["b"].dtype == "float64"
+    assert coerced["d"].dtype == bool
+
+    for data, message in [
+        ({"a": [1], "b": [1.0], "c": ["x"]}, "Missing columns: d"),
+        ({"a": [None], "b": [1.0], "c": ["x"], "d": [True]}, "must not have null"),
+        ({"a": ["one"], "b": [1.0], "c": ["x"], "d": [True]}, "must be numeric"),
+        ({"a": [1.5], "b": [1.0], "c": ["x"], "d": [True]}, "must be integers"),
+        ({"a": [1], "b": [1.0], "c": ["x"], "d": ["false"]}, "must be booleans"),
+        ({"a": [1], "b": [1.0], "c": ["x"], "d": [1]}, "must be booleans"),
+    ]:
+        with pytest.raises(SchemaValidationError, match=message):
+            schema.coerce(pandas.DataFrame(data))
+
+    strict_schema = DataFrameSchema(
+        {"a": "int64", "when": ColumnSchema("datetime64[ns]")}, strict=True
+    )
+    coerced = strict_schema.coerce(pandas.DataFrame({"a": [1], "when": ["2020-01-02"]}))
+    assert coerced["when"].dtype == "datetime64[ns]"
+    with pytest.raises(SchemaValidationError, match="Unexpected columns: b"):
+        strict_schema.coerce(pandas.DataFrame({"a": [1], "when": [None], "b": [2]}))
+    with pytest.raises(TypeError):
+        DataFrameSchema({"a": "not-a-dtype"})
+
+
+def test_infer_input_schema():
+    app = type(
+        "SchemaModel",
+        (InterpolateModelServing,),
+        {
+            "infer_input_schema": True,
+            "predict": lambda self, data: data.dtypes.astype(str).to_frame("dtype"),
+        },
+    )()
+    assert set(app._input_schema.columns) == {"A", "B", "C", "D"}
+    client = TestClient(app)
+    headers = {"Accept": MediaTypes.JSON.value}
+    data = {"A": ["1", "2"], "B": [1, None], "C": [3, 4], "D": [5.5, 6]}
+    response = client.post("/predict/", headers=headers, json=data)
+    assert response.status_code == 200
+    assert response.json() == {column: {"dtype": "float64"} for column in data}
+    assert client.post("/predict-test/", headers=headers).status_code == 200
+
+    response = client.post("/predict/", headers=headers, json={"A": ["x"]})
+    assert response.status_code == 400
+    assert response.text == "Missing columns: B, C, D"
+    data["A"] = ["1", "x"]
+    response = client.post("/predict/", headers=headers, json=data)
+    assert response.text == "Column A must be numeric but has 'x'"
+
+
+def test_infer_multi_frame_input_schema():
+    app = type(
+        "MultiFrameSchemaModel",
+        (InterpolateMultiFrameModelServing,),
+        {"infer_input_schema": True},
+    )()
+    assert set(app._input_schema) == {"one", "two"}
+    client = TestClient(app)
+    headers = {"Accept": MediaTypes.JSON.value}
+    response = client.post(
+        "/predict/", headers=headers, json=interpolate_multi_frame_data
+    )
+    assert response.json() == interpolate_multi_frame_result_data
+
+    data = {"multi_dataframe": True, "one": interpolate_multi_frame_data["one"]}
+    response = client.post("/predict/", headers=headers, json=data)
+    assert response.text == "Missing DataFrames: two"
+    data["three"] = {"A": [1]}
+    response = client.post("/predict/", headers=headers, json=data)
+    assert response.text == "Unexpected DataFrame three"
+    response = client.post("/predict/", headers=headers, json=interpolate_data)
+    assert response.text == "Expected a multi_dataframe input"
+
+
+def test_pandas_import_time_budget():
+    # modin is only imported for DataFrames of at least modin_min_rows rows
+    budget = 3
+    assert (
+        _import_time("foxcross.pandas_serving", ("jinja2", "uvicorn", "modin")) < budget
+    )
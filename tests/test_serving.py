@@ -1,17 +1,47 @@
+import asyncio
+import gzip
+import multiprocessing
 import os
+import pickle
+import pstats
 import re
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
 from pathlib import Path
 from typing import Any
 
 import pytest
 import requests
+import uvicorn
 from slugify import slugify
+from starlette.exceptions import HTTPException
 from starlette.testclient import TestClient
 
+from foxcross.admission import AdmissionController, ServiceUnavailableException
+from foxcross.batch import find_batch_model_serving, run_batch
+from foxcross.caching import ResultCache
+from foxcross.coalescing import RequestCoalescer
+from foxcross.compression import negotiate_encoding
 from foxcross.constants import SLUGIFY_REGEX, SLUGIFY_REPLACE
-from foxcross.enums import MediaTypes
-from foxcross.exceptions import PostProcessingError, PredictionError, PreProcessingError
+from foxcross.cli import main
+from foxcross.enums import ExecutionModes, JSONCodecs, MediaTypes
+from foxcross.exceptions import (
+    BatchPredictionError,
+    NoModelServingFoundError,
+    PostProcessingError,
+    PredictionError,
+    PreProcessingError,
+    exception_name,
+)
+from foxcross.executors import _WorkerHTTPException
+from foxcross.json_codecs import available_json_codecs, get_json_codec
+from foxcross.negotiation import ContentNegotiator
 from foxcross.serving import ModelServing, ModelServingRunner, compose_models
+from foxcross.workers import WorkerSupervisor
 
 try:
     import ujson as json
@@ -107,6 +137,156 @@ class AddFiveModel(ModelServing):
         return self.model.add(data)
 
 
+class ThreadAddOneModel(AddOneModel):
+    execution_mode = ExecutionModes.THREAD
+    max_workers = 2
+
+
+class ProcessAddFiveModel(AddFiveModel):
+    execution_mode = "process"
+    max_workers = 1
+
+    def predict(self, data: Any) -> Any:
+        try:
+            return super().predict(data)
+        except TypeError:
+            raise PredictionError("Must be a list")
+
+
+class AsyncAddOneModel(ModelServing):
+    test_data_path = add_one_data_path
+
+    async def predict(self, data: Any) -> Any:
+        await asyncio.sleep(0)
+        try:
+            return [x + 1 for x in data]
+        except TypeError:
+            raise PredictionError("Must be a list")
+
+
+class BatchAddOneModel(AddOneModel):
+    batch_max_size = 3
+    batch_max_wait_ms = 50
+
+    def load_model(self):
+        self.batch_sizes = []
+
+    def predict(self, data: Any) -> Any:
+        if isinstance(data, list):
+            self.batch_sizes.append(len(data))
+        return super().predict(data)
+
+
+class SmallBatchQueueModel(AddOneModel):
+    batch_max_size = 1
+    batch_max_queue_size = 2
+
+
+class CachedPredictTestModel(AddOneModel):
+    predict_test_cache_ttl = 60
+
+    def load_model(self):
+        self.predict_calls = 0
+
+    def predict(self, data: Any) -> Any:
+        self.predict_calls += 1
+        return super().predict(data)
+
+
+class MutatingHookModel(AddOneModel):
+    def pre_process_input(self, data: Any) -> Any:
+        data.append(0)
+        return data
+
+
+class AdmissionModel(AddOneModel):
+    max_in_flight = 1
+    max_queue_length = 1
+    retry_after_seconds = 3
+
+    def load_model(self):
+        self.release_predictions = None
+
+    async def predict(self, data: Any) -> Any:
+        await self.release_predictions.wait()
+        return [x + 1 for x in data]
+
+
+class CoalescingModel(AdmissionModel):
+    max_in_flight = None
+    coalesce_requests = True
+
+    def load_model(self):
+        super().load_model()
+        self.predict_calls = 0
+
+    async def predict(self, data: Any) -> Any:
+        self.predict_calls += 1
+        return await super().predict(data)
+
+
+class ResultCacheModel(CachedPredictTestModel):
+    predict_test_cache_ttl = None
+    result_cache_size = 2
+
+
+class NonDeterministicModel(ResultCacheModel):
+    deterministic = False
+
+
+class BarrierModel(ModelServing):
+    test_data_path = add_one_data_path
+    execution_mode = ExecutionModes.THREAD
+    max_workers = 2
+
+    def load_model(self):
+        self.barrier = threading.Barrier(2, timeout=5)
+
+    def predict(self, data: Any) -> Any:
+        # Fails with BrokenBarrierError unless two predictions run concurrently
+        self.barrier.wait()
+        return data
+
+
+class LoadBarrierModel(AddOneModel):
+    load_barrier = None
+
+    def load_model(self):
+        if self.load_barrier is not None:
+            self.load_barrier.wait()
+
+
+class OtherLoadBarrierModel(LoadBarrierModel):
+    pass
+
+
+class ReloadModel(AddOneModel):
+    reload_endpoint = True
+    increment = 1
+    fail_predictions = False
+    release_predictions = None
+
+    def load_model(self):
+        self.offset = type(self).increment
+
+    async def predict(self, data):
+        if self.release_predictions is not None:
+            await self.release_predictions.wait()
+        if type(self).fail_predictions:
+            raise ValueError("broken model")
+        return [x + self.offset for x in data]
+
+
+class ProfiledModel(AddOneModel):
+    profile_header = "X-Profile"
+
+
+class CompressedModel(AddOneModel):
+    compression_minimum_size = 1
+    compression_encodings = ("gzip",)
+    max_decompressed_request_bytes = 100
+
+
 @pytest.mark.parametrize(
     "model_serving,input_data,expected,endpoint",
     [
@@ -116,6 +296,11 @@ class AddFiveModel(ModelServing):
         (AddFiveModel, None, add_five_data, "/input-format/"),
         (AddOneModel, add_one_data, add_one_result_data, "/predict-test/"),
         (AddFiveModel, add_five_data, add_five_result_data, "/predict-test/"),
+        (ThreadAddOneModel, add_one_data, add_one_result_data, "/predict/"),
+        (ProcessAddFiveModel, add_five_data, add_five_result_data, "/predict/"),
+        (AsyncAddOneModel, add_one_data, add_one_result_data, "/predict/"),
+        (AsyncAddOneModel, add_one_data, add_one_result_data, "/predict-test/"),
+        (BatchAddOneModel, add_one_data, add_one_result_data, "/predict/"),
     ],
 )
 def test_endpoints_single_model_serving(model_serving, input_data, expected, endpoint):
@@ -228,9 +413,27 @@ def test_single_model_compose():
             PreProcessErrorModel,
             PostProcessErrorModel,
             StatusCodeOverrideModel,
+            ThreadAddOneModel,
+            ProcessAddFiveModel,
+            AsyncAddOneModel,
+            BarrierModel,
+            BatchAddOneModel,
+            SmallBatchQueueModel,
+            CachedPredictTestModel,
+            MutatingHookModel,
+            AdmissionModel,
+            CoalescingModel,
+            LoadBarrierModel,
+            OtherLoadBarrierModel,
+            CompressedModel,
+            ReloadModel,
+            ProfiledModel,
+            ResultCacheModel,
+            NonDeterministicModel,
         ),
     )
     app = runner.compose(__name__)
+    assert app.setup_time > 0
     client = TestClient(app)
     add_one_response = client.post(
         "/predict/", headers={"Accept": MediaTypes.JSON.value}, json=add_one_data
@@ -355,3 +558,1301 @@ def test_multi_model_html_responses(endpoint):
         f"{add_five_slugified}{endpoint}", headers={"Accept": MediaTypes.HTML.value}
     )
     assert add_five_response.status_code == 200
+
+
+@pytest.mark.parametrize("model_serving", [ThreadAddOneModel, ProcessAddFiveModel])
+def test_executor_prediction_error(model_serving):
+    with TestClient(model_serving(debug=True)) as client:
+        response = client.post(
+            "/predict/", headers={"Accept": MediaTypes.JSON.value}, json=1
+        )
+    assert response.status_code == 400
+
+
+def test_async_predict_error():
+    app = AsyncAddOneModel(debug=True)
+    client = TestClient(app)
+    response = client.post("/predict/", headers={"Accept": MediaTypes.JSON.value}, json=1)
+    assert response.status_code == 400
+    assert response.content == b"Must be a list"
+
+
+def test_thread_execution_runs_concurrently():
+    app = BarrierModel(debug=True)
+
+    async def predict_concurrently():
+        return await asyncio.gather(app._run_prediction([1]), app._run_prediction([2]))
+
+    assert asyncio.new_event_loop().run_until_complete(predict_concurrently()) == [
+        [1],
+        [2],
+    ]
+    app._shutdown_executor()
+
+
+def test_batched_predictions():
+    app = BatchAddOneModel(debug=True)
+
+    async def predict_concurrently():
+        return await asyncio.gather(
+            *(app._run_prediction(data) for data in ([1], [2, 3], [4], [5, 6]))
+        )
+
+    results = asyncio.new_event_loop().run_until_complete(predict_concurrently())
+    assert results == [[2], [3, 4], [5], [6, 7]]
+    assert app.batch_sizes == [4, 2]
+
+
+def test_batched_prediction_error():
+    app = BatchAddOneModel(debug=True)
+    with pytest.raises(HTTPException) as exc_info:
+        asyncio.new_event_loop().run_until_complete(app._run_prediction(1))
+    assert exc_info.value.status_code == 400
+
+
+def test_batch_queue_full():
+    app = SmallBatchQueueModel(debug=True)
+
+    async def predict_concurrently():
+        return await asyncio.gather(
+            *(app._run_prediction([x]) for x in range(3)), return_exceptions=True
+        )
+
+    # The running batch still counts toward the queue size
+    results = asyncio.new_event_loop().run_until_complete(predict_concurrently())
+    assert results[:2] == [[1], [2]]
+    assert results[2].status_code == 503
+    assert app._batcher.queue_depth == 0
+
+
+def test_test_data_cache(tmpdir):
+    data_path = Path(tmpdir / "test_data.json")
+    data_path.write_text("[1, 2]")
+    app = CachedPredictTestModel(debug=True)
+    app.test_data_path = str(data_path)
+    client = TestClient(app)
+    headers = {"Accept": MediaTypes.JSON.value}
+
+    assert client.post("/input-format/", headers=headers).json() == [1, 2]
+    assert client.post("/predict-test/", headers=headers).json() == [2, 3]
+    assert client.post("/predict-test/", headers=headers).json() == [2, 3]
+    assert app.predict_calls == 1
+
+    data_path.write_text("[1, 2, 3]")
+    os.utime(str(data_path), ns=(0, 0))
+    assert client.post("/input-format/", headers=headers).json() == [1, 2, 3]
+    assert client.post("/predict-test/", headers=headers).json() == [2, 3, 4]
+    assert app.predict_calls == 2
+
+
+def test_result_cache():
+    app = ResultCacheModel(debug=True)
+    client = TestClient(app)
+    headers = {"Accept": MediaTypes.JSON.value}
+    for _ in range(3):
+        response = client.post("/predict/", headers=headers, json=add_one_data)
+        assert response.status_code == 200
+        assert response.json() == add_one_result_data
+    assert app.predict_calls == 1
+    assert (app.result_cache.hits, app.result_cache.misses) == (2, 1)
+
+    response = client.post("/predict/", headers=headers, json=[1])
+    assert response.json() == [2]
+    assert app.predict_calls == 2
+
+    client.post("/input-format/", headers=headers)
+    client.post("/input-format/", headers=headers)
+    text = client.get("/metrics/").text
+    labels = '{model_name="Result-Cache-Model"}'
+    assert _metric_value(text, f"foxcross_result_cache_hits_total{labels}") == 2
+    assert _metric_value(text, f"foxcross_result_cache_misses_total{labels}") == 2
+    assert _metric_value(text, f"foxcross_result_cache_evictions_total{labels}") == 0
+    assert _metric_value(text, f"foxcross_result_cache_entries{labels}") == 2
+    assert (
+        _metric_value(text, f"foxcross_result_cache_bytes{labels}")
+        == app.result_cache.size_bytes
+    )
+    assert "# TYPE foxcross_result_cache_hits_total counter" in text
+    assert _metric_value(text, f"foxcross_compression_cache_hits_total{labels}") == (
+        app.compression_cache.hits
+    )
+    assert _metric_value(text, f"foxcross_compression_cache_entries{labels}") == len(
+        app.compression_cache
+    )
+
+
+def test_result_cache_disabled_for_non_deterministic_model():
+    app = NonDeterministicModel(debug=True)
+    client = TestClient(app)
+    headers = {"Accept": MediaTypes.JSON.value}
+    for _ in range(2):
+        client.post("/predict/", headers=headers, json=add_one_data)
+    assert app.result_cache is None
+    assert app.predict_calls == 2
+
+
+def test_result_cache_eviction(monkeypatch):
+    cache = ResultCache(max_entries=2, max_bytes=10, ttl=5)
+    cache.set("a", b"1234")
+    cache.set("b", b"1234")
+    assert cache.get("a") == b"1234"
+    cache.set("c", b"1234")
+    assert cache.get("b") is None
+    assert len(cache) == 2
+
+    cache.set("d", b"12345678")
+    assert len(cache) == 1
+    assert cache.size_bytes == 8
+    cache.set("e", b"12345678901")
+    assert cache.get("e") is None
+
+    monkeypatch.setattr("foxcross.caching.time.monotonic", lambda: float("inf"))
+    assert cache.get("d") is None
+    assert cache.size_bytes == 0
+
+
+def _child_pids(pid):
+    with open(f"/proc/{pid}/task/{pid}/children") as f:
+        return [int(child_pid) for child_pid in f.read().split()]
+
+
+def _wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if condition():
+                return True
+        except (OSError, requests.ConnectionError):
+            pass
+        time.sleep(0.1)
+    return False
+
+
+@pytest.mark.skipif(not sys.platform.startswith("linux"), reason="requires /proc")
+def test_worker_supervisor_restarts_workers():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    config = uvicorn.Config(AddOneModel(), host="127.0.0.1", port=port)
+    supervisor = WorkerSupervisor(config, workers=2, sock=sock, restart_delay=0)
+    process = multiprocessing.get_context("fork").Process(target=supervisor.run)
+    process.start()
+    try:
+        url = f"http://127.0.0.1:{port}/predict/"
+        assert _wait_for(
+            lambda: requests.post(
+                url, headers={"Accept": MediaTypes.JSON.value}, json=add_one_data
+            ).json()
+            == add_one_result_data
+        )
+        assert _wait_for(lambda: len(_child_pids(process.pid)) == 2)
+        crashed_pid = _child_pids(process.pid)[0]
+        os.kill(crashed_pid, signal.SIGKILL)
+        assert _wait_for(
+            lambda: len(_child_pids(process.pid)) == 2
+            and crashed_pid not in _child_pids(process.pid)
+        )
+    finally:
+        os.kill(process.pid, signal.SIGTERM)
+        process.join(timeout=10)
+        if process.is_alive():
+            process.kill()
+            process.join()
+        sock.close()
+    assert process.exitcode == 0
+
+
+async def _failing_startup_app(scope, receive, send):
+    assert scope["type"] == "lifespan"
+    await receive()
+    await send({"type": "lifespan.startup.failed", "message": "broken model"})
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="requires os.fork")
+def test_worker_supervisor_stops_crash_loop():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    config = uvicorn.Config(_failing_startup_app, lifespan="on")
+    supervisor = WorkerSupervisor(
+        config, workers=1, sock=sock, restart_delay=0.01, max_restarts=2
+    )
+    process = multiprocessing.get_context("fork").Process(
+        target=lambda: sys.exit(supervisor.run())
+    )
+    process.start()
+    process.join(timeout=30)
+    if process.is_alive():
+        process.kill()
+        process.join()
+    sock.close()
+    assert process.exitcode == 1
+
+
+def test_predict_stream():
+    app = AddOneModel(debug=True)
+    app.stream_chunk_size = 2
+    client = TestClient(app)
+    headers = {"Accept": MediaTypes.NDJSON.value, "Content-Type": MediaTypes.NDJSON.value}
+    response = client.post("/predict-stream/", headers=headers, data=b"1\n2\n\n3\n4\n5")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == MediaTypes.NDJSON.value
+    assert [json.loads(line) for line in response.text.splitlines()] == [2, 3, 4, 5, 6]
+
+    response = client.post("/predict-stream/", headers=headers, data=b"")
+    assert response.status_code == 200
+    assert response.content == b""
+
+
+@pytest.mark.parametrize(
+    "body,content_type,status_code",
+    [
+        (b"1\n{bad", MediaTypes.NDJSON.value, 400),
+        (b'"a"\n', MediaTypes.NDJSON.value, 400),
+        (b"1\n", MediaTypes.JSON.value, 415),
+    ],
+)
+def test_predict_stream_errors(body, content_type, status_code):
+    app = AddOneModel(debug=True)
+    client = TestClient(app)
+    response = client.post(
+        "/predict-stream/",
+        headers={"Accept": MediaTypes.NDJSON.value, "Content-Type": content_type},
+        data=body,
+    )
+    assert response.status_code == status_code
+
+
+def test_predict_stream_error_after_first_chunk():
+    app = AddOneModel(debug=True)
+    app.stream_chunk_size = 1
+    client = TestClient(app)
+    response = client.post(
+        "/predict-stream/",
+        headers={
+            "Accept": MediaTypes.NDJSON.value,
+            "Content-Type": MediaTypes.NDJSON.value,
+        },
+        data=b'1\n"a"\n3\n',
+    )
+    assert response.status_code == 200
+    assert [json.loads(line) for line in response.text.splitlines()] == [
+        2,
+        {"error": {"status_code": 400, "detail": "Must be a list"}},
+    ]
+
+
+def test_predict_stream_html():
+    app = AddOneModel(debug=True)
+    client = TestClient(app)
+    response = client.get("/predict-stream/", headers={"Accept": MediaTypes.HTML.value})
+    assert response.status_code == 200
+    assert "NDJSON" in response.text
+
+
+def test_multi_model_serving_shuts_down_executors():
+    app = compose_models(__name__, debug=True)
+    thread_app = next(
+        route.app for route in app.routes if isinstance(route.app, ThreadAddOneModel)
+    )
+    with TestClient(app) as client:
+        thread_slugified = slugify(
+            re.sub(SLUGIFY_REGEX, SLUGIFY_REPLACE, ThreadAddOneModel.__name__)
+        )
+        response = client.post(
+            f"{thread_slugified}/predict/",
+            headers={"Accept": MediaTypes.JSON.value},
+            json=add_one_data,
+        )
+        assert response.status_code == 200
+        assert thread_app._executor is not None
+    assert thread_app._executor is None
+
+
+def test_predict_test_hooks_do_not_mutate_cached_test_data():
+    app = MutatingHookModel(debug=True)
+    client = TestClient(app)
+    headers = {"Accept": MediaTypes.JSON.value}
+    for _ in range(2):
+        response = client.post("/predict-test/", headers=headers)
+        assert response.json() == [x + 1 for x in add_one_data] + [1]
+    assert client.post("/input-format/", headers=headers).json() == add_one_data
+
+
+def _metric_value(text, sample):
+    for line in text.splitlines():
+        if line.startswith(sample + " "):
+            return float(line.rsplit(" ", 1)[1])
+    return None
+
+
+def test_metrics_endpoint():
+    app = AddOneModel(debug=True)
+    client = TestClient(app)
+    headers = {"Accept": MediaTypes.JSON.value}
+    for _ in range(2):
+        assert client.post("/predict/", headers=headers, json=add_one_data).ok
+    assert client.post("/predict/", headers=headers, json="a").status_code == 400
+    assert client.post("/predict/", headers=headers, data=b"{bad").status_code == 400
+    assert client.get("/missing/").status_code == 404
+
+    response = client.get("/metrics/")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    text = response.text
+    labels = 'model_name="Add-One-Model",path="/predict/"'
+    assert (
+        _metric_value(text, f'foxcross_requests_total{{{labels},status_code="200"}}') == 2
+    )
+    assert (
+        _metric_value(text, f'foxcross_requests_total{{{labels},status_code="400"}}') == 2
+    )
+    assert (
+        _metric_value(
+            text,
+            'foxcross_requests_total{model_name="Add-One-Model",path="other",'
+            'status_code="404"}',
+        )
+        == 1
+    )
+    assert (
+        _metric_value(
+            text,
+            'foxcross_request_errors_total{model_name="Add-One-Model",'
+            'exception="PredictionError",status_code="400"}',
+        )
+        == 1
+    )
+    assert (
+        _metric_value(
+            text,
+            'foxcross_request_errors_total{model_name="Add-One-Model",'
+            'exception="HTTPException",status_code="400"}',
+        )
+        == 1
+    )
+    # The metrics request itself is still being handled
+    assert (
+        _metric_value(text, 'foxcross_requests_in_flight{model_name="Add-One-Model"}')
+        == 1
+    )
+    for stage, count in (
+        ("format_input", 3),
+        ("pre_process_input", 3),
+        ("predict", 2),
+        ("post_process_results", 2),
+        ("serialize_output", 2),
+    ):
+        sample = (
+            f'foxcross_stage_duration_seconds_count{{model_name="Add-One-Model",'
+            f'stage="{stage}"}}'
+        )
+        assert _metric_value(text, sample) == count
+    assert "# TYPE foxcross_stage_duration_seconds histogram" in text
+    assert 'stage="predict",le="+Inf"} 2' in text
+
+
+def test_metrics_process_pool():
+    app = ProcessAddFiveModel(debug=True)
+    client = TestClient(app)
+    response = client.post(
+        "/predict/", headers={"Accept": MediaTypes.JSON.value}, json=add_five_data
+    )
+    assert response.status_code == 200
+    app._shutdown_executor()
+    text = client.get("/metrics/").text
+    assert 'stage="process_pool"' in text
+    assert 'stage="predict"' not in text
+
+    # Errors raised in process pool workers keep the class the model raised
+    exc = pickle.loads(
+        pickle.dumps(_WorkerHTTPException(400, "Must be a list", "PredictionError"))
+    )
+    assert exception_name(exc.to_http_exception()) == "PredictionError"
+
+
+def test_metrics_multi_model_serving():
+    app = compose_models(__name__, debug=True)
+    client = TestClient(app)
+    add_one_slugified = slugify(
+        re.sub(SLUGIFY_REGEX, SLUGIFY_REPLACE, AddOneModel.__name__)
+    )
+    response = client.post(
+        f"{add_one_slugified}/predict/",
+        headers={"Accept": MediaTypes.JSON.value},
+        json=add_one_data,
+    )
+    assert response.status_code == 200
+    text = client.get("/metrics/").text
+    assert text.count("# TYPE foxcross_requests_in_flight gauge") == 1
+    assert 'foxcross_requests_in_flight{model_name="Add-One-Model"} 0' in text
+    assert 'foxcross_requests_in_flight{model_name="Add-Five-Model"} 0' in text
+    assert (
+        _metric_value(
+            text,
+            'foxcross_requests_total{model_name="Add-One-Model",path="/predict/",'
+            'status_code="200"}',
+        )
+        == 1
+    )
+
+
+async def _asgi_request(app, method, path, body=b""):
+    scope = {
+        "type": "http",
+        "http_version": "1.1",
+        "method": method,
+        "path": path,
+        "raw_path": path.encode(),
+        "root_path": "",
+        "scheme": "http",
+        "query_string": b"",
+        "headers": [
+            (b"accept", MediaTypes.JSON.value.encode()),
+            (b"content-type", MediaTypes.JSON.value.encode()),
+        ],
+        "client": ("127.0.0.1", 1),
+        "server": ("testserver", 80),
+    }
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    await app(scope, receive, send)
+    start = messages[0]
+    headers = {key.decode(): value.decode() for key, value in start["headers"]}
+    return start["status"], headers, b"".join(m.get("body", b"") for m in messages[1:])
+
+
+def test_coalesce_requests():
+    app = CoalescingModel(debug=True)
+
+    async def request_concurrently():
+        app.release_predictions = asyncio.Event()
+        requests = [
+            asyncio.ensure_future(_asgi_request(app, "POST", "/predict/", body))
+            for body in (b"[1]", b"[1]", b"[2]", b"[1]")
+        ]
+        await asyncio.sleep(0.01)
+        in_flight = app.coalescer.in_flight
+        app.release_predictions.set()
+        responses = await asyncio.gather(*requests)
+        metrics = await _asgi_request(app, "GET", "/metrics/")
+        return in_flight, responses, metrics
+
+    in_flight, responses, metrics = asyncio.new_event_loop().run_until_complete(
+        request_concurrently()
+    )
+    assert in_flight == 2
+    assert [(status, body) for status, _, body in responses] == [
+        (200, b"[2]"),
+        (200, b"[2]"),
+        (200, b"[3]"),
+        (200, b"[2]"),
+    ]
+    assert app.predict_calls == 2
+    assert app.coalescer.in_flight == 0
+    text = metrics[2].decode()
+    assert 'foxcross_coalesced_requests_total{model_name="Coalescing-Model"} 2' in text
+
+    # Nothing is kept once the prediction finishes
+    client = TestClient(app)
+    response = client.post(
+        "/predict/", headers={"Accept": MediaTypes.JSON.value}, json=[1]
+    )
+    assert response.json() == [2]
+    assert app.predict_calls == 3
+
+
+def test_request_coalescer_survives_cancelled_waiter():
+    coalescer = RequestCoalescer()
+    calls = []
+
+    async def predict():
+        calls.append(None)
+        await asyncio.sleep(0.01)
+        return b"result"
+
+    async def cancel_first_waiter():
+        first = asyncio.ensure_future(coalescer.run("key", predict))
+        second = asyncio.ensure_future(coalescer.run("key", predict))
+        await asyncio.sleep(0)
+        first.cancel()
+        return await second
+
+    loop = asyncio.new_event_loop()
+    assert loop.run_until_complete(cancel_first_waiter()) == b"result"
+    assert (len(calls), coalescer.coalesced, coalescer.in_flight) == (1, 1, 0)
+
+    async def fail():
+        raise HTTPException(status_code=400, detail="Bad input")
+
+    async def fail_together():
+        return await asyncio.gather(
+            coalescer.run("key", fail), coalescer.run("key", fail), return_exceptions=True
+        )
+
+    errors = loop.run_until_complete(fail_together())
+    assert [error.status_code for error in errors] == [400, 400]
+    assert coalescer.in_flight == 0
+
+
+def test_admission_controller_priorities():
+    async def acquire_in_order():
+        admission = AdmissionController(1, 1, retry_after=2)
+        await admission.acquire(0)
+        low = asyncio.ensure_future(admission.acquire(1))
+        await asyncio.sleep(0)
+        assert admission.queue_depth == 1
+        with pytest.raises(ServiceUnavailableException) as exc_info:
+            await admission.acquire(1)
+        assert exc_info.value.headers == {"Retry-After": "2"}
+        # A higher priority request replaces the queued low priority one
+        high = asyncio.ensure_future(admission.acquire(0))
+        await asyncio.sleep(0)
+        with pytest.raises(ServiceUnavailableException):
+            await low
+        admission.release()
+        await high
+        assert admission.in_flight == 1
+        admission.release()
+        assert (admission.in_flight, admission.queue_depth, admission.shed) == (0, 0, 2)
+
+    asyncio.new_event_loop().run_until_complete(acquire_in_order())
+
+
+def test_admission_controller_cancelled_waiters():
+    async def cancel_and_release():
+        admission = AdmissionController(1, 2, retry_after=2)
+        await admission.acquire(0)
+        cancelled = asyncio.ensure_future(admission.acquire(0))
+        await asyncio.sleep(0)
+        # Released in the same loop iteration, before the cancelled waiter cleans up
+        cancelled.cancel()
+        admission.release()
+        with pytest.raises(asyncio.CancelledError):
+            await cancelled
+        assert (admission.in_flight, admission.queue_depth) == (0, 0)
+        await asyncio.wait_for(admission.acquire(0), 1)
+
+        # A waiter shed and then cancelled does not release a slot it never held
+        low = [asyncio.ensure_future(admission.acquire(1)) for _ in range(2)]
+        await asyncio.sleep(0)
+        high = asyncio.ensure_future(admission.acquire(0))
+        await asyncio.sleep(0)
+        low[1].cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await low[1]
+        assert (admission.in_flight, admission.queue_depth) == (1, 2)
+        admission.release()
+        await asyncio.wait_for(high, 1)
+        admission.release()
+        await asyncio.wait_for(low[0], 1)
+        admission.release()
+        assert (admission.in_flight, admission.queue_depth) == (0, 0)
+
+    asyncio.new_event_loop().run_until_complete(cancel_and_release())
+
+
+def test_admission_control_sheds_load():
+    app = AdmissionModel(debug=True)
+
+    async def request_concurrently():
+        app.release_predictions = asyncio.Event()
+        body = json.dumps([1]).encode()
+        requests = [
+            asyncio.ensure_future(_asgi_request(app, "POST", "/predict/", body))
+            for _ in range(2)
+        ]
+        await asyncio.sleep(0.01)
+        shed = await _asgi_request(app, "POST", "/predict/", body)
+        # The metrics endpoint is never queued behind predictions
+        metrics = await _asgi_request(app, "GET", "/metrics/")
+        app.release_predictions.set()
+        return shed, metrics, await asyncio.gather(*requests)
+
+    shed, metrics, responses = asyncio.new_event_loop().run_until_complete(
+        request_concurrently()
+    )
+    assert shed[0] == 503
+    assert shed[1]["retry-after"] == "3"
+    assert [status for status, _, _ in responses] == [200, 200]
+    text = metrics[2].decode()
+    assert 'foxcross_admission_in_flight{model_name="Admission-Model"} 1' in text
+    assert 'foxcross_admission_queue_depth{model_name="Admission-Model"} 1' in text
+    assert 'foxcross_admission_shed_total{model_name="Admission-Model"} 1' in text
+    assert "# TYPE foxcross_admission_shed_total counter" in text
+    assert app.admission.in_flight == 0
+
+
+def test_lazy_load():
+    app = CachedPredictTestModel(debug=True, lazy_load=True, warmup=True)
+    assert app.load_time is None
+    client = TestClient(app)
+    headers = {"Accept": MediaTypes.JSON.value}
+    assert client.get("/").status_code == 200
+    response = client.post("/predict/", headers=headers, json=add_one_data)
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "1"
+    assert _wait_for(lambda: app.load_time is not None)
+    # Warming up ran the test data through predict once
+    assert app.predict_calls == 1
+    response = client.post("/predict/", headers=headers, json=add_one_data)
+    assert response.status_code == 200
+    text = client.get("/metrics/").text
+    assert 'foxcross_model_ready{model_name="Cached-Predict-Test-Model"} 1' in text
+    assert "# TYPE foxcross_model_load_seconds gauge" in text
+
+
+def test_parallel_load():
+    runner = ModelServingRunner(LoadBarrierModel, ())
+    # Fails with BrokenBarrierError unless both models load concurrently
+    LoadBarrierModel.load_barrier = threading.Barrier(2, timeout=5)
+    try:
+        app = runner.compose(__name__, load_mode="parallel")
+    finally:
+        LoadBarrierModel.load_barrier = None
+    assert all(route.app.load_time is not None for route in app.routes[:2])
+    client = TestClient(app)
+    response = client.post(
+        "/load-barrier-model/predict/",
+        headers={"Accept": MediaTypes.JSON.value},
+        json=add_one_data,
+    )
+    assert response.status_code == 200
+
+
+def test_eager_load_warmup():
+    app = CachedPredictTestModel(debug=True, warmup=True)
+    assert app.predict_calls == 1
+    assert app.load_time is not None
+
+
+def test_compressed_response():
+    headers = {"Accept": MediaTypes.JSON.value, "Accept-Encoding": "gzip"}
+    client = TestClient(CompressedModel())
+    response = client.post("/predict/", headers=headers, json=add_one_data)
+    assert response.status_code == 200
+    assert response.headers["content-encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["vary"]
+    assert response.json() == add_one_result_data
+
+    # Responses smaller than compression_minimum_size are sent as they are
+    response = TestClient(AddOneModel()).post(
+        "/predict/", headers=headers, json=add_one_data
+    )
+    assert "content-encoding" not in response.headers
+    assert response.json() == add_one_result_data
+
+    response = TestClient(CompressedModel(gzip_response=False)).post(
+        "/predict/", headers=headers, json=add_one_data
+    )
+    assert "content-encoding" not in response.headers
+
+
+def test_compressed_stream_response():
+    app = CompressedModel()
+    app.stream_chunk_size = 2
+    headers = {
+        "Accept": MediaTypes.NDJSON.value,
+        "Content-Type": MediaTypes.NDJSON.value,
+        "Accept-Encoding": "gzip",
+    }
+    response = TestClient(app).post("/predict-stream/", headers=headers, data=b"1\n2\n3")
+    assert response.status_code == 200
+    assert response.headers["content-encoding"] == "gzip"
+    assert "content-length" not in response.headers
+    assert [json.loads(line) for line in response.text.splitlines()] == [2, 3, 4]
+
+
+def test_precompressed_response_cache():
+    app = CompressedModel()
+    client = TestClient(app)
+    headers = {"Accept": MediaTypes.JSON.value, "Accept-Encoding": "gzip"}
+    for _ in range(3):
+        response = client.post("/input-format/", headers=headers)
+        assert response.headers["content-encoding"] == "gzip"
+        assert response.json() == add_one_data
+    assert app.compression_cache.misses == 1
+    assert app.compression_cache.hits == 2
+
+    # Prediction results are not cached
+    client.post("/predict/", headers=headers, json=add_one_data)
+    assert len(app.compression_cache) == 1
+
+
+@pytest.mark.parametrize(
+    "accept_encoding,expected",
+    [
+        ("gzip", "gzip"),
+        ("gzip, br", "br"),
+        ("gzip;q=1.0, br;q=0.5", "gzip"),
+        ("*", "zstd"),
+        ("*, zstd;q=0", "br"),
+        ("gzip;q=0", None),
+        ("identity", None),
+        ("", None),
+    ],
+)
+def test_negotiate_encoding(accept_encoding, expected):
+    assert negotiate_encoding(accept_encoding, ("zstd", "br", "gzip")) == expected
+
+
+@pytest.mark.parametrize(
+    "accept,expected",
+    [
+        ("application/json", "application/json"),
+        ("application/x-npy, application/json", "application/x-npy"),
+        ("application/json, application/x-npy;q=0.1", "application/json"),
+        ("application/x-npy;q=0.5, application/*;q=0.8", "application/json"),
+        ("application/*, application/x-npy;q=0", "application/json"),
+        ("*/*", "application/json"),
+        ("text/*;q=0.5, */*;q=0.1", "text/csv"),
+        ("Application/X-NPY; charset=binary", "application/x-npy"),
+        ("application/json;q=0", None),
+        ("text/html", None),
+    ],
+)
+def test_content_negotiator(accept, expected):
+    negotiator = ContentNegotiator(
+        {"application/json": "json", "application/x-npy": "npy", "text/csv": "csv"}
+    )
+    negotiated = negotiator.negotiate(accept)
+    if expected is None:
+        assert negotiated is None
+    else:
+        assert negotiated == (expected, negotiator.codecs[expected])
+
+
+def test_content_negotiator_cache():
+    negotiator = ContentNegotiator({"application/json": None}, cache_size=2)
+    for _ in range(3):
+        negotiator.negotiate("application/json")
+    negotiator.negotiate("*/*")
+    info = negotiator.negotiate.cache_info()
+    assert (info.hits, info.misses, info.maxsize) == (2, 2, 2)
+
+
+@pytest.mark.parametrize("gzip_response", [True, False])
+def test_compressed_request_body(gzip_response):
+    client = TestClient(CompressedModel(gzip_response=gzip_response))
+    headers = {
+        "Accept": MediaTypes.JSON.value,
+        "Content-Type": MediaTypes.JSON.value,
+        "Content-Encoding": "gzip",
+    }
+    body = gzip.compress(json.dumps(add_one_data).encode())
+    response = client.post("/predict/", headers=headers, data=body)
+    assert response.status_code == 200
+    assert response.json() == add_one_result_data
+
+
+@pytest.mark.parametrize(
+    "content_encoding,body,status_code",
+    [
+        ("gzip", b"not gzip", 400),
+        ("gzip", gzip.compress(b"[1, 2, 3]")[:-4], 400),
+        ("gzip", gzip.compress(json.dumps(list(range(100))).encode()), 413),
+        ("compress", b"[1, 2, 3]", 415),
+    ],
+)
+def test_compressed_request_body_errors(content_encoding, body, status_code):
+    client = TestClient(CompressedModel())
+    headers = {
+        "Accept": MediaTypes.JSON.value,
+        "Content-Type": MediaTypes.JSON.value,
+        "Content-Encoding": content_encoding,
+    }
+    response = client.post("/predict/", headers=headers, data=body)
+    assert response.status_code == status_code
+
+
+@pytest.mark.parametrize("codec", list(JSONCodecs))
+def test_json_codecs(codec):
+    if codec is not JSONCodecs.AUTO and codec not in available_json_codecs():
+        pytest.skip(f"{codec.value} is not installed")
+    model_serving = type("CodecModel", (AddOneModel,), {"json_codec": codec.value})
+    client = TestClient(model_serving())
+    headers = {"Accept": MediaTypes.JSON.value}
+    response = client.post("/predict/", headers=headers, json=add_one_data)
+    assert response.status_code == 200
+    assert response.headers["content-type"] == MediaTypes.JSON.value
+    assert response.json() == add_one_result_data
+    assert client.post("/input-format/", headers=headers).json() == add_one_data
+
+    headers["Content-Type"] = MediaTypes.JSON.value
+    response = client.post("/predict/", headers=headers, data=b"[1, 2")
+    assert response.status_code == 400
+    assert response.text.startswith("Failed to load request body into JSON")
+
+
+def test_json_codec_auto_prefers_fastest():
+    codec = get_json_codec()
+    assert type(codec) is type(get_json_codec(available_json_codecs()[0]))
+    assert (
+        get_json_codec(JSONCodecs.JSON).dumps({"a": [1, "é"]}) == '{"a":[1,"é"]}'.encode()
+    )
+
+
+def test_json_codec_not_installed():
+    missing = [
+        codec
+        for codec in (JSONCodecs.ORJSON, JSONCodecs.UJSON)
+        if codec not in available_json_codecs()
+    ]
+    if not missing:
+        pytest.skip("every JSON codec is installed")
+    with pytest.raises(ImportError):
+        get_json_codec(missing[0])
+
+
+def _store_weights(directory, marker_directory):
+    numpy = pytest.importorskip("numpy")
+    from foxcross.model_store import ModelStore
+
+    def create():
+        (marker_directory / str(os.getpid())).touch()
+        time.sleep(0.1)
+        return numpy.arange(1000.0)
+
+    weights = ModelStore(directory).get_or_create("weights", create)
+    assert weights.sum() == sum(range(1000))
+
+
+def test_model_store(tmp_path):
+    numpy = pytest.importorskip("numpy")
+    from foxcross.model_store import ModelStore
+
+    store = ModelStore(tmp_path / "store")
+    calls = []
+
+    def create():
+        calls.append(1)
+        return numpy.arange(10.0)
+
+    weights = store.get_or_create("weights", create)
+    assert isinstance(weights, numpy.memmap)
+    assert not weights.flags.writeable
+    assert weights.tolist() == list(range(10))
+    assert store.get_or_create("weights", create).tolist() == list(range(10))
+    assert len(calls) == 1
+
+    source = tmp_path / "model.bin"
+    source.touch()
+    os.utime(source, (time.time() + 10, time.time() + 10))
+    store.get_or_create("weights", create, source=source)
+    assert len(calls) == 2
+
+    layers = store.get_or_create(
+        "layers", lambda: {"dense": numpy.eye(2), "bias": numpy.zeros(2)}
+    )
+    assert sorted(layers) == ["bias", "dense"]
+    assert layers["dense"].tolist() == [[1, 0], [0, 1]]
+    assert store.get("layers")["bias"].tolist() == [0, 0]
+
+    store.remove("layers")
+    with pytest.raises(KeyError):
+        store.get("layers")
+    with pytest.raises(ValueError):
+        store.get_or_create("../weights", create)
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="requires os.fork")
+def test_model_store_creates_once_across_processes(tmp_path):
+    pytest.importorskip("numpy")
+    markers = tmp_path / "markers"
+    markers.mkdir()
+    processes = [
+        multiprocessing.get_context("fork").Process(
+            target=_store_weights, args=(tmp_path / "store", markers)
+        )
+        for _ in range(3)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(timeout=30)
+    assert [process.exitcode for process in processes] == [0, 0, 0]
+    assert len(list(markers.iterdir())) == 1
+
+
+def test_model_serving_model_store(tmp_path):
+    numpy = pytest.importorskip("numpy")
+
+    def load_model(self):
+        self.offset = self.model_store.get_or_create("offset", lambda: numpy.ones(1))
+
+    model_serving = type(
+        "StoreModel",
+        (AddOneModel,),
+        {
+            "model_store_path": str(tmp_path),
+            "load_model": load_model,
+            "predict": lambda self, data: [x + int(self.offset[0]) for x in data],
+        },
+    )
+    app = model_serving()
+    assert app.model_store.directory == tmp_path / "Store-Model"
+    assert (tmp_path / "Store-Model" / "offset.npy").exists()
+    response = TestClient(app).post(
+        "/predict/", headers={"Accept": MediaTypes.JSON.value}, json=add_one_data
+    )
+    assert response.json() == add_one_result_data
+
+
+def test_reload_endpoint():
+    app = ReloadModel(debug=True)
+    client = TestClient(app)
+    headers = {"Accept": MediaTypes.JSON.value}
+    assert client.post("/predict/", headers=headers, json=[1, 2]).json() == [2, 3]
+    assert client.get("/reload/", headers=headers).json() == {
+        "model_version": 1,
+        "reloading": False,
+        "reload_seconds": None,
+        "reload_error": None,
+    }
+    try:
+        ReloadModel.increment = 5
+        response = client.post("/reload/", headers=headers)
+        assert response.status_code == 202
+        # The test client only runs the event loop during requests
+        assert _wait_for(
+            lambda: client.get("/reload/", headers=headers).json()["model_version"] == 2
+        )
+        assert client.post("/predict/", headers=headers, json=[1, 2]).json() == [6, 7]
+
+        # A model that fails validation against the test data is not swapped in
+        ReloadModel.increment = 10
+        ReloadModel.fail_predictions = True
+        client.post("/reload/", headers=headers)
+        assert _wait_for(
+            lambda: client.get("/reload/", headers=headers).json()["reload_error"]
+        )
+        ReloadModel.fail_predictions = False
+    finally:
+        ReloadModel.increment = 1
+        ReloadModel.fail_predictions = False
+    status = client.get("/reload/", headers=headers).json()
+    assert status["model_version"] == 2
+    assert status["reload_error"] == "ValueError: broken model"
+    assert client.post("/predict/", headers=headers, json=[1, 2]).json() == [6, 7]
+    text = client.get("/metrics/").text
+    assert 'foxcross_model_version{model_name="Reload-Model"} 2' in text
+    assert 'foxcross_model_reloads_total{model_name="Reload-Model"} 1' in text
+    assert 'foxcross_model_reload_failures_total{model_name="Reload-Model"} 1' in text
+
+    lazy_client = TestClient(ReloadModel(lazy_load=True))
+    assert lazy_client.post("/reload/", headers=headers).status_code == 409
+    assert TestClient(AddOneModel()).post("/reload/", headers=headers).status_code == 404
+
+
+@pytest.mark.parametrize(
+    "attributes", [{}, {"result_cache_size": 8, "coalesce_requests": True}]
+)
+def test_reload_keeps_in_flight_requests_on_old_model(attributes):
+    app = type("ReloadedModel", (ReloadModel,), attributes)(debug=True)
+    app.reload_validate = False
+
+    async def reload_during_request():
+        app.release_predictions = asyncio.Event()
+        before = asyncio.ensure_future(_asgi_request(app, "POST", "/predict/", b"[1]"))
+        await asyncio.sleep(0.01)
+        assert await app.reload_model()
+        after = asyncio.ensure_future(_asgi_request(app, "POST", "/predict/", b"[1]"))
+        await asyncio.sleep(0.01)
+        app.release_predictions.set()
+        results = await before, await after
+        # Neither the cache nor coalescing hands out the old model's result
+        return results + (await _asgi_request(app, "POST", "/predict/", b"[1]"),)
+
+    ReloadModel.increment = 5
+    try:
+        before, after, later = asyncio.new_event_loop().run_until_complete(
+            reload_during_request()
+        )
+    finally:
+        ReloadModel.increment = 1
+    assert json.loads(before[2]) == [2]
+    assert json.loads(after[2]) == [6]
+    assert json.loads(later[2]) == [6]
+
+
+def test_reload_on_model_file_change(tmp_path):
+    model_file = tmp_path / "model.bin"
+    model_file.write_bytes(b"1")
+    model_serving = type(
+        "WatchedModel",
+        (ReloadModel,),
+        {"reload_watch_paths": (str(model_file),), "reload_poll_seconds": 0.05},
+    )
+    app = model_serving()
+    headers = {"Accept": MediaTypes.JSON.value}
+    with TestClient(app) as client:
+        model_file.write_bytes(b"22")
+        assert _wait_for(
+            lambda: client.get("/reload/", headers=headers).json()["model_version"] == 2
+        )
+        assert client.post("/predict/", headers=headers, json=[1]).json() == [2]
+    assert app._watch_task is None
+
+
+def test_profile_header():
+    app = ProfiledModel()
+    client = TestClient(app)
+    headers = {"Accept": MediaTypes.JSON.value}
+    response = client.post("/predict/", headers=headers, json=add_one_data)
+    assert response.json() == add_one_result_data
+    assert app.profiler.profiled == 0
+    response = client.post(
+        "/predict/", headers={**headers, "X-Profile": "1"}, json=add_one_data
+    )
+    assert response.json() == add_one_result_data
+    assert app.profiler.profiled == 1
+
+    response = client.get("/profile/?sort=tottime&limit=5")
+    assert response.status_code == 200
+    assert response.text.startswith("1 profiled predictions")
+    assert "_process_prediction" in client.get("/profile/").text
+    assert client.get("/profile/?sort=bogus").status_code == 400
+    text = client.get("/metrics/").text
+    assert 'foxcross_profiled_predictions_total{model_name="Profiled-Model"} 1' in text
+
+    assert client.delete("/profile/").status_code == 204
+    assert client.get("/profile/").text == "No predictions have been profiled yet\n"
+
+
+@pytest.mark.parametrize("model_serving", [ThreadAddOneModel, AsyncAddOneModel])
+def test_profile_sample_rate(model_serving, tmp_path):
+    app = type(
+        "SampledModel",
+        (model_serving,),
+        {"profile_sample_rate": 1.0, "profile_directory": str(tmp_path)},
+    )()
+    client = TestClient(app)
+    for _ in range(2):
+        response = client.post(
+            "/predict/", headers={"Accept": MediaTypes.JSON.value}, json=add_one_data
+        )
+        assert response.json() == add_one_result_data
+    assert app.profiler.profiled == 2
+    dumps = sorted(tmp_path.glob("Sampled-Model-*.prof"))
+    assert len(dumps) == 2
+    assert pstats.Stats(str(dumps[0])).total_calls > 0
+
+
+def test_profiling_disabled():
+    app = AddOneModel()
+    assert app.profiler is None
+    assert TestClient(app).get("/profile/").status_code == 404
+
+
+def _write_ndjson(path: Path, records: list):
+    path.write_text("".join(json.dumps(record) + "\n" for record in records))
+
+
+def _read_ndjson(path: Path) -> list:
+    return [json.loads(line) for line in path.read_text().splitlines()]
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+@pytest.mark.parametrize("model", ["AddOneModel", "async-add-one-model"])
+def test_batch_ndjson(model, workers, tmp_path):
+    input_path = tmp_path / "input.ndjson"
+    _write_ndjson(input_path, add_one_data)
+    summary = run_batch(
+        input_path,
+        tmp_path / "output.jsonl",
+        module_name=__name__,
+        model=model,
+        chunk_size=2,
+        workers=workers,
+    )
+    assert _read_ndjson(tmp_path / "output.jsonl") == add_one_result_data
+    assert summary["rows"] == len(add_one_data)
+    assert summary["chunks"] == 3
+    assert summary["rows_per_second"] > 0
+
+
+def test_batch_json(tmp_path):
+    summary = run_batch(
+        add_one_data_path,
+        tmp_path / "output",
+        module_name=__name__,
+        model="AddOneModel",
+        output_format="ndjson",
+    )
+    assert _read_ndjson(tmp_path / "output") == add_one_result_data
+    assert summary["chunks"] == 1
+
+
+def test_batch_errors(tmp_path):
+    assert find_batch_model_serving(__name__, "add-five-model") is AddFiveModel
+    with pytest.raises(NoModelServingFoundError, match="several model servings"):
+        find_batch_model_serving(__name__)
+    with pytest.raises(NoModelServingFoundError):
+        find_batch_model_serving(__name__, "MissingModel")
+
+    input_path = tmp_path / "input.ndjson"
+    _write_ndjson(input_path, [1, 2, "three"])
+    with pytest.raises(BatchPredictionError, match="Chunk 2 failed: Must be a list"):
+        run_batch(
+            input_path,
+            tmp_path / "output.ndjson",
+            module_name=__name__,
+            model="AddOneModel",
+            chunk_size=2,
+        )
+    assert _read_ndjson(tmp_path / "output.ndjson") == [2, 3]
+    input_path.write_text("1\n{\n")
+    with pytest.raises(BatchPredictionError, match="line 2"):
+        run_batch(input_path, tmp_path / "output.ndjson", __name__, model="AddOneModel")
+    with pytest.raises(ValueError):
+        run_batch(input_path, tmp_path / "output.json", __name__, model="AddOneModel")
+    with pytest.raises(ValueError):
+        run_batch(input_path, tmp_path / "output.txt", __name__, model="AddOneModel")
+
+
+def test_batch_cli(tmp_path, capsys):
+    input_path = tmp_path / "input.ndjson"
+    output_path = tmp_path / "output.ndjson"
+    _write_ndjson(input_path, add_one_data)
+    args = ["batch", str(input_path), str(output_path), "--module", __name__]
+    assert main(args + ["--model", "add-one-model", "--chunk-size", "2"]) == 0
+    assert _read_ndjson(output_path) == add_one_result_data
+    assert main(args) == 1
+    assert main([]) == 2
+
+
+def _import_time(module_name: str, unexpected_modules: tuple) -> float:
+    """Cumulative import time of module_name in seconds, in a fresh interpreter"""
+    output = subprocess.run(
+        [
+            sys.executable,
+            "-X",
+            "importtime",
+            "-c",
+            f"import sys, {module_name}; print(*[x for x in {unexpected_modules!r}"
+            " if x in sys.modules])",
+        ],
+        cwd=str(Path(__file__).parent.parent),
+        check=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    assert output.stdout.strip() == ""
+    for line in output.stderr.splitlines():
+        _, cumulative, name = line.split("|")
+        if name.strip() == module_name:
+            return int(cumulative) / 1e6
+    raise AssertionError(f"{module_name} was not imported")
+
+
+def test_import_time_budget():
+    # jinja2 is only needed for the HTML pages, uvicorn for run_model_serving and
+    # multiprocessing for process pools
+    assert _import_time("foxcross.serving", ("jinja2", "uvicorn", "multiprocessing")) < 1
+
+
+def test_api_only(caplog):
+    app = type("APIOnlyModel", (AddOneModel,), {"api_only": True})()
+    client = TestClient(app)
+    headers = {"Accept": MediaTypes.JSON.value}
+    assert client.post("/predict/", headers=headers, json=add_one_data).status_code == 200
+    assert client.post("/predict-test/", headers=headers).status_code == 200
+    assert client.post("/input-format/", headers=headers).status_code == 200
+    for path in ("/predict/", "/predict-stream/", "/predict-test/", "/input-format/"):
+        assert client.get(path, headers={"Accept": "text/html"}).status_code == 405
+    assert client.get("/", headers={"Accept": "text/html"}).status_code == 404
+
+    runner = ModelServingRunner(ModelServing, (ModelServing,))
+    module = type(sys)("api_only_models")
+    module.APIOnlyModel = type(app)
+    module.OtherAPIOnlyModel = type("OtherAPIOnlyModel", (type(app),), {})
+    sys.modules[module.__name__] = module
+    try:
+        with caplog.at_level("INFO", logger="foxcross.runner"):
+            app = runner.compose(module.__name__)
+    finally:
+        del sys.modules[module.__name__]
+    assert TestClient(app).get("/").status_code == 404
+    messages = [record.getMessage() for record in caplog.records]
+    assert re.match(r"Imported api_only_models in \d+\.\d{3}s", messages[0])
+    assert re.match(
+        r"Started APIOnlyModel: load_model \d+\.\d{3}s, route setup \d+\.\d{3}s",
+        messages[1],
+    )
+
+
+def _slow_predict(self, data: Any) -> Any:
+    # Blocks the event loop of the process serving the model
+    time.sleep(1)
+    return [x + 1 for x in data]
+
+
+def test_isolated_models():
+    runner = ModelServingRunner(ModelServing, (ModelServing,))
+    module = type(sys)("isolated_models")
+    module.SlowModel = type(
+        "SlowModel", (AddOneModel,), {"isolated_workers": 1, "predict": _slow_predict}
+    )
+    module.FastModel = type("FastModel", (AddOneModel,), {"isolated_workers": 2})
+    module.InProcessModel = type("InProcessModel", (AddOneModel,), {})
+    sys.modules[module.__name__] = module
+    try:
+        app = runner.compose(module.__name__)
+    finally:
+        del sys.modules[module.__name__]
+    processes = [
+        route.app.process for route in app.routes if hasattr(route.app, "process")
+    ]
+    assert sorted(process.name for process in processes) == ["FastModel", "SlowModel"]
+    headers = {"Accept": MediaTypes.JSON.value}
+    with TestClient(app) as client:
+        for path in ("/fast-model/predict/", "/in-process-model/predict/"):
+            response = client.post(path, headers=headers, json=add_one_data)
+            assert response.status_code == 200
+            assert response.json() == add_one_result_data
+        response = client.get("/fast-model/", headers={"Accept": "text/html"})
+        assert response.status_code == 200
+        response = client.get("/", headers={"Accept": "text/html"})
+        assert response.status_code == 200
+        assert 'href="/fast-model/predict/"' in response.text
+        # A request body without a content length is streamed to the model
+        response = client.post(
+            "/fast-model/predict-stream/",
+            headers={
+                "Accept": MediaTypes.NDJSON.value,
+                "Content-Type": MediaTypes.NDJSON.value,
+            },
+            data=(line for line in (b"1\n2\n", b"3\n")),
+        )
+        assert response.status_code == 200
+        assert response.text.splitlines() == ["2", "3", "4"]
+
+        async def request_while_saturated():
+            slow = asyncio.ensure_future(
+                _asgi_request(app, "POST", "/slow-model/predict/", b"[1]")
+            )
+            await asyncio.sleep(0.2)
+            started_at = time.perf_counter()
+            fast = await _asgi_request(app, "POST", "/fast-model/predict/", b"[1]")
+            return fast, time.perf_counter() - started_at, await slow
+
+        fast, fast_seconds, slow = asyncio.new_event_loop().run_until_complete(
+            request_while_saturated()
+        )
+        assert (fast[0], fast[2]) == (200, b"[2]")
+        assert fast_seconds < 0.5
+        assert (slow[0], slow[2]) == (200, b"[2]")
+        pids = [process.pid for process in processes]
+    assert all(process.pid is None for process in processes)
+    for pid in pids:
+        with pytest.raises(ProcessLookupError):
+            os.kill(pid, 0)
+
+    response = TestClient(app).post("/fast-model/predict/", headers=headers, json=[1])
+    assert response.status_code == 503